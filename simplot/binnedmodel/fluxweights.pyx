@@ -14,8 +14,9 @@ cdef class FluxWeights:
     cdef vector[uint64_t] _parindex
     cdef vector[uint64_t] _keys
     cdef list parameter_names
+    cdef list _derivatives
 
-    def __cinit__(self, parnames, shape, enudim, flavdim, detdim, beammodedim, parametermap=None, flavbinmap=_DEFAULT_FLAV_BINMAP):
+    def __init__(self, parnames, shape, enudim, flavdim, detdim, beammodedim, parametermap=None, flavbinmap=_DEFAULT_FLAV_BINMAP):
         parameter_names = list(parnames)
         #setup array
         fluxshape = [0 for s in shape]
@@ -96,6 +97,36 @@ cdef class FluxWeights:
         _update(self, pars)
         return self._arr
 
+    def __reduce__(self):
+        return (_restore_fluxweights, (self._arr, list(self._parindex), list(self._keys), self.parameter_names))
+
+    def derivatives(self, pars):
+        """Returns [(parameter index, derivative of the weights array)].
+        The weights are the parameter values so each derivative is 1 in the bins of that parameter."""
+        if self._derivatives is None:
+            self._derivatives = _build_derivatives(self)
+        return self._derivatives
+
+def _restore_fluxweights(arr, parindex, keys, parameter_names):
+    cdef FluxWeights result = FluxWeights.__new__(FluxWeights)
+    result._arr = arr
+    result._parindex = parindex
+    result._keys = keys
+    result.parameter_names = parameter_names
+    return result
+
+cdef list _build_derivatives(FluxWeights self):
+        cdef dict arrays = {}
+        cdef SparseArray arr
+        cdef int ii
+        for ii in xrange(self._keys.size()):
+            parindex = self._parindex[ii]
+            if parindex not in arrays:
+                arrays[parindex] = SparseArray(self._arr.shape())
+            arr = arrays[parindex]
+            arr._data[self._keys[ii]] = 1.0
+        return sorted(arrays.items())
+
 cdef void _update(FluxWeights self, vector[double]& pars):
         cdef int ii
         cdef uint64_t key
@@ -2,7 +2,8 @@
 
 #from sparsehist import SparseArray
 from simplot.sparsehist.sparsehist cimport SparseArray
-from simplot.sparsehist.sparsehist cimport std_map
+from simplot.sparsehist.sparsehist cimport std_map, find_value
+from simplot.sparsehist.sparsehist import DenseArray, choose_storage, DENSE_OCCUPANCY_THRESHOLD
 import numpy as np
 cimport numpy as np
 
@@ -12,6 +13,9 @@ from cython.operator cimport dereference, preincrement
 import itertools
 import StringIO
 
+from simplot.pdg import PdgNeutrinoOscillationParameters
+from simplot.binnedmodel.serialize import save_model, load_model
+
 #from rootglobes import crootglobes
 
 from libcpp.vector cimport vector
@@ -47,25 +51,27 @@ class OscParMode:
 ################################################################################
 
 cdef class BinnedModel:
-    cdef SparseArray _N_sel;
+    cdef object _N_sel;
     cdef _flux_weights;
     cdef _xsec_weights;
     cdef _det_weights;
     cdef list _parnames;
     cdef vector[uint64_t] _obs;
-    def __init__(self, parnames, N_sel, obs, flux_weights=None, xsec_weights=None, det_weights=None):
+    def __init__(self, parnames, N_sel, obs, flux_weights=None, xsec_weights=None, det_weights=None, densethreshold=DENSE_OCCUPANCY_THRESHOLD, dtype=np.float64):
+        """The histogram is stored as a DenseArray with values of dtype if at least densethreshold of its bins are filled
+        (densethreshold=None always uses sparse storage, which is float64). The prediction is always calculated in float64."""
         self._parnames = parnames
         self._obs = obs
         #self._shape = N_sel.array().shape()
-        self._N_sel = N_sel.array()
+        self._N_sel = choose_storage(N_sel.array(), densethreshold, dtype=dtype)
         if flux_weights is None:
-            flux_weights = lambda x: _identity(self._N_sel.shape())
+            flux_weights = _IdentityWeights(self._N_sel.shape())
         self._flux_weights = flux_weights
         if xsec_weights is None:
-            xsec_weights = lambda x: _identity(self._N_sel.shape())
+            xsec_weights = _IdentityWeights(self._N_sel.shape())
         self._xsec_weights = xsec_weights
         if det_weights is None:
-            det_weights = lambda x: _identity(self._N_sel.shape())
+            det_weights = _IdentityWeights(self._N_sel.shape())
         self._det_weights = det_weights
         return
 
@@ -78,16 +84,53 @@ cdef class BinnedModel:
     def observable(self, pars):
         return self.eval(pars).project(self._obs)
 
+    def jacobian(self, pars):
+        return self.observable_and_jacobian(pars)[1]
+
+    def observable_and_jacobian(self, pars):
+        """Returns the flattened observable rate vector and its derivatives with respect to each parameter, [nbins, npars].
+        Weights without derivatives(pars) are differentiated with central differences."""
+        pars = np.asarray(pars, dtype=float)
+        det = self._det_weights(pars)
+        xsec = self._xsec_weights(pars)
+        flux = self._flux_weights(pars)
+        fluxsel = flux * self._N_sel
+        nodet = xsec * fluxsel
+        obs = (det * nodet).project(self._obs).flatten()
+        jac = np.zeros((len(obs), len(pars)), dtype=float)
+        #each parameter only enters one of the weights, so its derivative multiplies the product of the other factors,
+        #which is shared by all parameters of these weights
+        derivatives = _weight_derivatives(self._flux_weights, pars, self._parnames)
+        if derivatives:
+            _add_weight_jacobian(jac, derivatives, det * (xsec * self._N_sel), self._obs)
+        derivatives = _weight_derivatives(self._xsec_weights, pars, self._parnames)
+        if derivatives:
+            _add_weight_jacobian(jac, derivatives, det * fluxsel, self._obs)
+        _add_weight_jacobian(jac, _weight_derivatives(self._det_weights, pars, self._parnames), nodet, self._obs)
+        return obs, jac
+
     def parameter_names(self):
         return self._parnames
 
+    def __reduce__(self):
+        return (_restore_binnedmodel, (self._parnames, self._N_sel, list(self._obs), self._flux_weights, self._xsec_weights, self._det_weights))
+
+    def save(self, path):
+        """Writes the model, ready to evaluate, to path (see simplot.binnedmodel.serialize)."""
+        save_model(self, path)
+        return
+
+    @classmethod
+    def load(cls, path, mmap=False, probabilitycalc=None):
+        return load_model(path, mmap=mmap, probabilitycalc=probabilitycalc, expected=cls)
+
 ################################################################################
 
 cdef class BinnedModelWithOscillation:
     cdef vector[uint64_t] _shape;
-    cdef SparseArray _N_sel;
-    cdef SparseArray _eff;
-    cdef SparseArray N_nosel;
+    cdef object _N_sel;
+    cdef object _eff;
+    cdef object N_nosel;
     cdef vector[uint64_t] _obs;
     cdef uint64_t _flav_dimension;
     cdef uint64_t _enu_dimension;
@@ -100,12 +143,19 @@ cdef class BinnedModelWithOscillation:
     cdef _osc_flux_weights;
     cdef list _parnames;
 
-    def __init__(self, parnames, N_sel, N_nosel, obs, enudim, flavdim, detdim, detdist, flux_weights=None, xsec_weights=None, det_weights=None, probabilitycalc=None, oscparmode=OscParMode.SINSQTHETA):
+    def __init__(self, parnames, N_sel, N_nosel, obs, enudim, flavdim, detdim, detdist, flux_weights=None, xsec_weights=None, det_weights=None, probabilitycalc=None, oscparmode=OscParMode.SINSQTHETA, densethreshold=DENSE_OCCUPANCY_THRESHOLD, dtype=np.float64):
+        """The histograms are stored as DenseArrays if at least densethreshold of the N_nosel bins are filled
+        (densethreshold=None always uses sparse storage). The dense histograms and the oscillation probabilities
+        are stored with dtype, the prediction is always calculated in float64."""
         self._parnames = parnames
         self._shape = N_sel.array().shape()
         self._eff = N_sel.array() / N_nosel.array()
         self._N_sel = N_sel.array()
         self.N_nosel = N_nosel.array()
+        if choose_storage(self.N_nosel, densethreshold) is not self.N_nosel:
+            self._eff = self._eff.todense(dtype=dtype)
+            self._N_sel = self._N_sel.todense(dtype=dtype)
+            self.N_nosel = self.N_nosel.todense(dtype=dtype)
         self._obs = obs
         self._flav_dimension = flavdim
         self._enu_dimension = enudim
@@ -114,15 +164,15 @@ cdef class BinnedModelWithOscillation:
         self._det_dimension = detdim
         self._otherflav = [1,0,3,2]
         enubinning = N_sel.binning()[enudim]
-        self._prob = ProbabilityCache(parnames, enubinning, detdist, probabilitycalc=probabilitycalc, oscparmode=oscparmode)
+        self._prob = ProbabilityCache(parnames, enubinning, detdist, probabilitycalc=probabilitycalc, oscparmode=oscparmode, dtype=dtype)
         if flux_weights is None:
-            flux_weights = lambda x: _identity(self._shape)
+            flux_weights = _IdentityWeights(self._shape)
         self._flux_weights = flux_weights
         if xsec_weights is None:
-            xsec_weights = lambda x: _identity(self._shape)
+            xsec_weights = _IdentityWeights(self._shape)
         self._xsec_weights = xsec_weights
         if det_weights is None:
-            det_weights = lambda x: _identity(self._shape)
+            det_weights = _IdentityWeights(self._shape)
         self._det_weights = det_weights
         self._osc_flux_weights = OscFluxWeights(N_nosel, enudim, flavdim, detdim, self._prob)
         return
@@ -141,53 +191,75 @@ cdef class BinnedModelWithOscillation:
         #return r
 
     @cython.boundscheck(False)
-    cdef SparseArray _osc_flav_rotation(self, pars, SparseArray arr):
+    @cython.wraparound(False)
+    cdef _osc_flav_rotation(self, pars, arr):
         self._prob.update(pars)
-        cdef np.ndarray[double, ndim=4] posc = self._prob.array
-        cdef uint64_t ienu = self._enu_dimension
-        cdef uint64_t idet = self._det_dimension
-        cdef uint64_t iflav = self._flav_dimension
-        cdef vector[uint64_t] otherflav = self._otherflav
+        if isinstance(arr, DenseArray):
+            return _rotate_flavours_dense(arr, self._prob.probabilities(), self._enu_dimension, self._det_dimension, self._flav_dimension, self._otherflav)
+        cdef SparseArray sparr = arr
+        cdef double[:, :, :, :] posc = self._prob.probabilities()
         cdef SparseArray result = SparseArray(self._shape)
-        cdef Py_ssize_t enu, det, flav_i, flav_j;
-        cdef double pdis, papp;
-        cdef SparseArrayIterator it = arr._data.begin()
-        cdef SparseArrayIterator end = arr._data.end()
-        cdef uint64_t key
-        cdef double value, othervalue
-        cdef vector[uint64_t] index
-        while it != end:
-            key = dereference(it).first
-            index = arr.decodekey(key)
-            value = dereference(it).second
-        #for index, value in arr:
-            #determine oscillation probability
-            enu = index[ienu]
-            if idet == NO_DET_DIM:
-                det = 0
-            else:
-                det = index[idet]
-            flav_j = index[iflav]
-            flav_i = otherflav[flav_j]
-            #pdis = posc[enu][det][flav_j][flav_j]
-            pdis = posc[enu, det, flav_j, flav_j]
-            papp = posc[enu, det, flav_i, flav_j]
-            #get N_otherflav
-            index[iflav] = flav_i 
-            othervalue = arr.get(index)
-            index[iflav] = flav_j # reset index
-            nosc = (pdis * value) + (papp * othervalue)
-            result.set(index, nosc)
-            #increment iterator
-            preincrement(it)
+        with nogil:
+            _rotate_flavours(sparr, result, posc, self._enu_dimension, self._det_dimension, self._flav_dimension, self._otherflav)
         return result
 
     def observable(self, pars):
         return self.eval(pars).project(self._obs)
 
+    def jacobian(self, pars):
+        return self.observable_and_jacobian(pars)[1]
+
+    def observable_and_jacobian(self, pars):
+        """Returns the flattened observable rate vector and its derivatives with respect to each parameter, [nbins, npars].
+        The derivatives are exact except for the oscillation parameters and the parameters of weights without
+        derivatives(pars), which use central differences."""
+        pars = np.asarray(pars, dtype=float)
+        det = self._det_weights(pars)
+        xsec = self._xsec_weights(pars)
+        flux = self._flux_weights(pars)
+        sel = self._eff * self._osc_flav_rotation(pars, flux * self.N_nosel)
+        obs = (det * (xsec * sel)).project(self._obs).flatten()
+        jac = np.zeros((len(obs), len(pars)), dtype=float)
+        #each parameter only enters one of the weights, so its derivative multiplies the product of the other factors,
+        #the flavour rotation is linear in the flux
+        derivatives = _weight_derivatives(self._flux_weights, pars, self._parnames)
+        if derivatives:
+            noflux = det * (xsec * self._eff)
+            for parindex, d in derivatives:
+                jac[:, parindex] += (noflux * self._osc_flav_rotation(pars, d * self.N_nosel)).project(self._obs).flatten()
+        derivatives = _weight_derivatives(self._xsec_weights, pars, self._parnames)
+        if derivatives:
+            _add_weight_jacobian(jac, derivatives, det * sel, self._obs)
+        derivatives = _weight_derivatives(self._det_weights, pars, self._parnames)
+        if derivatives:
+            _add_weight_jacobian(jac, derivatives, xsec * sel, self._obs)
+        for parindex, p in enumerate(self._parnames):
+            if p in _OSC_PARAMETER_NAMES:
+                h = _numerical_step(pars[parindex])
+                up = np.copy(pars)
+                up[parindex] += h
+                down = np.copy(pars)
+                down[parindex] -= h
+                jac[:, parindex] = (self.observable(up).flatten() - self.observable(down).flatten()) / (2.0 * h)
+        return obs, jac
+
     def parameter_names(self):
         return self._parnames
 
+    def __reduce__(self):
+        return (_restore_binnedmodelwithoscillation, (self._parnames, list(self._shape), self._N_sel, self._eff, self.N_nosel, list(self._obs),
+                                                       self._enu_dimension, self._flav_dimension, self._det_dimension, list(self._otherflav), self._prob,
+                                                       self._flux_weights, self._xsec_weights, self._det_weights, self._osc_flux_weights))
+
+    def save(self, path):
+        """Writes the model, ready to evaluate, to path (see simplot.binnedmodel.serialize)."""
+        save_model(self, path)
+        return
+
+    @classmethod
+    def load(cls, path, mmap=False, probabilitycalc=None):
+        return load_model(path, mmap=mmap, probabilitycalc=probabilitycalc, expected=cls)
+
     def __str__(self):
         sio = StringIO.StringIO()
         print >>sio, "BinnedModelWithOscillationModel(%s pars, %.2e bins, %.2e max bins)" % (len(self._parnames), len(self.N_nosel), self.N_nosel.max_size())
@@ -283,7 +355,8 @@ cdef class ProbabilityCache:
     cdef double _previous_ldm;
     cdef np.ndarray _flav_map;
 
-    def __init__(self, parnames, enubinning, detdist, probabilitycalc=None, oscparmode=OscParMode.SINSQTHETA):
+    def __init__(self, parnames, enubinning, detdist, probabilitycalc=None, oscparmode=OscParMode.SINSQTHETA, dtype=np.float64):
+        """The probabilities are calculated in float64 and stored in array with dtype."""
         self._flav_map = np.array([#appearance
                                                               (0, 0, 2, 2, 1),
                                                               (1, 1, 1, 1, 1),
@@ -312,13 +385,21 @@ cdef class ProbabilityCache:
         self._detdist = np.array(detdist, dtype=np.intc)
         enudim = len(enubinning) - 1
         detdim = len(detdist)
-        self.array = np.ones(shape=(enudim, detdim, 4, 4), dtype=float)
+        self.array = np.ones(shape=(enudim, detdim, 4, 4), dtype=dtype)
         for enubin, detbin, flav_i, flav_j in itertools.product(xrange(enudim), xrange(detdim), xrange(4), xrange(4)):
             if flav_i == flav_j:
                 self.array[enubin, detbin, flav_i, flav_j] = 1.0
             else:
                 self.array[enubin, detbin, flav_i, flav_j] = 0.0
 
+    def __reduce__(self):
+        state = (self._enuarray, self._prob, self._detdist, self.array,
+                 (self._theta12, self._theta23, self._theta13, self._deltacp, self._sdm, self._ldm),
+                 self._oscparmode,
+                 (self._previous_theta12, self._previous_theta23, self._previous_theta13, self._previous_deltacp, self._previous_sdm, self._previous_ldm),
+                 self._flav_map)
+        return (_restore_probabilitycache, state)
+
     def _parse_parameter_names(self, parnames):
         theta12 = None
         theta23 = None
@@ -368,6 +449,10 @@ cdef class ProbabilityCache:
     def update(self, np.ndarray[double, ndim=1] pars):
         return self._update(pars)
 
+    def probabilities(self):
+        """Returns the cached probabilities as float64, array itself if it is stored in float64."""
+        return np.asarray(self.array, dtype=np.float64)
+
     cdef _update(self, np.ndarray[double, ndim=1] pars):
         cdef double theta12, theta23, theta13, deltacp, sdm, ldm
         cdef int oscparmode
@@ -396,7 +481,8 @@ cdef class ProbabilityCache:
         #get inputs
         prob = self._prob
         cdef np.ndarray[double, ndim=1] enuarray = self._enuarray;
-        cdef np.ndarray[double, ndim=4] array = self.array;
+        #calculated in float64 and copied to array if it is stored with another dtype
+        cdef np.ndarray[double, ndim=4] array = self.probabilities();
         cdef np.ndarray[int, ndim=2] flavmap = self._flav_map;
         cdef np.ndarray[int, ndim=1] detdistarray = self._detdist;
         #temporary variables
@@ -434,6 +520,8 @@ cdef class ProbabilityCache:
                     p = prob.getVacuumProbability(flav_init, flav_final, enu, cp)
                     #array[enubin][detbin][flav_i][flav_j] = p
                     array[enubin,detbin,flav_i,flav_j] = p
+        if array is not self.array:
+            self.array[...] = array
         return
 
 cdef double invsinsqtheta(double x):
@@ -508,6 +596,9 @@ cdef class OscFluxWeights:
             arr[index] = 1.0
         return
 
+    def __reduce__(self):
+        return (_restore_oscfluxweights, (self._weights, self._nominal, self._prob, self._sparse_weights, self._enudim, self._flavdim, self._detdim, self._otherflav))
+
     def __call__(self, pars):
         self._update_weights_array(pars)
         self._update_sparse_array()
@@ -519,7 +610,7 @@ cdef class OscFluxWeights:
         cdef np.ndarray[double, ndim=3] weights = self._weights
         cdef np.ndarray[uint64_t, ndim=1] otherflav = self._otherflav;
         self._prob.update(pars)
-        cdef np.ndarray[double, ndim=4] posc = self._prob.array
+        cdef np.ndarray[double, ndim=4] posc = self._prob.probabilities()
         cdef int numenubins = nominal.shape[0]
         cdef int numflavbins = nominal.shape[1]
         cdef int numdetbins = nominal.shape[2]
@@ -569,6 +660,172 @@ cdef class OscFluxWeights:
 
 ################################################################################
 
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void _rotate_flavours(SparseArray arr, SparseArray result, double[:, :, :, :] posc, uint64_t ienu, uint64_t idet, uint64_t iflav, vector[uint64_t]& otherflav) nogil:
+    #result[flav_j] = pdis * arr[flav_j] + papp * arr[flav_i] where flav_i is the other flavour of the same helicity
+    cdef SparseArrayIterator it = arr._data.begin()
+    cdef SparseArrayIterator end = arr._data.end()
+    cdef vector[uint64_t] index = vector[uint64_t](arr._shape.size())
+    cdef uint64_t key, otherkey, b, s, enu, det, flav_i, flav_j
+    cdef double pdis, papp, value, othervalue
+    cdef size_t i
+    while it != end:
+        key = dereference(it).first
+        value = dereference(it).second
+        otherkey = key
+        for i in xrange(arr._shape.size()):
+            s = arr._shape[i]
+            if s > 0:
+                b = otherkey % s
+                otherkey = otherkey / s
+            else:
+                b = 0
+            index[i] = b
+        #determine oscillation probability
+        enu = index[ienu]
+        if idet == NO_DET_DIM:
+            det = 0
+        else:
+            det = index[idet]
+        flav_j = index[iflav]
+        flav_i = otherflav[flav_j]
+        pdis = posc[enu, det, flav_j, flav_j]
+        papp = posc[enu, det, flav_i, flav_j]
+        #get N_otherflav
+        otherkey = key - flav_j * arr._dimscale[iflav] + flav_i * arr._dimscale[iflav]
+        othervalue = find_value(arr._data, otherkey)
+        result._data[key] = (pdis * value) + (papp * othervalue)
+        preincrement(it)
+    return
+
+def _rotate_flavours_dense(arr, posc, enudim, detdim, flavdim, otherflav):
+    """Equivalent to _rotate_flavours for a DenseArray."""
+    view = arr.view()
+    ndim = view.ndim
+    def axisindex(dim):
+        s = [1] * ndim
+        s[dim] = view.shape[dim]
+        return np.arange(view.shape[dim]).reshape(s)
+    otherflav = np.array(otherflav, dtype=int)
+    enu = axisindex(enudim)
+    det = 0 if detdim == NO_DET_DIM else axisindex(detdim)
+    flav = axisindex(flavdim)
+    result = DenseArray(arr.shape())
+    out = result.view()
+    np.multiply(posc[enu, det, flav, flav], view, out=out)
+    out += posc[enu, det, otherflav[flav], flav] * np.take(view, otherflav, axis=flavdim)
+    return result
+
+################################################################################
+
+def _restore_binnedmodel(parnames, N_sel, obs, flux_weights, xsec_weights, det_weights):
+    cdef BinnedModel model = BinnedModel.__new__(BinnedModel)
+    model._parnames = parnames
+    model._N_sel = N_sel
+    model._obs = obs
+    model._flux_weights = flux_weights
+    model._xsec_weights = xsec_weights
+    model._det_weights = det_weights
+    return model
+
+def _restore_binnedmodelwithoscillation(parnames, shape, N_sel, eff, N_nosel, obs, enudim, flavdim, detdim, otherflav, prob, flux_weights, xsec_weights, det_weights, osc_flux_weights):
+    cdef BinnedModelWithOscillation model = BinnedModelWithOscillation.__new__(BinnedModelWithOscillation)
+    model._parnames = parnames
+    model._shape = shape
+    model._N_sel = N_sel
+    model._eff = eff
+    model.N_nosel = N_nosel
+    model._obs = obs
+    model._enu_dimension = enudim
+    model._flav_dimension = flavdim
+    model._det_dimension = detdim
+    model._otherflav = otherflav
+    model._prob = prob
+    model._flux_weights = flux_weights
+    model._xsec_weights = xsec_weights
+    model._det_weights = det_weights
+    model._osc_flux_weights = osc_flux_weights
+    return model
+
+def _restore_probabilitycache(enuarray, prob, detdist, array, parindices, oscparmode, previous, flav_map):
+    cdef ProbabilityCache cache = ProbabilityCache.__new__(ProbabilityCache)
+    cache._enuarray = np.array(enuarray, dtype=float)
+    cache._prob = prob
+    cache._detdist = np.array(detdist, dtype=np.intc)
+    #the cache is updated in place so it must not be a read-only memory map
+    cache.array = np.array(array)
+    cache._theta12, cache._theta23, cache._theta13, cache._deltacp, cache._sdm, cache._ldm = parindices
+    cache._oscparmode = oscparmode
+    cache._previous_theta12, cache._previous_theta23, cache._previous_theta13, cache._previous_deltacp, cache._previous_sdm, cache._previous_ldm = previous
+    cache._flav_map = np.array(flav_map, dtype=np.intc)
+    return cache
+
+def _restore_oscfluxweights(weights, nominal, prob, sparse_weights, enudim, flavdim, detdim, otherflav):
+    cdef OscFluxWeights result = OscFluxWeights.__new__(OscFluxWeights)
+    result._weights = np.array(weights, dtype=float)
+    result._nominal = np.array(nominal, dtype=float)
+    result._prob = prob
+    result._sparse_weights = sparse_weights
+    result._enudim = enudim
+    result._flavdim = flavdim
+    result._detdim = detdim
+    result._otherflav = np.array(otherflav, dtype=np.uint64)
+    return result
+
+################################################################################
+
+class _IdentityWeights(object):
+    """Default weights, 1 everywhere and independent of the parameters."""
+    def __init__(self, shape):
+        self._shape = shape
+    def __call__(self, pars):
+        return _identity(self._shape)
+    def derivatives(self, pars):
+        return []
+
+def _weight_derivatives(weights, pars, parnames):
+    """Returns [(parameter index, derivative of the weights array)] for the parameters the weights depend on.
+    Weights without derivatives(pars) are differentiated with central differences in each parameter
+    that is not an oscillation parameter."""
+    derivatives = getattr(weights, "derivatives", None)
+    if derivatives is not None:
+        return derivatives(pars)
+    result = []
+    for parindex, p in enumerate(parnames):
+        if p in _OSC_PARAMETER_NAMES:
+            continue
+        h = _numerical_step(pars[parindex])
+        up = np.copy(pars)
+        up[parindex] += h
+        down = np.copy(pars)
+        down[parindex] -= h
+        #copied, the weights may refill the same array on each call
+        d = float(0.5 / h) * (weights(up).clone() - weights(down))
+        if np.any(d.toarrays()[1]):
+            result.append((parindex, d))
+    #weights that refill the same array are left at pars
+    weights(pars)
+    return result
+
+def _add_weight_jacobian(jac, derivatives, others, obs):
+    """Adds each weight derivative times others, the product of the other factors of the prediction, projected onto obs."""
+    for parindex, d in derivatives:
+        jac[:, parindex] += (d * others).project(obs).flatten()
+    return
+
+_OSC_PARAMETER_NAMES = frozenset(PdgNeutrinoOscillationParameters.ALL_PARS
+                                  + PdgNeutrinoOscillationParameters.ALL_PARS_SINSQ2
+                                  + PdgNeutrinoOscillationParameters.ALL_PARS_SINSQ)
+
+def _numerical_step(x):
+    if x == 0.0:
+        return 1e-6
+    return 1e-4 * abs(x)
+
+################################################################################
+
 def _scalar(n, shape):
     s = [0 for s in shape]
     arr = SparseArray(s)
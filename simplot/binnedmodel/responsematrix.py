@@ -0,0 +1,203 @@
+"""Oscillation model stored as response matrices from true neutrino bins to observable bins.
+
+The true bins are (true energy, flavour, detector/beam mode). Each observable bin is a sum over true bins
+of the (flux weight x oscillation probability) of that true bin times a fixed response. The model is
+evaluated with a single dense (BLAS) or CSR matrix-vector product instead of iterating over the full histogram.
+"""
+
+import numpy as np
+import scipy.sparse
+
+from simplot.mc.statistics import safedivide
+from simplot.binnedmodel.model import ProbabilityCache, OscParMode, _weight_derivatives, _numerical_step, _OSC_PARAMETER_NAMES
+from simplot.binnedmodel.serialize import save_model, load_model
+
+################################################################################
+
+_OTHER_FLAV = np.array([1, 0, 3, 2], dtype=int)
+
+################################################################################
+
+class ResponseMatrixModelWithOscillation(object):
+    def __init__(self, parnames, N_sel, N_nosel, obs, enudim, flavdim, detdim, detdist, flux_weights=None, xsec_weights=None, det_weights=None, probabilitycalc=None, oscparmode=OscParMode.SINSQTHETA, sparse=None, dtype=np.float64):
+        """Equivalent to BinnedModelWithOscillation for models with flux weights only.
+        The flux weights must only depend on the true energy, flavour and detector dimensions.
+        If sparse is None a CSR matrix is used when less than a quarter of the response matrix is filled,
+        otherwise a dense matrix is used.
+        The matrix and the oscillation probabilities are stored with dtype, the prediction is always accumulated in float64.
+        """
+        if xsec_weights is not None or det_weights is not None:
+            raise ValueError("ResponseMatrixModelWithOscillation only supports flux weights, use BinnedModelWithOscillation for cross section or detector systematics.")
+        self._parnames = parnames
+        self._flux_weights = flux_weights
+        self._prob = ProbabilityCache(parnames, N_sel.binning()[enudim], detdist, probabilitycalc=probabilitycalc, oscparmode=oscparmode, dtype=dtype)
+        shape = list(N_nosel.array().shape())
+        self._truedims = [enudim, flavdim]
+        if detdim is not None:
+            self._truedims.append(detdim)
+        self._trueshape = [shape[d] for d in self._truedims]
+        self._buildtruebins(flavdim)
+        self._matrix = self._buildmatrix(N_sel, N_nosel, shape, obs, flavdim, sparse).astype(dtype)
+        self._vector = np.zeros(self._matrix.shape[1], dtype=float)
+        self._fluxshape = None
+        self._fluxkeys = None
+        return
+
+    def _buildtruebins(self, flavdim):
+        ntrue = int(np.prod(self._trueshape))
+        index = np.unravel_index(np.arange(ntrue), self._trueshape, order="F")
+        self._trueindex = index
+        self._enu = index[0]
+        self._flav = index[1]
+        self._other = _OTHER_FLAV[self._flav]
+        if len(index) > 2:
+            self._det = index[2]
+        else:
+            self._det = np.zeros(ntrue, dtype=int)
+        #true bin with the same energy and detector and the other flavour of the same helicity
+        otherindex = list(index)
+        otherindex[1] = self._other
+        self._othertrue = np.ravel_multi_index(otherindex, self._trueshape, order="F")
+        return
+
+    def _buildmatrix(self, N_sel, N_nosel, shape, obs, flavdim, sparse):
+        keys, nosel = N_nosel.array().toarrays(sort=True)
+        index = _decodekeys(keys, shape)
+        selkeys, selvalues = N_sel.array().toarrays(sort=True)
+        sel = _lookup(selkeys, selvalues, keys)
+        eff = safedivide(sel, nosel)
+        #number of unselected events in the bin with the other flavour
+        otherindex = list(index)
+        otherindex[flavdim] = _OTHER_FLAV[index[flavdim]]
+        othernosel = _lookup(keys, nosel, _encodekeys(otherindex, shape))
+        #rows are observable bins in the order of SparseArray.project(obs).flatten()
+        rows = _encodekeys([index[d] for d in obs], [shape[d] for d in obs])
+        cols = _encodekeys([index[d] for d in self._truedims], self._trueshape)
+        nobs = int(np.prod([shape[d] for d in obs]))
+        ntrue = int(np.prod(self._trueshape))
+        matrix = scipy.sparse.coo_matrix((np.concatenate([eff * nosel, eff * othernosel]),
+                                          (np.concatenate([rows, rows]), np.concatenate([cols, cols + ntrue]))),
+                                         shape=(nobs, 2 * ntrue)).tocsr()
+        if sparse is None:
+            sparse = matrix.nnz < 0.25 * nobs * 2 * ntrue
+        if not sparse:
+            matrix = matrix.toarray()
+        return matrix
+
+    def __call__(self, pars):
+        return self.observable(pars)
+
+    def observable(self, pars):
+        pars = np.asarray(pars, dtype=float)
+        self._prob.update(pars)
+        return self._product(self._truevector(self._fluxweights(pars)))
+
+    def jacobian(self, pars):
+        return self.observable_and_jacobian(pars)[1]
+
+    def observable_and_jacobian(self, pars):
+        """Returns the observable rate vector and its derivatives with respect to each parameter, [nbins, npars].
+        The derivatives are exact except for the oscillation parameters and the parameters of flux weights without
+        derivatives(pars), which use central differences."""
+        pars = np.asarray(pars, dtype=float)
+        obs = self.observable(pars)
+        jac = np.zeros((len(obs), len(pars)), dtype=float)
+        if self._flux_weights is not None:
+            #the prediction is linear in the flux weights
+            for parindex, d in _weight_derivatives(self._flux_weights, pars, self._parnames):
+                jac[:, parindex] += self._product(self._truevector(self._flatfluxweights(d)))
+        for parindex, p in enumerate(self._parnames):
+            if p in _OSC_PARAMETER_NAMES:
+                h = _numerical_step(pars[parindex])
+                up = np.copy(pars)
+                up[parindex] += h
+                down = np.copy(pars)
+                down[parindex] -= h
+                jac[:, parindex] = (self.observable(up) - self.observable(down)) / (2.0 * h)
+        return obs, jac
+
+    def _truevector(self, weights):
+        """Fills the true bin vector from the current oscillation probabilities and flux weights of each true bin."""
+        posc = self._prob.probabilities()
+        ntrue = len(self._enu)
+        v = self._vector
+        v[:ntrue] = posc[self._enu, self._det, self._flav, self._flav] * weights
+        v[ntrue:] = posc[self._enu, self._det, self._other, self._flav] * weights[self._othertrue]
+        return v
+
+    def _product(self, v):
+        if self._matrix.dtype == np.float64:
+            return self._matrix.dot(v)
+        if scipy.sparse.issparse(self._matrix):
+            #sum the products of each row in float64, padded so that empty trailing rows are valid indices
+            m = self._matrix
+            products = np.zeros(m.nnz + 1, dtype=np.float64)
+            np.multiply(m.data, v[m.indices], out=products[:-1])
+            result = np.add.reduceat(products, m.indptr[:-1])
+            result[m.indptr[:-1] == m.indptr[1:]] = 0.0
+            return result
+        return np.einsum("ij,j->i", self._matrix, v, dtype=np.float64)
+
+    def _fluxweights(self, pars):
+        if self._flux_weights is None:
+            return np.ones(len(self._enu), dtype=float)
+        return self._flatfluxweights(self._flux_weights(pars))
+
+    def _flatfluxweights(self, arr):
+        if self._fluxshape != list(arr.shape()):
+            self._fluxkeys = self._buildfluxkeys(list(arr.shape()))
+            self._fluxshape = list(arr.shape())
+        return arr.flatten()[self._fluxkeys]
+
+    def _buildfluxkeys(self, fluxshape):
+        for d, s in enumerate(fluxshape):
+            if s > 0 and d not in self._truedims:
+                raise ValueError("ResponseMatrixModelWithOscillation flux weights depend on a dimension that is not a true bin dimension", d, fluxshape)
+        dims = sorted(d for d in self._truedims if fluxshape[d] > 0)
+        return _encodekeys([self._trueindex[self._truedims.index(d)] for d in dims], [fluxshape[d] for d in dims])
+
+    @property
+    def matrix(self):
+        return self._matrix
+
+    def parameter_names(self):
+        return self._parnames
+
+    def save(self, path):
+        """Writes the model, ready to evaluate, to path (see simplot.binnedmodel.serialize)."""
+        save_model(self, path)
+        return
+
+    @classmethod
+    def load(cls, path, mmap=False, probabilitycalc=None):
+        return load_model(path, mmap=mmap, probabilitycalc=probabilitycalc, expected=cls)
+
+################################################################################
+
+def _decodekeys(keys, shape):
+    """Returns the per-dimension bin indices of SparseArray keys."""
+    keys = np.asarray(keys, dtype=np.int64)
+    index = []
+    for s in shape:
+        index.append(keys % s)
+        keys = keys // s
+    return index
+
+def _encodekeys(index, shape):
+    """Inverse of _decodekeys."""
+    keys = np.zeros(len(index[0]) if index else 1, dtype=np.int64)
+    scale = 1
+    for i, s in zip(index, shape):
+        keys += np.asarray(i, dtype=np.int64) * scale
+        scale *= s
+    return keys
+
+def _lookup(keys, values, find):
+    """Returns values[keys == find] or 0 if find is not in keys (which must be sorted)."""
+    if len(keys) == 0:
+        return np.zeros(len(find), dtype=float)
+    keys = np.asarray(keys, dtype=np.int64)
+    pos = np.clip(np.searchsorted(keys, find), 0, len(keys) - 1)
+    return np.where(keys[pos] == find, values[pos], 0.0)
+
+################################################################################
@@ -1,13 +1,16 @@
-import itertools
+from multiprocessing.pool import ThreadPool
 
 from simplot.pdg import PdgNeutrinoOscillationParameters
-from simplot.cache import cache
-from simplot.mc.montecarlo import MonteCarloParameterMismatch
+from simplot.cache import cache, file_identity, provenance_hash
+from simplot.parallel import parallel_map, numprocesses
+from simplot.mc.montecarlo import MonteCarloParameterMismatch, evaluate_batch
 import simplot.sparsehist.sparsehist
-from simplot.sparsehist import SparseHistogram
+from simplot.sparsehist import SparseHistogram, DENSE_OCCUPANCY_THRESHOLD
 from simplot.binnedmodel.model import BinnedModel as _BinnedModel
 from simplot.binnedmodel.model import OscParMode
 from simplot.binnedmodel.model import BinnedModelWithOscillation as _BinnedModelWithOscillation
+from simplot.binnedmodel.responsematrix import ResponseMatrixModelWithOscillation
+from simplot.binnedmodel.serialize import save_model, load_model
 
 import numpy as np
 
@@ -16,13 +19,87 @@ import numpy as np
 class Sample(object):
     def __init__(self, parameter_names):
         self.parameter_names = parameter_names
-    def __call__(self, x):
+    def __call__(self, x, out=None):
+        """Returns the rate vector. If out is given the result is written into it."""
         raise NotImplementedError("ERROR: child class should override __call__.")
 
+    def save(self, path):
+        """Writes the built sample to path so it can be evaluated without rebuilding it (see load)."""
+        save_model(self, path)
+        return
+
+    @classmethod
+    def load(cls, path, mmap=False, probabilitycalc=None):
+        """Reads a sample written by save.
+        If mmap is True the arrays are memory-mapped copy-on-write so processes loading the same file share memory.
+        Probability calculators are not saved, they are replaced by probabilitycalc or a new Prob3++ calculator.
+        """
+        return load_model(path, mmap=mmap, probabilitycalc=probabilitycalc, expected=cls)
+
+################################################################################
+
+class PartitionedData(object):
+    """Input data for a BinnedSample split into independent partitions (for example one per input file).
+
+    Each partition is either a dict of columns, an iterable of event tuples or a callable, 
+    taking no arguments, that returns one of these. 
+    The partitions are filled in nprocesses worker processes and the partial histograms are merged in 
+    partition order, so the result does not depend on the number of processes. Each bin is summed per partition, 
+    so it agrees with a fill of all the events in one pass up to floating point rounding, not bit for bit.
+    """
+    def __init__(self, partitions, nprocesses=None):
+        self.partitions = list(partitions)
+        self.nprocesses = nprocesses
+
+    @property
+    def filelist(self):
+        #partitions that are callables are not called here, their files are unknown
+        files = [getattr(p, "filelist", None) for p in self.partitions]
+        if all(f is None for f in files):
+            return None
+        return [fname for f in files if f is not None for fname in f]
+
+################################################################################
+
+class ChunkedData(object):
+    """Input data for a BinnedSample read in blocks of events, for example from simplot.rootplot.ntuple.TreeChunkReader.
+
+    chunks is an iterable of blocks. If columns is given it is called on each block and must return a dict of columns 
+    (see BinnedSample._fillcolumns), otherwise the blocks must already be dicts of columns.
+    The blocks are filled into the histograms one at a time so only one block is held in memory.
+    """
+    def __init__(self, chunks, columns=None):
+        self.chunks = chunks
+        self.columns = columns
+
+    @property
+    def filelist(self):
+        return getattr(self.chunks, "filelist", None)
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            if self.columns is not None:
+                chunk = self.columns(chunk)
+            yield chunk
+        return
+
 ################################################################################
 
 class BinnedSample(Sample):
-    def __init__(self, name, binning, observables, data, cache_name=None, systematics=None, cache_dir=None):
+    def __init__(self, name, binning, observables, data, cache_name=None, systematics=None, cache_dir=None, cache_files=None, cache_digest=False, densethreshold=DENSE_OCCUPANCY_THRESHOLD, dtype=np.float64):
+        """If cache_name is given the filled histograms are cached on disk.
+        The cache key is built from cache_name, the binning, observables, systematics and the identity 
+        (path, size, modification time and, if cache_digest is True, an md5 of the contents) of the input files.
+        The input files are cache_files or, if that is not given, data.filelist if it exists 
+        (ChunkedData over a reader with a filelist, such as TreeChunkReader, or PartitionedData of these).
+        Inputs that are not files, for example arrays, generators or callable partitions, are not part of the key:
+        pass their source files as cache_files or change cache_name when they change.
+        The model uses dense storage if at least densethreshold of the histogram bins are filled (None for always sparse).
+        The dense histograms of the model are stored with dtype, for example np.float32 with densethreshold=0.0 to halve
+        the memory of the model (the spline knots are stored with the dtype of SplineSystematics).
+        """
+        self._densethreshold = densethreshold
+        self._dtype = dtype
         parameter_names = self._build_parameter_names(systematics)
         super(BinnedSample, self).__init__(parameter_names)
         self.name = name
@@ -34,7 +111,7 @@ class BinnedSample(Sample):
         if cache_name:
             if cache_dir is None:
                 cache_dir = "/tmp/cache-binned-sample/"
-            data = cache(cache_name, func, tmpdir=cache_dir)
+            data = cache(self._cachekey(cache_name, data, systematics, cache_files, cache_digest), func, tmpdir=cache_dir)
         else:
             data = func()
         self._model, self.N_sel, self.N_nosel = self._buildmodel(systematics, data, observables)
@@ -45,6 +122,21 @@ class BinnedSample(Sample):
             parameter_names += systematics.parameter_names
         return parameter_names
 
+    def _cachekey(self, cache_name, data, systematics, cache_files, cache_digest):
+        if cache_files is None:
+            cache_files = getattr(data, "filelist", None)
+        files = []
+        if cache_files is not None:
+            files = [file_identity(f, digest=cache_digest) for f in cache_files]
+        provenance = (type(self).__name__, 
+                      self.axisnames, 
+                      self.binedges, 
+                      list(self.observables), 
+                      systematics.provenance() if systematics else None, 
+                      files,
+        )
+        return "_".join((cache_name, provenance_hash(*provenance)))
+
     def _buildmodel(self, systematics, data, observables):
         hist, systhist = data
         observabledim = [self.axisnames.index(p) for p in observables]
@@ -53,22 +145,57 @@ class BinnedSample(Sample):
         det_weights, xsec_weights, flux_weights = None, None, None
         if systematics:
             det_weights, xsec_weights, flux_weights = systematics(self.parameter_names, systhist, hist)
-        return _BinnedModel(self.parameter_names, hist, observabledim, det_weights=det_weights, xsec_weights=xsec_weights, flux_weights=flux_weights), hist, None
+        return _BinnedModel(self.parameter_names, hist, observabledim, det_weights=det_weights, xsec_weights=xsec_weights, flux_weights=flux_weights, densethreshold=self._densethreshold, dtype=self._dtype), hist, None
+
+    def __call__(self, x, out=None):
+        """Returns the rate vector. If out is given the result is written into it."""
+        if len(x) != len(self.parameter_names):
+            raise ValueError("Sample called with wrong number of parameters")
+        vec = self._model.observable(x).flatten()
+        if out is None:
+            return vec
+        out[:] = vec
+        return out
 
-    def __call__(self, x):
+    def eval_and_jacobian(self, x):
+        """Returns the rate vector and its derivatives with respect to each parameter, [nbins, npars]."""
         if len(x) != len(self.parameter_names):
             raise ValueError("Sample called with wrong number of parameters")
-        return self._model.observable(x).flatten()
+        return self._model.observable_and_jacobian(x)
+
+    def jacobian(self, x):
+        return self.eval_and_jacobian(x)[1]
 
     def array(self, x):
         return self._model(x)
 
+    def _loadpartitions(self, data, systematics):
+        def loadpartition(partition):
+            if callable(partition):
+                partition = partition()
+            return self._loaddata(partition, systematics)
+        partials = parallel_map(loadpartition, data.partitions, nprocesses=data.nprocesses)
+        #merge into empty histograms in partition order so that single and multi-process results are identical
+        result = self._loaddata([], systematics)
+        for p in partials:
+            _mergehistograms(result, p)
+        return result
+
     def _loaddata(self, data, systematics):
+        if isinstance(data, PartitionedData):
+            return self._loadpartitions(data, systematics)
         hist = SparseHistogram(self.binedges)
         if systematics:
             systhist = [[SparseHistogram(self.binedges) for val in values] for syst, values in systematics.spline_parameter_values]
         else:
             systhist = []
+        if isinstance(data, dict):
+            self._fillcolumns(data, hist, systhist)
+            return hist, systhist
+        if isinstance(data, ChunkedData):
+            for columns in data:
+                self._fillcolumns(columns, hist, systhist)
+            return hist, systhist
         for coord, selweight, systweight in data:
             hist.fill(coord, selweight)
             for isyst in xrange(len(systhist)):
@@ -76,10 +203,27 @@ class BinnedSample(Sample):
                     systhist[isyst][ival].fill(coord, selweight * systweight[isyst][ival])
         return hist, systhist
 
+    def _fillcolumns(self, data, hist, systhist):
+        coord = _coordinatecolumns(data, self.axisnames)
+        selweight = _weightcolumn(data, "selweight", len(coord))
+        keys = _BinKeys(hist, coord)
+        keys.fill(hist, selweight)
+        for isyst in xrange(len(systhist)):
+            for ival in xrange(len(systhist[isyst])):
+                keys.fill(systhist[isyst][ival], selweight * _systweightcolumn(data, isyst, ival))
+        return
+
 ################################################################################
 
 class BinnedSampleWithOscillation(BinnedSample):
-    def __init__(self, name, binning, observables, data, enuaxis, flavaxis, distance, beammodeaxis=None, cache_name=None, systematics=None, probabilitycalc=None, oscparmode=OscParMode.SINSQTHETA, cache_dir=None):
+    def __init__(self, name, binning, observables, data, enuaxis, flavaxis, distance, beammodeaxis=None, cache_name=None, systematics=None, probabilitycalc=None, oscparmode=OscParMode.SINSQTHETA, cache_dir=None, cache_files=None, cache_digest=False, responsematrix=False, densethreshold=DENSE_OCCUPANCY_THRESHOLD, dtype=np.float64):
+        """If responsematrix is True the model is stored as a matrix from true (energy, flavour, beam mode) bins
+        to observable bins (see ResponseMatrixModelWithOscillation). This only supports flux systematics,
+        a ValueError is raised before the data are read if systematics has spline parameters.
+        """
+        if responsematrix and systematics is not None and systematics.spline_parameter_values:
+            raise ValueError("BinnedSampleWithOscillation with responsematrix=True only supports flux systematics.", [s for s, _ in systematics.spline_parameter_values])
+        self._responsematrix = responsematrix
         self._enu_axis_name = enuaxis
         self._flav_axis_name = flavaxis
         self._beam_mode_axis = beammodeaxis
@@ -93,6 +237,10 @@ class BinnedSampleWithOscillation(BinnedSample):
                                                           cache_name=cache_name,
                                                           systematics=systematics,
                                                           cache_dir=cache_dir,
+                                                          cache_files=cache_files,
+                                                          cache_digest=cache_digest,
+                                                          densethreshold=densethreshold,
+                                                          dtype=dtype,
         )
 
     def _build_parameter_names(self, systematics):
@@ -125,9 +273,17 @@ class BinnedSampleWithOscillation(BinnedSample):
             import simplot.rootprob3pp.lib
             import ROOT
             probabilitycalc = ROOT.crootprob3pp.Probability()
-        return _BinnedModelWithOscillation(self.parameter_names, selhist, noselhist, observabledim, enudim, flavdim, beammodedim, distance, det_weights=det_weights, xsec_weights=xsec_weights, flux_weights=flux_weights, probabilitycalc=probabilitycalc, oscparmode=self._oscparmode), selhist, noselhist
+        kwargs = dict(det_weights=det_weights, xsec_weights=xsec_weights, flux_weights=flux_weights, probabilitycalc=probabilitycalc, oscparmode=self._oscparmode, dtype=self._dtype)
+        if self._responsematrix:
+            model = ResponseMatrixModelWithOscillation
+        else:
+            model = _BinnedModelWithOscillation
+            kwargs["densethreshold"] = self._densethreshold
+        return model(self.parameter_names, selhist, noselhist, observabledim, enudim, flavdim, beammodedim, distance, **kwargs), selhist, noselhist
 
     def _loaddata(self, data, systematics):
+        if isinstance(data, PartitionedData):
+            return self._loadpartitions(data, systematics)
         selhist = SparseHistogram(self.binedges)
         noselhist = SparseHistogram(self.binedges)
         if systematics:
@@ -136,6 +292,13 @@ class BinnedSampleWithOscillation(BinnedSample):
         else:
             selsysthist = []
             noselsysthist = []
+        if isinstance(data, dict):
+            self._fillcolumns(data, selhist, noselhist, selsysthist, noselsysthist)
+            return selhist, noselhist, selsysthist, noselsysthist
+        if isinstance(data, ChunkedData):
+            for columns in data:
+                self._fillcolumns(columns, selhist, noselhist, selsysthist, noselsysthist)
+            return selhist, noselhist, selsysthist, noselsysthist
         for coord, selweight, noselweight, systweight in data:
             if selweight != 0:
                 selhist.fill(coord, selweight)
@@ -147,32 +310,205 @@ class BinnedSampleWithOscillation(BinnedSample):
                     noselsysthist[isyst][ival].fill(coord, noselweight * systweight[isyst][ival])
         return selhist, noselhist, selsysthist, noselsysthist
 
+    def _fillcolumns(self, data, selhist, noselhist, selsysthist, noselsysthist):
+        coord = _coordinatecolumns(data, self.axisnames)
+        selweight = _weightcolumn(data, "selweight", len(coord))
+        noselweight = _weightcolumn(data, "noselweight", len(coord))
+        #as in the event loop, events with zero selected weight do not create selected bins
+        selkeys = _BinKeys(selhist, coord, mask=(selweight != 0))
+        noselkeys = _BinKeys(noselhist, coord)
+        selkeys.fill(selhist, selweight)
+        noselkeys.fill(noselhist, noselweight)
+        for isyst in xrange(len(selsysthist)):
+            for ival in xrange(len(selsysthist[isyst])):
+                systweight = _systweightcolumn(data, isyst, ival)
+                selkeys.fill(selsysthist[isyst][ival], selweight * systweight)
+                noselkeys.fill(noselsysthist[isyst][ival], noselweight * systweight)
+        return
+
+################################################################################
+
+class _BinKeys(object):
+    """Bin keys of a block of events.
+    The keys are computed once and shared by all histograms with the same binning, 
+    each histogram is then filled with a single bincount over the unique keys."""
+    def __init__(self, hist, coord, mask=None):
+        keys = hist.find_keys(coord)
+        if mask is not None:
+            keys = keys[mask]
+        self._mask = mask
+        self._keys, self._inverse = np.unique(keys, return_inverse=True)
+
+    def fill(self, hist, weights):
+        if self._mask is not None:
+            weights = weights[self._mask]
+        sumw = np.bincount(self._inverse, weights=weights, minlength=len(self._keys))
+        hist.fill_keys(self._keys, sumw)
+        return
+
+def _mergehistograms(lhs, rhs):
+    """Adds the histograms in rhs to lhs, where both are (nested) sequences of histograms."""
+    if isinstance(lhs, SparseHistogram):
+        lhs.merge(rhs)
+    else:
+        for l, r in zip(lhs, rhs):
+            _mergehistograms(l, r)
+    return lhs
+
+def _coordinatecolumns(data, axisnames):
+    """Returns the event coordinates as an [N, ndim] array. 
+    data["coord"] is either an [N, ndim] array or a dict mapping axis names to [N] arrays."""
+    coord = data["coord"]
+    if isinstance(coord, dict):
+        coord = np.column_stack([np.asarray(coord[name], dtype=float) for name in axisnames])
+    coord = np.asarray(coord, dtype=float)
+    if coord.ndim != 2 or coord.shape[1] != len(axisnames):
+        raise ValueError("columnar data has coordinates with the wrong shape", coord.shape, axisnames)
+    return coord
+
+def _weightcolumn(data, name, N):
+    w = np.asarray(data[name], dtype=float)
+    if w.ndim == 0:
+        w = np.repeat(w, N)
+    if w.shape != (N,):
+        raise ValueError("columnar data has weight column with the wrong shape", name, w.shape, N)
+    return w
+
+def _systweightcolumn(data, isyst, ival):
+    """data["systweight"] is either an [N, nsyst, nknots] array or a list of [N, nknots] arrays (one per systematic)."""
+    systweight = data["systweight"]
+    if isinstance(systweight, np.ndarray) and systweight.ndim == 3:
+        return systweight[:, isyst, ival]
+    return np.asarray(systweight[isyst], dtype=float)[:, ival]
+
+################################################################################
+
+def _shares_probability_calculator(samples):
+    calculators = [id(s._probabilitycalc) for s in samples if getattr(s, "_probabilitycalc", None) is not None]
+    return len(calculators) != len(set(calculators))
+
 ################################################################################
 
 class CombinedBinnedSample(Sample):
-    def __init__(self, samples, parameter_order=None, ignoreerrors=False):
+    def __init__(self, samples, parameter_order=None, ignoreerrors=False, nthreads=1):
+        """By default the samples are evaluated one after another in the calling thread.
+        If nthreads is greater than 1 (or None for one per core) the samples are evaluated concurrently in a thread pool,
+        at most one thread per sample. Only the parts of the model evaluation that release the GIL run in parallel,
+        the oscillation probability update does not, so threads mostly help samples without oscillation.
+        Probability calculators are not thread safe, so a ValueError is raised if threaded samples share one.
+        Call close() to stop the threads.
+        Each sample writes its rate vector into its part of a result array that is reused by every call,
+        so the returned array is overwritten by the next call unless out is given.
+        """
         self._samples = samples
         parameter_names, mapping = self._determine_parameter_mapping(samples, parameter_order=parameter_order, ignoreerrors=ignoreerrors)
         self._par_map = mapping
+        self._nthreads = min(numprocesses(nthreads), max(len(samples), 1))
+        if self._nthreads > 1 and _shares_probability_calculator(samples):
+            raise ValueError("CombinedBinnedSample samples that share a probability calculator must be evaluated with nthreads=1")
+        self._pool = None
+        self._slices = None
+        self._result = None
         super(CombinedBinnedSample, self).__init__(parameter_names)
 
     def sample_parameters(self, pars, samplenum):
         return self._get_args(pars, samplenum)
 
-    def eval_sample(self, pars, samplenum):
-        return self._samples[samplenum](self._get_args(pars, samplenum))
+    def eval_sample(self, pars, samplenum, out=None):
+        return self._samples[samplenum](self._get_args(pars, samplenum), out=out)
 
     def array_sample(self, pars, samplenum):
         return self._samples[samplenum].array(self._get_args(pars, samplenum))
 
-    def __call__(self, x):
+    def __call__(self, x, out=None):
+        """Returns the rate vector. If out is given the result is written into it."""
         if len(x) != len(self.parameter_names):
             raise ValueError("Sample called with wrong number of parameters")
-        return np.concatenate([s(self._get_args(x, i)) for i, s in enumerate(self._samples)])
+        x = np.asarray(x)
+        if self._slices is None:
+            #the output size of each sample is only known after it is first evaluated
+            self._first_call(x)
+        if out is None:
+            if self._result is None:
+                self._result = np.empty(self._slices[-1].stop, dtype=float)
+            out = self._result
+        result = out
+        def evalsample(samplenum):
+            self.eval_sample(x, samplenum, out=result[self._slices[samplenum]])
+            return
+        if self._nthreads <= 1:
+            for samplenum in xrange(len(self._samples)):
+                evalsample(samplenum)
+        else:
+            self._threadpool().map(evalsample, xrange(len(self._samples)), chunksize=1)
+        return result
+
+    def eval_batch(self, pars):
+        """Returns the [n, nbins] rate vectors for [n, npars] parameters.
+        Each sample is evaluated for all parameters in one call if it implements eval_batch."""
+        pars = np.asarray(pars)
+        if pars.shape[1] != len(self.parameter_names):
+            raise ValueError("Sample called with wrong number of parameters")
+        return np.concatenate([evaluate_batch(s, pars[:, self._par_map[samplenum]]) for samplenum, s in enumerate(self._samples)], axis=1)
+
+    def eval_and_jacobian(self, x):
+        """Returns the rate vector and its derivatives with respect to each parameter, [nbins, npars]."""
+        if len(x) != len(self.parameter_names):
+            raise ValueError("Sample called with wrong number of parameters")
+        x = np.asarray(x)
+        vectors = []
+        jacobians = []
+        for samplenum, s in enumerate(self._samples):
+            v, j = s.eval_and_jacobian(self._get_args(x, samplenum))
+            vectors.append(v)
+            jacobians.append(j)
+        result = np.concatenate(vectors)
+        jac = np.zeros((len(result), len(x)), dtype=float)
+        start = 0
+        for samplenum, j in enumerate(jacobians):
+            jac[start:start + len(j), self._par_map[samplenum]] += j
+            start += len(j)
+        return result, jac
+
+    def jacobian(self, x):
+        return self.eval_and_jacobian(x)[1]
+
+    def _first_call(self, x):
+        slices = []
+        start = 0
+        for samplenum in xrange(len(self._samples)):
+            n = len(self.eval_sample(x, samplenum))
+            slices.append(slice(start, start + n))
+            start += n
+        self._slices = slices
+        return
+
+    def __getstate__(self):
+        #the thread pool and result array are recreated when needed
+        state = dict(self.__dict__)
+        state["_pool"] = None
+        state["_result"] = None
+        return state
+
+    def _threadpool(self):
+        if self._pool is None:
+            self._pool = ThreadPool(self._nthreads)
+        return self._pool
+
+    def close(self):
+        """Stops the evaluation threads (they are restarted if the sample is evaluated again)."""
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        return
+
+    def __del__(self):
+        if getattr(self, "_pool", None) is not None:
+            self._pool.terminate()
 
     def _get_args(self, x, samplenum):
-        x2 = np.fromiter(itertools.imap(x.__getitem__, self._par_map[samplenum]), x.dtype)
-        return x2
+        return np.take(x, self._par_map[samplenum])
 
     def _determine_parameter_mapping(self, samples, parameter_order=None, ignoreerrors=False):
         parameter_names = []
@@ -0,0 +1,119 @@
+"""Save and load models that are ready to evaluate.
+
+The file starts with a pickle of the object with every numpy array replaced by a reference,
+followed by the raw, 64 byte aligned, contents of the arrays. The arrays can be read into memory or
+memory-mapped (copy-on-write) so many processes loading the same file share the pages.
+
+Probability calculators (for example Prob3++) are not stored. On loading each calculator is replaced by
+the probabilitycalc argument or, if that is None, a new Prob3++ calculator.
+"""
+
+import struct
+from cStringIO import StringIO
+
+import cPickle as pickle
+import numpy as np
+
+_MAGIC = "simplot-model-v1\n"
+_ALIGNMENT = 64
+_PROBABILITY_CALCULATOR = "probabilitycalc"
+_ARRAY = "ndarray"
+
+################################################################################
+
+def save_model(model, path):
+    """Writes model (any object that can be pickled, with numpy arrays stored in binary) to path."""
+    arrays = []
+    ids = {}
+    calculators = {}
+    def persistent_id(obj):
+        if isinstance(obj, np.ndarray) and obj.dtype != object:
+            key = id(obj)
+            if key not in ids:
+                ids[key] = len(arrays)
+                arrays.append(obj)
+            return (_ARRAY, ids[key])
+        if _is_probability_calculator(obj):
+            return (_PROBABILITY_CALCULATOR, calculators.setdefault(id(obj), len(calculators)))
+        return None
+    skeleton = _dumps(model, persistent_id)
+    table = []
+    offset = 0
+    for arr in arrays:
+        arr = np.ascontiguousarray(arr)
+        table.append((arr.dtype.str, arr.shape, offset))
+        offset = _align(offset + arr.nbytes)
+    header = pickle.dumps((skeleton, table), protocol=pickle.HIGHEST_PROTOCOL)
+    with open(path, "wb") as outfile:
+        outfile.write(_MAGIC)
+        outfile.write(struct.pack("<Q", len(header)))
+        outfile.write(header)
+        start = _align(outfile.tell())
+        for arr, (_, _, arroffset) in zip(arrays, table):
+            outfile.seek(start + arroffset)
+            outfile.write(np.ascontiguousarray(arr).tostring())
+    return
+
+def load_model(path, mmap=False, probabilitycalc=None, expected=None):
+    """Reads a model written by save_model.
+    If mmap is True the arrays are memory-mapped copy-on-write instead of read into memory.
+    If expected is given a TypeError is raised unless the model is an instance of it.
+    """
+    with open(path, "rb") as infile:
+        if infile.read(len(_MAGIC)) != _MAGIC:
+            raise ValueError("not a simplot model file", path)
+        length, = struct.unpack("<Q", infile.read(8))
+        skeleton, table = pickle.loads(infile.read(length))
+        start = _align(infile.tell())
+        arrays = [_readarray(infile, path, dtype, shape, start + offset, mmap) for dtype, shape, offset in table]
+    calculators = {}
+    def persistent_load(pid):
+        kind, index = pid
+        if kind == _ARRAY:
+            return arrays[index]
+        if kind == _PROBABILITY_CALCULATOR:
+            if probabilitycalc is not None:
+                return probabilitycalc
+            if index not in calculators:
+                calculators[index] = _default_probability_calculator()
+            return calculators[index]
+        raise pickle.UnpicklingError("unknown persistent id", pid)
+    model = _loads(skeleton, persistent_load)
+    if expected is not None and not isinstance(model, expected):
+        raise TypeError("model file contains an object of the wrong type", path, type(model), expected)
+    return model
+
+################################################################################
+
+def _dumps(obj, persistent_id):
+    sio = StringIO()
+    pickler = pickle.Pickler(sio, pickle.HIGHEST_PROTOCOL)
+    pickler.persistent_id = persistent_id
+    pickler.dump(obj)
+    return sio.getvalue()
+
+def _loads(data, persistent_load):
+    unpickler = pickle.Unpickler(StringIO(data))
+    unpickler.persistent_load = persistent_load
+    return unpickler.load()
+
+def _align(offset):
+    return ((offset + _ALIGNMENT - 1) // _ALIGNMENT) * _ALIGNMENT
+
+def _readarray(infile, path, dtype, shape, offset, mmap):
+    dtype = np.dtype(dtype)
+    count = int(np.prod(shape))
+    if count == 0:
+        return np.zeros(shape, dtype=dtype)
+    if mmap and len(shape) > 0:
+        return np.memmap(path, dtype=dtype, mode="c", offset=offset, shape=shape)
+    infile.seek(offset)
+    return np.fromfile(infile, dtype=dtype, count=count).reshape(shape)
+
+def _is_probability_calculator(obj):
+    return callable(getattr(obj, "getVacuumProbability", None)) and callable(getattr(obj, "setAll", None))
+
+def _default_probability_calculator():
+    import simplot.rootprob3pp.lib
+    import ROOT
+    return ROOT.crootprob3pp.Probability()
@@ -1,26 +1,59 @@
 from collections import OrderedDict
+import copy
 
 import numpy as np
 import ROOT
 
-from simplot.mc.generators import GeneratorList, MultiVariateGaussianGenerator, GeneratorSubset
+from simplot.mc.generators import GeneratorList, MultiVariateGaussianGenerator, GeneratorSubset, derive_seeds
 from simplot.mc.montecarlo import ToyMC
-from simplot.mc.statistics import Covariance, Mean, calculate_statistics_from_toymc
-from simplot.cache import cache
+from simplot.mc.statistics import Covariance, Mean, calculate_statistics_from_toymc, safedivide, fractional_covariance
+from simplot.mc.likelihood import EventRateLikelihood
+from simplot.mc.streams import asstream
+from simplot.cache import cache, provenance_hash
+from simplot.parallel import parallel_map
 
 from simplot.binnedmodel.xsecweights import SimpleInterpolatedWeightCalc
 from simplot.binnedmodel.sample import Sample, BinnedSample, BinnedSampleWithOscillation, CombinedBinnedSample, OscParMode
+from simplot.binnedmodel.model import BinnedModel, BinnedModelWithOscillation, ObservableRateVector
+from simplot.binnedmodel.responsematrix import ResponseMatrixModelWithOscillation
 
 from simplot.binnedmodel.simplemodelwithosc import SimpleBinnedModelWithOscillation
 
 _PAR_BIN_FORMAT = "bin%02.0f"
+_TOY_BLOCK_SIZE = 1000
+#child of the builder seed that seeds the built generator, the covariance blocks use children 0, 1, ...
+_GENERATOR_STREAM = -1
+#maximum number of interpolated weights held in memory by SimpleModel.eval_batch
+_BATCH_ELEMENTS = 10**7
+#finite difference step in units of the parameter sigma
+_PROPAGATION_STEP = 1e-3
+
+################################################################################
+
+class CovarianceMethod:
+    TOYS = "toys"
+    LINEAR = "linear"
+    QUADRATIC = "quadratic"
+    ALL = [TOYS, LINEAR, QUADRATIC]
 
 ################################################################################
 
 class SimpleMcBuilder(object):
 
-    def build(self, name, toymc, keep=None, cache_name=None, npe=1000, fixed=None):
+    def build(self, name, toymc, keep=None, cache_name=None, npe=1000, fixed=None, nprocesses=1, seed=None, method=CovarianceMethod.TOYS, dtype=np.float64):
+        """The spline knots and toys are evaluated in nprocesses worker processes (all cores if None).
+        If seed is given, or more than one process is used, the toys are thrown in blocks with random number
+        streams derived from seed so the covariance does not depend on the number of processes.
+        With method=CovarianceMethod.LINEAR the covariance is J.C.J^T from the Jacobian of the rate vector and
+        the generator covariance instead of npe toys. CovarianceMethod.QUADRATIC adds the second order terms.
+        Use compare_covariance to check whether these agree with the toys.
+        dtype=np.float32 stores the spline tables of the built model in single precision, see compare_precision.
+        """
         self.name = name
+        self.nprocesses = nprocesses
+        self.seed = seed
+        self.method = method
+        self.dtype = dtype
         try:
             #assume keep is dict(parnames, splinepoints)
             keys = keep.keys()
@@ -38,9 +71,16 @@ class SimpleMcBuilder(object):
         return toymc, cov
 
     def _generate_covariance_with_cache(self, toymc, keep, npe=1000, cache_name=None, fixed=None):    
+        method = self.method
+        if method not in CovarianceMethod.ALL:
+            raise ValueError("SimpleMcBuilder unknown covariance method", method, CovarianceMethod.ALL)
         def func(self=self, toymc=toymc, keep=keep):
-            return self._generate_covariance(toymc, keep, npe=npe, fixed=fixed)
+            if method == CovarianceMethod.TOYS:
+                return self._generate_covariance(toymc, keep, npe=npe, fixed=fixed)
+            return self._propagate_covariance(toymc, keep, fixed=fixed, secondorder=(method == CovarianceMethod.QUADRATIC))
         if cache_name is not None:
+            if method != CovarianceMethod.TOYS:
+                cache_name = method + "_" + cache_name
             cov = cache("SimpleMcBuilderCovariance_" + cache_name, func)
         else:
             cov = func()
@@ -59,14 +99,22 @@ class SimpleMcBuilder(object):
         result = OrderedDict()
         if spline_points is None:
             spline_points = self._autosplinepoints(toymc, keep)
+        #build the parameter vectors of every knot up front and evaluate them together
+        parameter_names = toymc.generator.parameter_names
+        start_values = np.array(toymc.generator.start_values)
+        knots = [(par, x) for par, xpoints in spline_points.iteritems() for x in xpoints]
+        knotpars = np.tile(start_values, (len(knots), 1))
+        for row, (par, x) in enumerate(knots):
+            knotpars[row, parameter_names.index(par)] = x
+        name = self.name
+        if name is not None:
+            name = "generate splines for " + str(name)
+        ratevector = toymc.ratevector
+        def evalknot(pars):
+            return np.array(ratevector(pars))
+        ypoints = iter(parallel_map(evalknot, knotpars, nprocesses=self.nprocesses, name=name))
         for par, xpoints in spline_points.iteritems():
-            ypoints = []
-            for x in xpoints:
-                index = toymc.generator.parameter_names.index(par)
-                pars = np.array(toymc.generator.start_values)
-                pars[index] = x
-                ypoints.append(np.array(toymc.ratevector(pars)))
-            wc = SimpleInterpolatedWeightCalc(nominalvalues=nominal, parvalues=xpoints, arrays=ypoints, parname=par, parameternames=keep)
+            wc = SimpleInterpolatedWeightCalc(nominalvalues=nominal, parvalues=xpoints, arrays=[next(ypoints) for x in xpoints], parname=par, parameternames=keep)
             result[par] = wc
         return result
 
@@ -79,26 +127,115 @@ class SimpleMcBuilder(object):
             spline_points[par] = [float(ii)*sigma for ii in xrange(-5, 6)]
         return spline_points
 
-    def _generate_covariance(self, toymc, keep, npe=1000, fixed=None):
-        cov = Covariance(fractional=True)
-        mean = Mean()
-        generator = toymc.generator
+    def _setfixed(self, generator, keep, fixed):
         if keep is not None and fixed is not None:
             generator.setfixed(set(keep) | set(fixed))
         elif keep is not None:
             generator.setfixed(set(keep))
         elif fixed is not None:
             generator.setfixed(set(fixed))
+        return
+
+    def _generate_covariance(self, toymc, keep, npe=1000, fixed=None):
+        cov = Covariance(fractional=True)
+        mean = Mean()
+        generator = toymc.generator
+        self._setfixed(generator, keep, fixed)
         name = self.name
         if name is not None:
             name = "generate covariance matrix for " + str(name)
-        calculate_statistics_from_toymc(toymc, [cov, mean], npe=npe, name=name)
+        if self.nprocesses == 1 and self.seed is None:
+            calculate_statistics_from_toymc(toymc, [cov, mean], npe=npe, name=name)
+        else:
+            self._generate_covariance_blocks(toymc, cov, mean, npe, name)
         if keep is not None:
             generator.setfixed(None)
         return cov.eval(), mean.eval()
 
+    def _generate_covariance_blocks(self, toymc, cov, mean, npe, name):
+        #the blocks, their seeds and the merge order only depend on npe and the seed
+        blocks = [min(_TOY_BLOCK_SIZE, npe - start) for start in xrange(0, npe, _TOY_BLOCK_SIZE)]
+        seeds = derive_seeds(self.seed, len(blocks))
+        #the blocks reseed a copy, the caller's toymc continues its own stream
+        toymc = toymc.clone()
+        def throwblock(block):
+            size, seed = block
+            toymc.generator.seed(seed)
+            partial = [Covariance(fractional=True), Mean()]
+            calculate_statistics_from_toymc(toymc, partial, npe=size)
+            return partial
+        for partialcov, partialmean in parallel_map(throwblock, zip(blocks, seeds), nprocesses=self.nprocesses, name=name):
+            cov.merge(partialcov)
+            mean.merge(partialmean)
+        return
+
+    def _propagate_covariance(self, toymc, keep, fixed=None, secondorder=False):
+        """Returns the fractional covariance and mean of the rate vector, propagating the generator covariance
+        of the varied parameters through the Jacobian of the rate vector at the start values.
+        With secondorder the Hessian terms for Gaussian parameters are included,
+        cov_ab += tr(H_a C H_b C) / 2 and mean_a += tr(H_a C) / 2.
+        """
+        generator = toymc.generator
+        self._setfixed(generator, keep, fixed)
+        pars = np.array(generator.start_values, dtype=float)
+        fixedvalues = dict(generator._fixed)
+        if keep is not None or fixed is not None:
+            generator.setfixed(None)
+        for index, value in fixedvalues.iteritems():
+            pars[index] = value
+        varied = [ii for ii in xrange(len(pars)) if ii not in fixedvalues]
+        names = [generator.parameter_names[ii] for ii in varied]
+        C = np.array([[generator.getcovariance(p1, p2) for p2 in names] for p1 in names], dtype=float).reshape((len(varied), len(varied)))
+        steps = _PROPAGATION_STEP * np.sqrt(np.diag(C))
+        steps[steps == 0.0] = _PROPAGATION_STEP
+        mean, J = self._eval_and_jacobian(toymc.ratevector, pars, varied, steps)
+        cov = np.dot(J, np.dot(C, J.T))
+        if secondorder:
+            #Hessian [nbins, nvaried, nvaried] from central differences of the Jacobian
+            H = np.zeros((len(mean), len(varied), len(varied)), dtype=float)
+            for jj, (index, h) in enumerate(zip(varied, steps)):
+                up = np.copy(pars)
+                up[index] += h
+                down = np.copy(pars)
+                down[index] -= h
+                H[:, :, jj] = (self._eval_and_jacobian(toymc.ratevector, up, varied, steps)[1] - self._eval_and_jacobian(toymc.ratevector, down, varied, steps)[1]) / (2.0 * h)
+            H = 0.5 * (H + H.transpose((0, 2, 1)))
+            HC = np.einsum("aij,jk->aik", H, C)
+            cov += 0.5 * np.einsum("aij,bji->ab", HC, HC)
+            mean = mean + 0.5 * np.einsum("aii->a", HC)
+        return fractional_covariance(cov, mean), mean
+
+    def _eval_and_jacobian(self, ratevector, pars, varied, steps):
+        """Returns the rate vector and its derivatives with respect to the varied parameters.
+        The analytic Jacobian is used if the rate vector provides one, otherwise central differences."""
+        try:
+            vec, jac = ratevector.eval_and_jacobian(pars)
+            return np.array(vec, dtype=float), np.array(jac, dtype=float)[:, varied]
+        except (AttributeError, NotImplementedError):
+            pass
+        vec = np.array(ratevector(pars), dtype=float)
+        jac = np.zeros((len(vec), len(varied)), dtype=float)
+        for jj, (index, h) in enumerate(zip(varied, steps)):
+            up = np.copy(pars)
+            up[index] += h
+            down = np.copy(pars)
+            down[index] -= h
+            jac[:, jj] = (np.array(ratevector(up), dtype=float) - np.array(ratevector(down), dtype=float)) / (2.0 * h)
+        return vec, jac
+
+    def compare_covariance(self, toymc, keep=None, npe=200, fixed=None, secondorder=False):
+        """Compares the propagated covariance with one estimated from npe toys.
+        Returns a CovarianceComparison, use its agrees() method to decide whether the propagation can be used."""
+        propagated, propagatedmean = self._propagate_covariance(toymc, keep, fixed=fixed, secondorder=secondorder)
+        cov = Covariance(fractional=True)
+        mean = Mean()
+        self._setfixed(toymc.generator, keep, fixed)
+        calculate_statistics_from_toymc(toymc, [cov, mean], npe=npe)
+        toymc.generator.setfixed(None)
+        return CovarianceComparison(propagated, cov.eval(), cov.err(), propagatedmean, mean.eval(), mean.err())
+
     def _buildratevector(self, mean, splines):
-        model = SimpleModel(mean, splines)
+        model = SimpleModel(mean, splines, dtype=self.dtype)
         return model
 
     def _buildgenerator(self, toymc, keep, cov):
@@ -109,41 +246,218 @@ class SimpleMcBuilder(object):
         if keep is not None:
             subset = GeneratorSubset(keep, toymc.generator)
             gen = GeneratorList(subset, gen)
+        gen.seed(self._generatorstream(toymc))
         return gen
 
+    def _generatorstream(self, toymc):
+        """Returns the seed of the built generator, a child of the builder seed or, without one, a seed drawn from
+        a copy of the input generator so that a seeded input toymc gives a reproducible model."""
+        if self.seed is not None:
+            return asstream(self.seed).child(_GENERATOR_STREAM)
+        throw = copy.deepcopy(toymc.generator).generate(1)
+        return asstream(int(provenance_hash(throw)[:15], 16))
+
+################################################################################
+
+class CovarianceComparison(object):
+    def __init__(self, propagated, toys, toyserr, propagatedmean, toysmean, toysmeanerr):
+        """Propagated and toy covariance matrices and means with the statistical errors of the toys."""
+        self.propagated = propagated
+        self.toys = toys
+        self.toyserr = toyserr
+        self.propagatedmean = propagatedmean
+        self.toysmean = toysmean
+        self.toysmeanerr = toysmeanerr
+
+    def pulls(self):
+        """Returns the difference between the propagated and toy covariance in units of the toy error."""
+        return safedivide(self.propagated - self.toys, self.toyserr)
+
+    def maxpull(self):
+        return np.max(np.abs(self.pulls()))
+
+    def meanpulls(self):
+        return safedivide(self.propagatedmean - self.toysmean, self.toysmeanerr)
+
+    def agrees(self, threshold=3.0):
+        """True if the covariance and mean agree with the toys within threshold standard deviations."""
+        return self.maxpull() < threshold and np.max(np.abs(self.meanpulls())) < threshold
+
+    def __str__(self):
+        return "CovarianceComparison(maxpull=%.2f, maxmeanpull=%.2f)" % (self.maxpull(), np.max(np.abs(self.meanpulls())))
+
+################################################################################
+
+def compare_precision(reference, model, parameters, observed=None):
+    """Evaluates reference (for example a float64 model) and model (for example the same model in float32)
+    at each parameter vector. Returns the largest relative deviation of the rate vector and
+    the largest absolute deviation of the Poisson log-likelihood of observed (default: the reference
+    prediction at the first parameter vector).
+    The binned models (BinnedModel, BinnedModelWithOscillation, ResponseMatrixModelWithOscillation) are compared
+    on their observable() rate vector, for example the model of a BinnedSample built with dtype=np.float32.
+    """
+    reference = _asratevector(reference)
+    model = _asratevector(model)
+    parameters = [np.asarray(p, dtype=float) for p in parameters]
+    if observed is None:
+        observed = np.copy(reference(parameters[0]))
+    lhd_reference = EventRateLikelihood(reference, observed)
+    lhd_model = EventRateLikelihood(model, observed)
+    maxobs = 0.0
+    maxlhd = 0.0
+    for pars in parameters:
+        expected = np.asarray(reference(pars), dtype=float)
+        deviation = safedivide(np.abs(np.asarray(model(pars), dtype=float) - expected), np.abs(expected))
+        maxobs = max(maxobs, np.max(deviation))
+        maxlhd = max(maxlhd, abs(lhd_model(pars) - lhd_reference(pars)))
+    return maxobs, maxlhd
+
+def _asratevector(model):
+    if isinstance(model, (BinnedModel, BinnedModelWithOscillation, ResponseMatrixModelWithOscillation)):
+        return ObservableRateVector(model)
+    return model
+
 ################################################################################
 
 class SimpleModel(Sample):
-    def __init__(self, nominal, splines, binoffset=0):
+    def __init__(self, nominal, splines, binoffset=0, dtype=np.float64):
+        """The spline tables are stored with dtype, the interpolation and rate vector are always calculated in float64."""
         self._nominal = np.array(nominal, dtype=float)
+        self._dtype = dtype
         parameter_names = []
         interp = []
         for parname, wc in splines.iteritems():
             parameter_names.append(parname)
             interp.append(wc)
         self._interp = interp
+        self._buildtable(interp)
         self._binweights_start = len(parameter_names)
         self._binweights_end = self._binweights_start + len(self._nominal)
         for ii in xrange(len(self._nominal)):
             parameter_names.append(_PAR_BIN_FORMAT % (ii+binoffset))
         super(SimpleModel, self).__init__(parameter_names)
-    
-    def __call__(self, x):
+
+    def _buildtable(self, interp):
+        """Stacks the spline tables into [nparams, nknots] knot values and [nparams, nknots, nbins] weights.
+        Splines with fewer knots are padded by repeating their last knot."""
+        nbins = len(self._nominal)
+        nknots = max([len(wc.table()[1]) for wc in interp] + [1])
+        self._parindex = np.zeros(len(interp), dtype=int)
+        self._xknots = np.zeros((len(interp), nknots), dtype=float)
+        self._yknots = np.ones((len(interp), nknots, nbins), dtype=self._dtype)
+        self._lastinterval = np.zeros(len(interp), dtype=int)
+        for ipar, wc in enumerate(interp):
+            parnum, x, y = wc.table()
+            n = len(x)
+            self._parindex[ipar] = parnum
+            self._xknots[ipar, :n] = x
+            self._xknots[ipar, n:] = x[-1]
+            self._yknots[ipar, :n] = y
+            self._yknots[ipar, n:] = y[-1]
+            self._lastinterval[ipar] = max(n - 2, 0)
+        self._rows = np.arange(len(interp))
+        self._weights = np.ones(nbins, dtype=float)
+        return
+
+    def __call__(self, x, out=None):
+        """Returns the rate vector. If out is given the result is written into it."""
         binweights = x[self._binweights_start:self._binweights_end]
         interpolatedweights = self._interpolatedweights(x)
-        return interpolatedweights * binweights * self._nominal
+        if out is None:
+            out = np.empty(len(self._nominal), dtype=float)
+        np.multiply(interpolatedweights, binweights, out=out)
+        np.multiply(out, self._nominal, out=out)
+        return out
 
-    def _interpolatedweights(self, x):
-        result = np.ones(len(self._nominal))
-        for wc in self._interp:
-            result *= wc(x)
+    def eval_batch(self, pars):
+        """Returns the [n, nbins] rate vectors for [n, npars] parameters."""
+        pars = np.asarray(pars, dtype=float)
+        result = np.array(pars[:, self._binweights_start:self._binweights_end], dtype=float)
+        if len(self._rows) > 0:
+            #[n, nparams, nbins] interpolated weights, evaluated in blocks to bound the memory
+            step = max(1, _BATCH_ELEMENTS // max(1, self._yknots.shape[0] * self._yknots.shape[2]))
+            for start in xrange(0, len(pars), step):
+                y = self._interpolate_batch(pars[start:start + step])
+                result[start:start + step] *= np.prod(y, axis=1)
+        np.multiply(result, self._nominal, out=result)
         return result
 
+    def eval_and_jacobian(self, x):
+        """Returns the rate vector and its derivatives with respect to each parameter, [nbins, npars]."""
+        x = np.asarray(x, dtype=float)
+        binweights = x[self._binweights_start:self._binweights_end]
+        nbins = len(self._nominal)
+        jac = np.zeros((nbins, len(x)), dtype=float)
+        if len(self._rows) == 0:
+            interpolatedweights = np.ones(nbins, dtype=float)
+        else:
+            y, slope = self._interpolate(x)
+            interpolatedweights = np.prod(y, axis=0)
+            #products of the weights of the splines before and after each spline
+            before = np.ones_like(y)
+            before[1:] = np.cumprod(y, axis=0)[:-1]
+            after = np.ones_like(y)
+            after[:-1] = np.cumprod(y[::-1], axis=0)[::-1][1:]
+            scale = binweights * self._nominal
+            for ipar in xrange(len(self._rows)):
+                jac[:, self._parindex[ipar]] += before[ipar] * after[ipar] * slope[ipar] * scale
+        result = interpolatedweights * binweights * self._nominal
+        jac[:, self._binweights_start:self._binweights_end] += np.diag(interpolatedweights * self._nominal)
+        return result, jac
+
+    def jacobian(self, x):
+        return self.eval_and_jacobian(x)[1]
+
+    def _interpolatedweights(self, x):
+        if len(self._rows) == 0:
+            return self._weights
+        y, _ = self._interpolate(x)
+        return np.prod(y, axis=0, out=self._weights)
+
+    def _interpolate_batch(self, pars):
+        """Returns the [n, nparams, nbins] interpolated weights of each spline, as _interpolate for each row of pars."""
+        rows = self._rows[np.newaxis, :]
+        xknots = self._xknots
+        v = pars[:, self._parindex]
+        i = np.clip(np.sum(xknots[np.newaxis] <= v[:, :, np.newaxis], axis=2) - 1, 0, self._lastinterval)
+        inext = np.minimum(i + 1, xknots.shape[1] - 1)
+        x0 = xknots[rows, i]
+        x1 = xknots[rows, inext]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            f = np.where(x1 > x0, (v - x0) / (x1 - x0), 0.0)
+        np.clip(f, 0.0, 1.0, out=f)
+        f = f[:, :, np.newaxis]
+        return f * self._yknots[rows, inext] + (1.0 - f) * self._yknots[rows, i]
+
+    def _interpolate(self, x):
+        """Returns the [nparams, nbins] interpolated weights of each spline and their derivatives."""
+        rows = self._rows
+        xknots = self._xknots
+        v = np.asarray(x, dtype=float)[self._parindex]
+        #linear interpolation between the knots either side of each parameter, constant outside the knots
+        i = np.clip(np.sum(xknots <= v[:, np.newaxis], axis=1) - 1, 0, self._lastinterval)
+        inext = np.minimum(i + 1, xknots.shape[1] - 1)
+        x0 = xknots[rows, i]
+        x1 = xknots[rows, inext]
+        y0 = self._yknots[rows, i]
+        y1 = self._yknots[rows, inext]
+        inside = (x1 > x0) & (v >= xknots[:, 0]) & (v < xknots[rows, np.minimum(self._lastinterval + 1, xknots.shape[1] - 1)])
+        with np.errstate(divide="ignore", invalid="ignore"):
+            f = np.where(x1 > x0, (v - x0) / (x1 - x0), 0.0)
+            slope = np.where(inside[:, np.newaxis], (y1 - y0) / (x1 - x0)[:, np.newaxis], 0.0)
+        np.clip(f, 0.0, 1.0, out=f)
+        f = f[:, np.newaxis]
+        return f * y1 + (1.0 - f) * y0, slope
+
 ################################################################################
 
 class SimpleMcWithOscillationBuilder(SimpleMcBuilder):
-    def build(self, name, toymc, sample, cache_name=None, npe=1000, probabilitycalc=None, fixed=None, oscparmode=OscParMode.SINSQTHETA):
+    def build(self, name, toymc, sample, cache_name=None, npe=1000, probabilitycalc=None, fixed=None, oscparmode=OscParMode.SINSQTHETA, nprocesses=1, seed=None, method=CovarianceMethod.TOYS, dtype=np.float64):
         self.name = name
+        self.nprocesses = nprocesses
+        self.seed = seed
+        self.method = method
+        self.dtype = dtype
         oscpars = toymc.generator.parameter_names[:6]
         cov, mean = self._generate_covariance_with_cache(toymc=toymc, keep=oscpars, npe=npe, cache_name=cache_name, fixed=fixed)
         generator = self._buildgenerator(toymc, oscpars, cov)
@@ -159,7 +473,7 @@ class SimpleMcWithOscillationBuilder(SimpleMcBuilder):
         parnames = oscpars + [_PAR_BIN_FORMAT % (ii+binoffset) for ii in xrange(N_sel.shape[2])]
         if probabilitycalc is None:
             probabilitycalc = ROOT.crootprob3pp.Probability()
-        ratevector = SimpleBinnedModelWithOscillation(parnames, N_sel, N_nosel, enubinning, detdist, probabilitycalc=probabilitycalc, oscparmode=oscparmode)
+        ratevector = SimpleBinnedModelWithOscillation(parnames, N_sel, N_nosel, enubinning, detdist, probabilitycalc=probabilitycalc, oscparmode=oscparmode, dtype=self.dtype)
         return ratevector
 
     def _transform_array(self, arr, observables, enubinning, dim_enu, dim_flav):
@@ -188,8 +502,12 @@ class SimpleMcWithOscillationBuilder(SimpleMcBuilder):
 
 class SimpleCombinedMcWithOscillationBuilder(SimpleMcWithOscillationBuilder):
 
-    def build(self, name, toymc, sample, cache_name=None, npe=1000, probabilitycalc=None, fixed=None, oscparmode=OscParMode.SINSQTHETA):
+    def build(self, name, toymc, sample, cache_name=None, npe=1000, probabilitycalc=None, fixed=None, oscparmode=OscParMode.SINSQTHETA, nprocesses=1, seed=None, method=CovarianceMethod.TOYS, dtype=np.float64):
         self.name = name
+        self.nprocesses = nprocesses
+        self.seed = seed
+        self.method = method
+        self.dtype = dtype
         oscpars = toymc.generator.parameter_names[:6]
         cov, mean = self._generate_covariance_with_cache(toymc=toymc, keep=oscpars, npe=npe, cache_name=cache_name, fixed=fixed)
         generator = self._buildgenerator(toymc, oscpars, cov)
@@ -1,8 +1,10 @@
 import numpy as np
 cimport numpy as np
+cimport cython
 
 from simplot.mc.statistics import safedivide
 from simplot.binnedmodel.model import ProbabilityCache, OscParMode
+from simplot.binnedmodel.serialize import save_model, load_model
 
 DEF _DIM_ENU = 0
 DEF _DIM_NUPDG = 1
@@ -16,12 +18,16 @@ cdef class SimpleBinnedModelWithOscillation:
     cdef np.ndarray _N_nosel_projection;
     cdef np.ndarray _otherflav;
     cdef object _prob;
-    cdef np.ndarray _cache3D;
+    cdef np.ndarray _response;
+    cdef np.ndarray _weights;
     cdef np.ndarray _cache1D;
+    cdef np.ndarray _cached_oscpars;
+    cdef bint _float64;
     cdef Py_ssize_t _num_enu_bins;
     cdef Py_ssize_t _num_reco_bins;
 
-    def __init__(self, parnames, N_sel, N_nosel, enubinning, detdist, probabilitycalc=None, oscparmode=OscParMode.SINSQTHETA):
+    def __init__(self, parnames, N_sel, N_nosel, enubinning, detdist, probabilitycalc=None, oscparmode=OscParMode.SINSQTHETA, dtype=np.float64):
+        """The response matrix is stored with dtype, the prediction is always accumulated in float64."""
         self._num_enu_bins = N_sel.shape[_DIM_ENU]
         self._num_reco_bins = N_sel.shape[_DIM_RECO]
         #check shape
@@ -38,41 +44,67 @@ cdef class SimpleBinnedModelWithOscillation:
         self._N_nosel_projection = np.sum(N_nosel, axis=2)
         self._otherflav = np.array([1,0,3,2], dtype=int)
         self._prob = ProbabilityCache(parnames, enubinning, [detdist], probabilitycalc=probabilitycalc, oscparmode=oscparmode)
-        self._cache3D = np.copy(N_sel)
+        #selected events in each (enu, flavour) bin spread over reco bins, the prediction is weights . response
+        self._response = np.ascontiguousarray(np.multiply(self._eff, N_nosel).reshape((self._num_enu_bins * 4, self._num_reco_bins)), dtype=dtype)
+        self._float64 = self._response.dtype == np.float64
+        self._weights = np.zeros((self._num_enu_bins, 4), dtype=float)
         self._cache1D = np.copy(np.sum(N_sel, axis=(_DIM_NUPDG, _DIM_ENU)))
+        self._cached_oscpars = None
         return
 
-    def __call__(self, pars):
-        return self.eval(pars)
+    def __call__(self, pars, out=None):
+        return self.eval(pars, out=out)
 
-    cdef np.ndarray[np.float64_t, ndim=1] eval(self, np.ndarray[np.float64_t, ndim=1] pars):
+    def __reduce__(self):
+        state = (self._parnames, self._eff, self.N_nosel, self._N_nosel_projection, self._otherflav, self._prob,
+                 self._response, self._num_enu_bins, self._num_reco_bins)
+        return (_restore_simplebinnedmodelwithoscillation, state)
+
+    def save(self, path):
+        """Writes the model, ready to evaluate, to path (see simplot.binnedmodel.serialize)."""
+        save_model(self, path)
+        return
+
+    @classmethod
+    def load(cls, path, mmap=False, probabilitycalc=None):
+        return load_model(path, mmap=mmap, probabilitycalc=probabilitycalc, expected=cls)
+
+    cdef np.ndarray eval(self, np.ndarray[np.float64_t, ndim=1] pars, out=None):
+        """Returns the rate vector. If out is given the result is written into it."""
         self._updateprediction(pars)
-        return np.multiply(self._syst_weights(pars), self._cache1D)
+        if out is None:
+            out = np.empty(self._num_reco_bins, dtype=float)
+        return np.multiply(self._syst_weights(pars), self._cache1D, out=out)
 
     cdef np.ndarray[np.float64_t, ndim=1] _syst_weights(self, np.ndarray[np.float64_t, ndim=1] pars):
         return pars[_NUM_OSC_PARS:]
 
-    cdef void _updateprediction(self, pars):
-        self._osc_flav_rotation(pars)
-        np.multiply(self._eff, self._cache3D, out=self._cache3D)
-        np.sum(self._cache3D, axis=(_DIM_NUPDG, _DIM_ENU), out=self._cache1D)
+    cdef void _updateprediction(self, np.ndarray[np.float64_t, ndim=1] pars):
+        #the oscillated prediction only depends on the oscillation parameters
+        if self._cached_oscpars is not None and np.array_equal(self._cached_oscpars, pars[:_NUM_OSC_PARS]):
+            return
+        self._osc_weights(pars)
+        if self._float64:
+            np.dot(self._weights.reshape(self._num_enu_bins * 4), self._response, out=self._cache1D)
+        else:
+            #buffered casting, the response matrix is not copied to float64
+            np.einsum("i,ij->j", self._weights.reshape(self._num_enu_bins * 4), self._response, dtype=np.float64, out=self._cache1D)
+        self._cached_oscpars = np.copy(pars[:_NUM_OSC_PARS])
         return
 
-#    @cython.boundscheck(False)
-    cdef void _osc_flav_rotation(self, pars):
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef void _osc_weights(self, pars):
         #get inputs
-        cdef np.ndarray[double, ndim=4] posc = self._prob.array
-        cdef np.ndarray[np.float64_t, ndim=3] nominal = self.N_nosel
+        self._prob.update(pars)
+        cdef np.ndarray[double, ndim=4] posc = self._prob.probabilities()
         cdef np.ndarray[np.float64_t, ndim=2] nominal_projection = self._N_nosel_projection
-        cdef np.ndarray[np.float64_t, ndim=3] result = self._cache3D
+        cdef np.ndarray[np.float64_t, ndim=2] weights = self._weights
         cdef Py_ssize_t Nenubins = self._num_enu_bins
-        cdef Py_ssize_t Nrecobins = self._num_reco_bins
         cdef np.ndarray[dtype=Py_ssize_t, ndim=1] otherflav = self._otherflav
-        #update oscillation probabilities
-        self._prob.update(pars)
-        #calculate
-        cdef Py_ssize_t flav_j, flav_i, ienu, ireco
-        cdef double pdis, papp, value, othervalue, nosc
+        #calculate the ratio of oscillated to unoscillated events in each (enu, flavour) bin
+        cdef Py_ssize_t flav_j, flav_i, ienu
+        cdef double pdis, papp, value, othervalue, nosc, weight
         for flav_j in xrange(4):
             for ienu in xrange(Nenubins):
                 flav_i = otherflav[flav_j]
@@ -84,10 +116,27 @@ cdef class SimpleBinnedModelWithOscillation:
                 weight = 0.0
                 if value != 0.0:
                     weight = nosc / value
-                for ireco in xrange(Nrecobins):
-                    result[ienu, flav_j, ireco] = weight * nominal[ienu, flav_j, ireco]
+                weights[ienu, flav_j] = weight
         return
 
     @property
     def parameter_names(self):
         return self._parnames
+
+def _restore_simplebinnedmodelwithoscillation(parnames, eff, N_nosel, N_nosel_projection, otherflav, prob, response, num_enu_bins, num_reco_bins):
+    cdef SimpleBinnedModelWithOscillation result = SimpleBinnedModelWithOscillation.__new__(SimpleBinnedModelWithOscillation)
+    result._parnames = parnames
+    result._eff = eff
+    result.N_nosel = N_nosel
+    result._N_nosel_projection = N_nosel_projection
+    result._otherflav = otherflav
+    result._prob = prob
+    result._response = response
+    result._float64 = response.dtype == np.float64
+    result._num_enu_bins = num_enu_bins
+    result._num_reco_bins = num_reco_bins
+    #working arrays are rebuilt, the prediction is recalculated on the first call
+    result._weights = np.zeros((num_enu_bins, 4), dtype=float)
+    result._cache1D = np.zeros(num_reco_bins, dtype=float)
+    result._cached_oscpars = None
+    return result
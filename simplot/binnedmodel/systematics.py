@@ -1,5 +1,7 @@
 from collections import OrderedDict
 
+import numpy as np
+
 from simplot.binnedmodel.xsecweights import XsecWeights, InterpolatedWeightCalc
 from simplot.binnedmodel.fluxweights import FluxWeights
 
@@ -17,12 +19,19 @@ class Systematics(object):
     def __call__(self, parameter_names, systhist, nominalhist):
         raise NotImplementedError("ERROR: child class must implement this method.")        
 
+    def provenance(self):
+        """Returns a description of these systematics that is used to build cache keys. 
+        Child classes with other settings that change the histograms or model must extend it."""
+        return (type(self).__name__, list(self.parameter_names), [(s, list(v)) for s, v in self.spline_parameter_values])
+
 ################################################################################
 
 class SplineSystematics(Systematics):
 
-    def __init__(self, spline_parameter_values):
+    def __init__(self, spline_parameter_values, dtype=np.float64):
+        """The spline weights at each knot are stored with dtype (see InterpolatedWeightCalc)."""
         self._spline_parameter_values = spline_parameter_values
+        self._dtype = dtype
 
     def __call__(self, parameter_names, systhist, nominalhist):
         xsec_weights = self._buildxsecweights(self.spline_parameter_values, parameter_names, systhist, nominalhist)
@@ -48,7 +57,7 @@ class SplineSystematics(Systematics):
                 l.sort() # sort by parameter value
                 weights = [x[1].array() for x in l] 
                 parval = [x[0] for x in l]
-                wc = InterpolatedWeightCalc(hist.array(), parval, weights, syst, parameter_names)
+                wc = InterpolatedWeightCalc(hist.array(), parval, weights, syst, parameter_names, dtype=self._dtype)
                 wclist.append(wc)
             xsecweights = XsecWeights(hist.array(), wclist)
         return xsecweights
@@ -87,6 +96,9 @@ class FluxSystematics(Systematics):
         flux_weights = self._buildfluxweights(parameter_names, nominalhist)
         return det_weights, xsec_weights, flux_weights
 
+    def provenance(self):
+        return super(FluxSystematics, self).provenance() + ((self._dim_enutrue, self._dim_nupdg, self._dim_beammode), dict(self._fluxparametermap))
+
     def _buildfluxweights(self, parameter_names, nominalhist):
         fw = FluxWeights(parameter_names, nominalhist.array().shape(),
                      self._dim_enutrue, 
@@ -126,8 +138,8 @@ class FluxSystematics(Systematics):
 ################################################################################
 
 class FluxAndSplineSystematics(Systematics):
-    def __init__(self, spline_parameter_values, enudim, nupdgdim, beammodedim, fluxparametermap):
-        self._splinesyst = SplineSystematics(spline_parameter_values)
+    def __init__(self, spline_parameter_values, enudim, nupdgdim, beammodedim, fluxparametermap, dtype=np.float64):
+        self._splinesyst = SplineSystematics(spline_parameter_values, dtype=dtype)
         self._fluxsyst = FluxSystematics(enudim, nupdgdim, beammodedim, fluxparametermap)
 
     @property
@@ -144,11 +156,14 @@ class FluxAndSplineSystematics(Systematics):
     def parameter_names(self):
         return self._splinesyst.parameter_names + self._fluxsyst.parameter_names
 
+    def provenance(self):
+        return super(FluxAndSplineSystematics, self).provenance() + (self._fluxsyst.provenance(),)
+
 ################################################################################
 
 class DetectorFluxAndSplineSystematics(FluxAndSplineSystematics):
-    def __init__(self, det_systematics, spline_parameter_values, enudim, nupdgdim, beammodedim, fluxparametermap):
-        super(DetectorFluxAndSplineSystematics, self).__init__(spline_parameter_values, enudim, nupdgdim, beammodedim, fluxparametermap)
+    def __init__(self, det_systematics, spline_parameter_values, enudim, nupdgdim, beammodedim, fluxparametermap, dtype=np.float64):
+        super(DetectorFluxAndSplineSystematics, self).__init__(spline_parameter_values, enudim, nupdgdim, beammodedim, fluxparametermap, dtype=dtype)
         self._detector_systematics = det_systematics
 
     @property
@@ -164,4 +179,7 @@ class DetectorFluxAndSplineSystematics(FluxAndSplineSystematics):
     def parameter_names(self):
         return self._detector_systematics.parameter_names + self._splinesyst.parameter_names + self._fluxsyst.parameter_names
 
+    def provenance(self):
+        return super(DetectorFluxAndSplineSystematics, self).provenance() + (self._detector_systematics.provenance(),)
+
 ################################################################################
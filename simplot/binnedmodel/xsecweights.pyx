@@ -4,6 +4,7 @@ import numpy as np
 cimport numpy as np
 
 from simplot.sparsehist.sparsehist cimport SparseArray, SparseArrayIterator, array_bisect_right, sparse_array_interpolation
+from simplot.sparsehist.sparsehist import DenseArray
 
 from libc.stdint cimport uint64_t
 from libcpp.vector cimport vector
@@ -43,6 +44,33 @@ class XsecWeights:
         other = self._update(pars)
         return self._product(arr, other)
 
+    def derivatives(self, pars):
+        """Returns [(parameter index, derivative of the product of weights)] for each spline parameter inside its knots."""
+        other = self._update(pars)
+        n = len(other)
+        #products of the weights before and after each spline
+        before = [self._ones()]
+        for ii in xrange(n - 1):
+            before.append(before[ii] * other[ii])
+        after = [None] * n
+        acc = None
+        for ii in reversed(xrange(n)):
+            after[ii] = acc
+            if acc is None:
+                acc = other[ii]
+            else:
+                acc = other[ii] * acc
+        result = []
+        for ii, calc in enumerate(self._xseccalc):
+            parnum, d = calc.derivative(pars)
+            if d is None:
+                continue
+            d = before[ii] * d
+            if after[ii] is not None:
+                d = d * after[ii]
+            result.append((parnum, d))
+        return result
+
     def _update(self, pars):
         cdef np.ndarray[object, ndim=1] other = np.zeros(dtype=object, shape=(len(self._xseccalc),));
         for ii, calc in enumerate(self._xseccalc):
@@ -72,10 +100,9 @@ class XsecWeights:
 #        return arr
 
     def _product(self, SparseArray arr, np.ndarray[object, ndim=1] otherarrays):
-        cdef SparseArray rhs;
+        #the weights are SparseArrays or DenseArrays
         for ii in xrange(len(otherarrays)):
-            rhs = otherarrays[ii]
-            arr *= rhs
+            arr *= otherarrays[ii]
         return arr
 
 ################################################################################
@@ -142,14 +169,18 @@ cdef class InterpolatedWeightCalc:
     cdef int _parnum;
     cdef vector[double] _xvec;
     cdef list _yvec;
-    cdef SparseArray _arr;
+    cdef object _arr;
     #SparseArray self._arr;
     cdef str _parname;
-    def __init__(self, nominalvalues, parvalues, arrays, parname, parameternames):
+    def __init__(self, nominalvalues, parvalues, arrays, parname, parameternames, dtype=np.float64):
+        """The weights at the knots are stored with dtype, as DenseArrays unless dtype is float64.
+        The interpolated weights are always calculated in float64."""
         self._check_is_sorted(parvalues)
         self._parnum = self._findparameter(parname, parameternames)
         self._xvec = parvalues
         self._yvec = [arr/nominalvalues for arr in arrays]
+        if np.dtype(dtype) != np.float64:
+            self._yvec = [y.todense(dtype=dtype) for y in self._yvec]
         self._arr = None
         self._parname = parname
         #check inputs
@@ -190,7 +221,21 @@ cdef class InterpolatedWeightCalc:
         x = pars[self._parnum]
         self._arr = self.eval(x)
 
-    cdef SparseArray eval(self, double x):
+    def __reduce__(self):
+        return (_restore_interpolatedweightcalc, (self._parnum, list(self._xvec), self._yvec, self._arr, self._parname))
+
+    def derivative(self, pars):
+        """Returns (parameter index, derivative of the weights array) or (parameter index, None) outside of the knots."""
+        cdef double x = pars[self._parnum]
+        cdef int last = self._xvec.size() - 1
+        if x < self._xvec[0] or x >= self._xvec[last]:
+            return self._parnum, None
+        cdef int i = array_bisect_right(self._xvec, x) - 1
+        y0 = self._yvec[i]
+        y1 = self._yvec[i+1]
+        return self._parnum, (1.0 / (self._xvec[i+1] - self._xvec[i])) * (y1 - y0)
+
+    cdef eval(self, double x):
         cdef int last = self._xvec.size() - 1
         if x <= self._xvec[0]:
             return self._yvec[0]
@@ -199,15 +244,17 @@ cdef class InterpolatedWeightCalc:
         #inside vector
         cdef i = array_bisect_right(self._xvec, x) - 1
         #print "DEBUG", len(yvec), x, xvec, i
-        cdef SparseArray y0 = self._yvec[i]
-        cdef SparseArray y1 = self._yvec[i+1]
+        y0 = self._yvec[i]
+        y1 = self._yvec[i+1]
         cdef double x0 = self._xvec[i]
         cdef double x1 = self._xvec[i+1]
         return self._interp(x, x0, x1, y0, y1)
 
-    cdef SparseArray _interp(self, double x, double x0, double x1, SparseArray y0, SparseArray y1):
+    cdef _interp(self, double x, double x0, double x1, y0, y1):
         cdef double f = (x-x0) / (x1-x0)
         #return f*y1 + (1.0-f)*y0
+        if isinstance(y1, DenseArray):
+            return _dense_interpolation(f, y0, y1)
         return sparse_array_interpolation(f, y0, y1)
 
 ################################################################################
@@ -258,6 +305,13 @@ cdef class SimpleInterpolatedWeightCalc:
     def array(self):
         return self._arr
 
+    def __reduce__(self):
+        return (_restore_simpleinterpolatedweightcalc, (self._parnum, list(self._xvec), self._yvec, np.array(self._arr, dtype=float), self._parname))
+
+    def table(self):
+        """Returns (parameter index, knot values, [nknots, nbins] array of weights at each knot)."""
+        return self._parnum, np.array(self._xvec, dtype=float), np.array(self._yvec, dtype=float)
+
     def update(self, pars):
         #for i in xrange(len(pars)):
         #    print "DEBUG", i, pars[i]
@@ -289,3 +343,30 @@ cdef class SimpleInterpolatedWeightCalc:
         return y
 
 ################################################################################
+
+def _dense_interpolation(double f, y0, y1):
+    #f*y1 + (1-f)*y0 calculated in float64 from knots of any dtype
+    result = DenseArray(y1.shape())
+    np.multiply(y1._values, f, out=result._values, dtype=np.float64)
+    result._values += (1.0 - f) * np.asarray(y0._values, dtype=np.float64)
+    return result
+
+def _restore_interpolatedweightcalc(parnum, xvec, yvec, arr, parname):
+    cdef InterpolatedWeightCalc result = InterpolatedWeightCalc.__new__(InterpolatedWeightCalc)
+    result._parnum = parnum
+    result._xvec = xvec
+    result._yvec = yvec
+    result._arr = arr
+    result._parname = parname
+    return result
+
+def _restore_simpleinterpolatedweightcalc(parnum, xvec, yvec, arr, parname):
+    cdef SimpleInterpolatedWeightCalc result = SimpleInterpolatedWeightCalc.__new__(SimpleInterpolatedWeightCalc)
+    result._parnum = parnum
+    result._xvec = xvec
+    result._yvec = yvec
+    result._arr = arr
+    result._parname = parname
+    return result
+
+################################################################################
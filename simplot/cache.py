@@ -46,6 +46,56 @@ def cache_root(uniquestr, callable_, filelist=None, tmpdir=_DEFAULT_TMPDIR):
 
 ###############################################################################
 
+def file_identity(fname, digest=False):
+    '''Returns a tuple identifying the contents of a file: (absolute path, size, modification time).
+    If digest is True the md5 of the file contents is appended. This is slower but is not fooled by 
+    files that are copied or touched.
+    '''
+    fname = os.path.abspath(fname)
+    stat = os.stat(fname)
+    result = (fname, stat.st_size, stat.st_mtime)
+    if digest:
+        md5 = hashlib.md5()
+        with open(fname, "rb") as infile:
+            for block in iter(lambda: infile.read(2**20), ""):
+                md5.update(block)
+        result += (md5.hexdigest(),)
+    return result
+
+def provenance_hash(*objects):
+    '''Returns a hex digest of the objects. 
+    The objects may be (nested) lists, tuples and dicts of numbers, strings and numpy arrays.
+    Equal inputs always give the same digest so it can be used as a cache key.
+    '''
+    md5 = hashlib.md5()
+    _update_hash(md5, objects)
+    return md5.hexdigest()
+
+def _update_hash(md5, obj):
+    if isinstance(obj, numpy.number):
+        obj = obj.item()
+    if isinstance(obj, numpy.ndarray):
+        arr = numpy.ascontiguousarray(obj)
+        md5.update("ndarray%s%s" % (arr.dtype.str, arr.shape))
+        md5.update(arr.tostring())
+    elif isinstance(obj, dict):
+        md5.update("dict%d" % len(obj))
+        for key in sorted(obj.keys()):
+            _update_hash(md5, key)
+            _update_hash(md5, obj[key])
+    elif isinstance(obj, (list, tuple)):
+        md5.update("%s%d" % (type(obj).__name__, len(obj)))
+        for x in obj:
+            _update_hash(md5, x)
+    elif isinstance(obj, (basestring, int, long, float, bool, type(None))):
+        #repr of floats round-trips exactly
+        md5.update("%s:%r" % (type(obj).__name__, obj))
+    else:
+        raise TypeError("provenance_hash cannot hash object of this type", type(obj))
+    return
+
+###############################################################################
+
 class Cache(object):
     def __init__(self, uniquestr, prefix="tmp", postfix=".bin", tmpdir=_DEFAULT_TMPDIR):
         self._uniquestr = uniquestr
@@ -7,6 +7,7 @@ from libc.math cimport exp
 
 from simplot.mc.montecarlo import generate_timed as _gen_timed
 from simplot.mc.montecarlo import generate_events as _gen_events
+from simplot.mc.streams import randomstate
 
 ################################################################################
 
@@ -30,6 +31,9 @@ cdef class MetropolisHastingsAlgorithm(object):
     cdef object _random
     cdef double _likelihood
     def __init__(self, parameter_names, function, proposal, start, parameter_range, seed=None):
+        """The accept/reject decisions use seed (None, an integer or a RandomStream, see simplot.mc.streams).
+        The proposal functions have their own streams, see simplot.fit.mcmc.proposalfunc.seed_proposals.
+        """
         self._parameter_names = parameter_names
         self._start = np.array(start)
         self._low = np.array([x[0] for x in parameter_range])
@@ -40,7 +44,7 @@ cdef class MetropolisHastingsAlgorithm(object):
         self._proposal = proposal
         self._total = 0
         self._success = 0
-        self._random = np.random.RandomState(seed)
+        self._random = randomstate(seed)
         #compute the intial likelihood values
         self._likelihood = self._function(self._theta)
         self._check_inputs()
@@ -11,6 +11,7 @@ from simplot.fit.hesse import Verbosity as HesseVerbosity
 from simplot.fit.mcmc.metropolishastings import McMcSetupError
 from simplot.mc.likelihood import MultiVariateGaussianLikelihood
 from simplot.mc.generators import MultiVariateGaussianGenerator
+from simplot.mc.streams import randomstate, derive_streams
 
 from simplot.mc.clikelihood import gaus_log_density
 
@@ -30,6 +31,11 @@ cdef class NormalGenerator:
         self._N = 1000
         self._gen()
 
+    def seed(self, seed):
+        self._random = randomstate(seed)
+        self._gen()
+        return
+
     cdef _gen(self):
         self._cache = self._random.normal(size=self._N)
         self._count = 0
@@ -48,6 +54,16 @@ _NORMAL = NormalGenerator()
 cdef double _normal():
     return _NORMAL.normal()
 
+def seed_proposals(seed):
+    """Restarts the random number streams shared by the proposal functions from seed (None, an integer or a RandomStream).
+    Each chain run in a separate process should use its own seed, for example a child stream of a common RandomStream.
+    """
+    global _RANDOM
+    randomseed, normalseed = derive_streams(seed, 2)
+    _RANDOM = randomstate(randomseed)
+    _NORMAL.seed(normalseed)
+    return
+
 ###############################################################################
 
 @cython.boundscheck(False)
@@ -283,13 +299,13 @@ class _MultiVariateGaussianLikelihoodWrapper(MultiVariateGaussianLikelihood):
 ###############################################################################
 
 class MultiVariateGaussianProposal(object):
-    def __init__(self, mu, cov, startindex=0):
+    def __init__(self, mu, cov, startindex=0, seed=None):
         cov = np.copy(cov)
         self._startindex = startindex
         self._stopindex = startindex + len(mu)
         self._lhd = _MultiVariateGaussianLikelihoodWrapper(mu, cov)
         parameter_names = ["par_"+str(i) for i in xrange(len(mu))]
-        self._gen = MultiVariateGaussianGenerator(parameter_names, mu=[0.0]*len(mu), cov=cov)
+        self._gen = MultiVariateGaussianGenerator(parameter_names, mu=[0.0]*len(mu), cov=cov, seed=seed)
         self._check_input(cov)
 
     def _check_input(self, cov):
@@ -4,7 +4,7 @@ import math
 import numpy as np
 import scipy.stats
 
-from simplot.mc.eigendecomp import EigenDecomposition
+from simplot.mc.streams import randomstate, derive_streams
 
 ###############################################################################
 
@@ -13,24 +13,59 @@ class GeneratorException(Exception):
 
 ###############################################################################
 
+def derive_seeds(seed, n):
+    """Returns n independent random number streams (see simplot.mc.streams) derived from seed."""
+    return derive_streams(seed, n)
+
+###############################################################################
+
 class Generator(object):
-    """Interface for generators. The generators must implement _generate()."""
+    """Interface for generators. The generators must implement _generate() and may implement _generate_batch(n)."""
     def __init__(self, parameter_names, start_values):
         self.parameter_names = list(parameter_names)
         self.start_values = np.array(start_values, copy=True)
         self.start_values.setflags(write=False)
         self._fixed = {}
+        self._fixedindices = np.zeros(0, dtype=int)
+        self._fixedvalues = np.zeros(0, dtype=float)
         self._verify_generator()
 
     def __call__(self):
         v = self._generate()
         #replace fixed parameters with their set values
-        for index, val in self._fixed.iteritems():
-            v[index] = val
+        v[self._fixedindices] = self._fixedvalues
+        return v
+
+    def generate(self, n):
+        """Returns [n, npars] parameter vectors. For a given seed these are the same as n calls to the generator."""
+        v = self._generate_batch(n)
+        v[:, self._fixedindices] = self._fixedvalues
         return v
 
     def _generate(self):
         raise NotImplementedError("ERROR: child class must implement _generate method.")
+
+    def marginal(self, parameter_names):
+        """Returns a generator of the marginal distribution of parameter_names (in the order of this generator),
+        or None if this generator cannot build one. The new generator has its own random number stream,
+        seed it with seed(). Fixed parameters are not copied.
+        """
+        return None
+
+    def _marginalindices(self, parameter_names):
+        return np.array([self.parameter_names.index(p) for p in parameter_names], dtype=int)
+
+    def _generate_batch(self, n):
+        #generic implementation, child classes override this with a vectorised version
+        result = np.zeros((n, len(self.parameter_names)), dtype=float)
+        for ii in xrange(n):
+            result[ii] = self._generate()
+        return result
+
+    def seed(self, seed):
+        """Restarts the random number stream of this generator from seed (None, an integer or a RandomStream)."""
+        self._rng = randomstate(seed)
+        return
         
     def fixallexcept(self, varied):
         fixed = set(self.parameter_names)
@@ -57,6 +92,8 @@ class Generator(object):
             if v is None:
                 v = self.start_values[index]
             self._fixed[index] = v
+        self._fixedindices = np.array(self._fixed.keys(), dtype=int)
+        self._fixedvalues = np.array(self._fixed.values(), dtype=float)
         return
 
     def getmu(self, parname):
@@ -90,7 +127,7 @@ class GaussianGenerator(Generator):
         self._sigma = np.array(sigma, copy=True)
         self._mu.setflags(write=False)
         self._sigma.setflags(write=False)
-        self._rng = np.random.RandomState(seed=seed)
+        self._rng = randomstate(seed)
         self._verify()
 
     def _generate(self):
@@ -101,6 +138,15 @@ class GaussianGenerator(Generator):
         np.add(mu, np.multiply(x, sigma, x), x)
         return x
 
+    def _generate_batch(self, n):
+        x = self._rng.normal(size=(n, len(self._mu)))
+        np.add(self._mu, np.multiply(x, self._sigma, x), x)
+        return x
+
+    def marginal(self, parameter_names):
+        indices = self._marginalindices(parameter_names)
+        return GaussianGenerator(parameter_names, self._mu[indices], self._sigma[indices])
+
     def getsigma(self, parname):
         index = self.parameter_names.index(parname)
         return self._sigma[index]
@@ -121,6 +167,12 @@ class ConstantGenerator(Generator):
     def _generate(self):
         return np.copy(self.start_values)
 
+    def _generate_batch(self, n):
+        return np.tile(np.array(self.start_values, dtype=float), (n, 1))
+
+    def marginal(self, parameter_names):
+        return ConstantGenerator(parameter_names, self.start_values[self._marginalindices(parameter_names)])
+
     def getsigma(self, parname):
         index = self.parameter_names.index(parname)
         return 0.0
@@ -135,7 +187,7 @@ class UniformGenerator(Generator):
         super(UniformGenerator, self).__init__(parameter_names, start_values=value)
         self._scale = np.array([x[1]-x[0] for x in range_], dtype=float)
         self._shift = np.array([x[0] for x in range_], dtype=float)
-        self._rng = np.random.RandomState(seed=seed)
+        self._rng = randomstate(seed)
 
     def _generate(self):
         scale = self._scale
@@ -143,6 +195,18 @@ class UniformGenerator(Generator):
         x = self._rng.uniform(size=len(scale))
         return (scale*x) + shift
 
+    def _generate_batch(self, n):
+        x = self._rng.uniform(size=(n, len(self._scale)))
+        np.multiply(x, self._scale, x)
+        np.add(x, self._shift, x)
+        return x
+
+    def marginal(self, parameter_names):
+        indices = self._marginalindices(parameter_names)
+        shift = self._shift[indices]
+        range_ = zip(shift, shift + self._scale[indices])
+        return UniformGenerator(parameter_names, self.start_values[indices], range_)
+
     def getsigma(self, parname):
         index = self.parameter_names.index(parname)
         return self._scale[index] / np.sqrt(12)
@@ -162,6 +226,35 @@ class GeneratorList(Generator):
     def _generate(self):
         return np.concatenate([gen._generate() for gen in self._generators])
 
+    def _generate_batch(self, n):
+        result = np.zeros((n, len(self.parameter_names)), dtype=float)
+        start = 0
+        for gen in self._generators:
+            stop = start + len(gen.parameter_names)
+            result[:, start:stop] = gen._generate_batch(n)
+            start = stop
+        return result
+
+    def marginal(self, parameter_names):
+        #the generators are independent, the marginal is the product of the marginals of each generator
+        kept = set(parameter_names)
+        marginals = []
+        for gen in self._generators:
+            names = [p for p in gen.parameter_names if p in kept]
+            if len(names) == 0:
+                continue
+            m = gen.marginal(names)
+            if m is None:
+                return None
+            marginals.append(m)
+        return GeneratorList(*marginals)
+
+    def seed(self, seed):
+        #each generator gets its own stream derived from seed
+        for gen, s in zip(self._generators, derive_seeds(seed, len(self._generators))):
+            gen.seed(s)
+        return
+
     def getmu(self, parname):
         result = None
         for gen in self._generators:
@@ -199,15 +292,61 @@ class GeneratorList(Generator):
 ###############################################################################
 
 class GeneratorSubset(Generator):
-    def __init__(self, parameter_names, generator):
+    def __init__(self, parameter_names, generator, seed=None):
+        """Throws parameter_names from generator.
+        If generator can build the marginal distribution of these parameters (see Generator.marginal) only they are thrown,
+        from an independent stream derived from seed, otherwise the full vector of generator is thrown and the parameters 
+        selected from it. The parameters fixed in generator are set to its current fixed values each time the subset is thrown.
+        """
         self._indices = [generator.parameter_names.index(p) for p in parameter_names]
+        self._indexarray = np.array(self._indices, dtype=int)
         self._gen = generator
         start_values = [generator.start_values[ii] for ii in self._indices]
         super(GeneratorSubset, self).__init__(parameter_names, start_values)
+        self._marginal, self._marginalorder = self._buildmarginal(generator)
+        self._parentfixed = None
+        self.seed(seed)
+
+    def _buildmarginal(self, generator):
+        ordered = sorted(self._indices)
+        names = [generator.parameter_names[ii] for ii in ordered]
+        marginal = generator.marginal(names)
+        if marginal is None:
+            return None, None
+        order = np.array([ordered.index(ii) for ii in self._indices], dtype=int)
+        return marginal, order
+
+    def _fixedbyparent(self):
+        #(positions, values) of the parameters fixed in the parent, rebuilt after the parent calls setfixed
+        parent = self._gen
+        if self._parentfixed is None or self._parentfixed[0] is not parent._fixedindices:
+            positions = [pos for pos, ii in enumerate(self._indices) if ii in parent._fixed]
+            values = [parent._fixed[self._indices[pos]] for pos in positions]
+            self._parentfixed = (parent._fixedindices, np.array(positions, dtype=int), np.array(values, dtype=float))
+        return self._parentfixed[1:]
 
     def _generate(self):
-        x = self._gen()
-        return np.array([x[ii] for ii in self._indices], dtype=float)
+        if self._marginal is not None:
+            v = self._marginal()[self._marginalorder]
+            positions, values = self._fixedbyparent()
+            v[positions] = values
+            return v
+        return self._gen()[self._indexarray]
+
+    def _generate_batch(self, n):
+        if self._marginal is not None:
+            v = self._marginal.generate(n)[:, self._marginalorder]
+            positions, values = self._fixedbyparent()
+            v[:, positions] = values
+            return v
+        return self._gen.generate(n)[:, self._indexarray]
+
+    def seed(self, seed):
+        """Seeds the marginal generator with a child stream of seed, so it does not repeat the throws of a parent seeded with seed.
+        Without a marginal the subset throws the parent, which is seeded separately, and seed is ignored."""
+        if self._marginal is not None:
+            self._marginal.seed(derive_streams(seed, 1)[0])
+        return
 
     def getsigma(self, par):
         return self._gen.getsigma(par)
@@ -218,18 +357,69 @@ class GeneratorSubset(Generator):
 ###############################################################################
 
 class MultiVariateGaussianGenerator(Generator):
-    def __init__(self, parameter_names, mu, cov, seed=None):
+    def __init__(self, parameter_names, mu, cov, seed=None, variancefraction=None):
+        """Throws are mu + L z, where z are independent unit Gaussians.
+        L is the Cholesky factor of cov if it is positive definite. Otherwise L is the eigenvectors scaled by the 
+        square root of the eigenvalues, with negative eigenvalues set to zero.
+        If variancefraction is given, only the largest eigenmodes that account for that fraction of the total variance
+        are kept. Each throw then costs O(npars * nmodes). getsigma and getcovariance still return the input covariance.
+        """
         super(MultiVariateGaussianGenerator, self).__init__(parameter_names, start_values=mu)
         self._mu = np.array(mu, copy=True, dtype=float)
         self._cov = np.array(cov, copy=True, dtype=float)
+        self._verify()
+        self._variancefraction = variancefraction
         self._sigma = np.sqrt(self._removenegative(np.diag(self._cov)), dtype=float)
-        self._decomp = EigenDecomposition(self._cov, dtype=float)
-        eigenvalues = self._removenegative(self._decomp.eigenvalues)
-        self._eigensigma = np.sqrt(eigenvalues)
-        for arr in [self._mu, self._cov, self._sigma, self._eigensigma]:
+        self._transform = self._buildtransform(self._cov, variancefraction)
+        self.nmodes = self._transform.shape[1]
+        self._residualsigma = None
+        for arr in [self._mu, self._cov, self._sigma, self._transform]:
             arr.setflags(write=False)
-        self._rng = np.random.RandomState(seed=seed)
-        self._verify()
+        self._rng = randomstate(seed)
+
+    @classmethod
+    def fromfactors(cls, parameter_names, mu, factor, diagonal=None, seed=None):
+        """Returns the generator of a Gaussian with covariance factor . factor^T + diag(diagonal), [npars, k] and [npars].
+        The dense covariance matrix is never built, each throw costs O(npars * k).
+        """
+        result = cls.__new__(cls)
+        Generator.__init__(result, parameter_names, start_values=mu)
+        result._mu = np.array(mu, copy=True, dtype=float)
+        result._transform = np.array(factor, copy=True, dtype=float).reshape((len(result._mu), -1))
+        variance = np.sum(np.power(result._transform, 2), axis=1)
+        result._residualsigma = None
+        if diagonal is not None:
+            result._residualsigma = np.sqrt(result._removenegative(diagonal))
+            variance += np.power(result._residualsigma, 2)
+        result._cov = None
+        result._variancefraction = None
+        result._sigma = np.sqrt(variance)
+        result.nmodes = result._transform.shape[1]
+        for arr in [result._mu, result._sigma, result._transform]:
+            arr.setflags(write=False)
+        result._rng = randomstate(seed)
+        if not len(result.parameter_names) == len(result._mu) == len(result._transform):
+            raise ValueError("MultiVariateGaussianGenerator initialisation list arguments are not the same length", len(result.parameter_names), len(result._mu), len(result._transform))
+        return result
+
+    def _buildtransform(self, cov, variancefraction):
+        if variancefraction is None:
+            try:
+                return np.linalg.cholesky(cov)
+            except np.linalg.LinAlgError:
+                #not positive definite, fall back to the eigen decomposition
+                pass
+        elif not 0.0 < variancefraction <= 1.0:
+            raise ValueError("MultiVariateGaussianGenerator variancefraction must be in (0, 1]", variancefraction)
+        eigenvalues, eigenvectors = np.linalg.eigh(cov)
+        #largest modes first
+        eigenvalues = self._removenegative(eigenvalues[::-1])
+        eigenvectors = eigenvectors[:, ::-1]
+        nmodes = len(eigenvalues)
+        total = np.sum(eigenvalues)
+        if variancefraction is not None and total > 0.0:
+            nmodes = min(int(np.searchsorted(np.cumsum(eigenvalues), variancefraction * total)) + 1, len(eigenvalues))
+        return np.ascontiguousarray(eigenvectors[:, :nmodes] * np.sqrt(eigenvalues[:nmodes]))
 
     def _removenegative(self, eigenvalues):
         printwarning = True
@@ -244,14 +434,35 @@ class MultiVariateGaussianGenerator(Generator):
         return eigenvalues
 
     def _generate(self):
-        mu = self._mu
-        sigma = self._eigensigma
-        x = self._rng.normal(size=len(mu))
-        np.multiply(x, sigma, x)
-        x = self._decomp.transform_from_eigen_basis(x)
-        np.add(x, mu, x)
+        if self._residualsigma is not None:
+            return self._generate_batch(1)[0]
+        x = np.dot(self._transform, self._rng.normal(size=self.nmodes))
+        np.add(x, self._mu, x)
         return x
 
+    def _generate_batch(self, n):
+        if self._residualsigma is not None:
+            #each throw uses nmodes correlated and npars independent normals
+            z = self._rng.normal(size=(n, self.nmodes + len(self._mu)))
+            x = np.dot(z[:, :self.nmodes], self._transform.T)
+            x += z[:, self.nmodes:] * self._residualsigma
+        else:
+            #each row is L z, z . L^T
+            x = np.dot(self._rng.normal(size=(n, self.nmodes)), self._transform.T)
+        np.add(x, self._mu, x)
+        return x
+
+    def marginal(self, parameter_names):
+        #the marginal of a Gaussian is the Gaussian with the sub-covariance matrix
+        indices = self._marginalindices(parameter_names)
+        if self._cov is None:
+            diagonal = None
+            if self._residualsigma is not None:
+                diagonal = np.power(self._residualsigma[indices], 2)
+            return MultiVariateGaussianGenerator.fromfactors(parameter_names, self._mu[indices], self._transform[indices], diagonal)
+        cov = self._cov[np.ix_(indices, indices)]
+        return MultiVariateGaussianGenerator(parameter_names, self._mu[indices], cov, variancefraction=self._variancefraction)
+
     def getsigma(self, parname):
         index = self.parameter_names.index(parname)
         return self._sigma[index]
@@ -259,6 +470,12 @@ class MultiVariateGaussianGenerator(Generator):
     def getcovariance(self, par1, par2):
         i1 = self.parameter_names.index(par1)
         i2 = self.parameter_names.index(par2)
+        if self._cov is None:
+            #built from the factors
+            cov = np.dot(self._transform[i1], self._transform[i2])
+            if i1 == i2 and self._residualsigma is not None:
+                cov += self._residualsigma[i1]**2
+            return cov
         cov = self._cov[i1,i2]
         return cov
     
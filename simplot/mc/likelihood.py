@@ -75,6 +75,29 @@ class MultiVariateGaussianLikelihood(Likelihood):
         cov = np.array(cov, copy=True)
         self._verify(cov) # check inputs before trying matrix inversion.
         self._invcov = np.linalg.inv(cov)
+        self._factor = None
+
+    @classmethod
+    def fromfactors(cls, parameter_names, mu, factor, diagonal):
+        """Returns the likelihood of a Gaussian with covariance factor . factor^T + diag(diagonal), [npars, k] and [npars].
+        The inverse is applied with the Woodbury identity so each evaluation costs O(npars * k).
+        The diagonal must be positive.
+        """
+        result = cls.__new__(cls)
+        Likelihood.__init__(result, parameter_names)
+        result._mu = np.array(mu, dtype=float, copy=True)
+        factor = np.array(factor, dtype=float, copy=True).reshape((len(result._mu), -1))
+        diagonal = np.array(diagonal, dtype=float, copy=True)
+        if not len(result._mu) == len(factor) == len(diagonal) == result._npars:
+            raise ValueError("MultiVariateGaussianLikelihood given mu and factors of different length", len(result._mu), len(factor), len(diagonal), result._npars)
+        if np.any(diagonal <= 0.0):
+            raise ValueError("MultiVariateGaussianLikelihood given a diagonal that is not positive")
+        result._invcov = None
+        result._factor = factor
+        result._invdiagonal = 1.0 / diagonal
+        #(I + W^T D^-1 W)^-1
+        result._core = np.linalg.inv(np.identity(factor.shape[1]) + np.dot(factor.T, factor * result._invdiagonal[:, np.newaxis]))
+        return result
 
 
     def _verify(self, cov):
@@ -90,9 +113,17 @@ class MultiVariateGaussianLikelihood(Likelihood):
     def __call__(self, x):
         self._checksize(x)
         xminmu = x - self._mu
+        if self._factor is not None:
+            return -0.5 * self._woodbury(xminmu)
         xminmu = xminmu.reshape((1, self._npars))
         return -0.5 * np.dot(xminmu, np.dot(self._invcov, xminmu.T))[0,0]
 
+    def _woodbury(self, r):
+        #r^T C^-1 r with C^-1 = D^-1 - D^-1 W (I + W^T D^-1 W)^-1 W^T D^-1
+        dr = r * self._invdiagonal
+        wdr = np.dot(self._factor.T, dr)
+        return np.dot(r, dr) - np.dot(wdr, np.dot(self._core, wdr))
+
 ################################################################################
 
 class SumLikelihood(Likelihood):
@@ -1,10 +1,23 @@
 import StringIO
+import copy
+import itertools
+import multiprocessing
 import time
 import datetime
+import traceback
 
 import numpy as np
 
 from simplot.progress import printprogress
+from simplot.parallel import numprocesses
+from simplot.mc.streams import randomstate, derive_streams, asstream
+
+################################################################################
+
+#number of toys thrown together by generate_events and generate_batches
+DEFAULT_BATCH_SIZE = 1000
+#seconds between checks that the generate_parallel workers are alive
+_POLL_SECONDS = 0.1
 
 ################################################################################
 
@@ -35,11 +48,46 @@ class ToyMCExperiment:
 
 ################################################################################
 
+class ToyMCBatch:
+    """n experiments stored as [n, npars] parameters and [n, nbins] rate vectors."""
+    def __init__(self, pars, vec):
+        self.pars = pars
+        self.vec = vec
+
+    def __len__(self):
+        return len(self.pars)
+
+    def __getitem__(self, index):
+        return ToyMCExperiment(self.pars[index], self.vec[index])
+
+    def __iter__(self):
+        for ii in xrange(len(self)):
+            yield self[ii]
+        return
+
+################################################################################
+
 class ToyMC:
-    def __init__(self, ratevector, generator):
+    def __init__(self, ratevector, generator, seed=None):
+        """seed is the random number stream of the Poisson fluctuations (see generate_batch)."""
         self.ratevector = ratevector
         self.generator = generator
+        self._rng = randomstate(seed)
         self._verify(ratevector, generator)
+
+    def seed(self, seed):
+        """Restarts the generator and the Poisson fluctuations from independent streams derived from seed."""
+        generatorseed, poissonseed = derive_streams(seed, 2)
+        self.generator.seed(generatorseed)
+        self._rng = randomstate(poissonseed)
+        return
+
+    def clone(self):
+        """Returns a ToyMC sharing the rate vector with a copy of the generator and random number streams,
+        so seeding or throwing from the copy leaves this object unchanged."""
+        result = ToyMC(self.ratevector, copy.deepcopy(self.generator))
+        result._rng = copy.deepcopy(self._rng)
+        return result
         
     def _verify(self, ratevector, generator):
         #check that the inputs match
@@ -62,8 +110,21 @@ class ToyMC:
 #             logging.debug("ToyMC generating parameters")
 #             for n, v in itertools.izip_longest(self.generator.parameter_names, pars):
 #                 logging.debug("parameter value %s = %s", n, v)
-        vec = self.ratevector(pars)
+        #copied, the rate vector may reuse its output array
+        vec = np.copy(self.ratevector(pars))
         return ToyMCExperiment(pars, vec)
+
+    def generate_batch(self, n, poisson=False):
+        """Returns a ToyMCBatch of n experiments.
+        The parameters are the same as n calls to the generator. If poisson is True each bin of the rate vectors is 
+        replaced by a Poisson distributed number of events.
+        """
+        pars = self.generator.generate(n)
+        vec = evaluate_batch(self.ratevector, pars)
+        if poisson:
+            #negative predictions are treated as zero
+            vec = self._rng.poisson(np.maximum(vec, 0.0)).astype(float)
+        return ToyMCBatch(pars, vec)
     
     def _infostring(self):
         sio = StringIO.StringIO()
@@ -98,11 +159,171 @@ def generate_timed(toymc, maxseconds, maxevents=None, name=None):
 
 ################################################################################
 
-def generate_events(toymc, n, name=None):
-        if name is None:
-            iterN = xrange(n)
+def evaluate_batch(ratevector, pars):
+    """Returns the [n, nbins] rate vectors for [n, npars] parameters.
+    ratevector.eval_batch is used if it exists, otherwise ratevector is called once for each row.
+    """
+    evalbatch = getattr(ratevector, "eval_batch", None)
+    if evalbatch is not None:
+        return evalbatch(pars)
+    result = None
+    for ii in xrange(len(pars)):
+        #copied immediately, the rate vector may reuse its output array
+        vec = ratevector(pars[ii])
+        if result is None:
+            result = np.zeros((len(pars), len(vec)), dtype=float)
+        result[ii] = vec
+    if result is None:
+        result = np.zeros((0, 0), dtype=float)
+    return result
+
+def generate_batches(toymc, n, poisson=False, batchsize=DEFAULT_BATCH_SIZE):
+    """Yields ToyMCBatch objects with n experiments in total."""
+    for start in xrange(0, n, batchsize):
+        yield toymc.generate_batch(min(batchsize, n - start), poisson=poisson)
+    return
+
+def generate_events(toymc, n, name=None, poisson=False):
+        if hasattr(toymc, "generate_batch"):
+            #copies, so an experiment kept by the caller does not hold on to its whole batch
+            events = (exp.clone() for batch in generate_batches(toymc, n, poisson=poisson) for exp in batch)
         else:
-            iterN = printprogress(name, n, xrange(n))
-        for i in iterN:
-            yield toymc()
+            events = (toymc() for _ in xrange(n))
+        if name is not None:
+            events = printprogress(name, n, events)
+        for exp in events:
+            yield exp
         return
+
+################################################################################
+
+#the toymc, root stream and options of each running generate_parallel, inherited by the forked workers
+_PARALLEL_TASKS = {}
+_PARALLEL_KEYS = itertools.count()
+_WORKER_TOYMCS = {}
+
+def generate_parallel(toymc, n=None, maxseconds=None, nprocesses=None, ordered=True, poisson=False, seed=None, batchsize=DEFAULT_BATCH_SIZE, name=None):
+    """Yields ToyMCBatch objects thrown in nprocesses local worker processes (by default one per core).
+
+    toymc is a ToyMC or a callable, taking no arguments, that builds one. The workers are forked from this process so
+    toymc is inherited rather than pickled. A callable is called once in each worker.
+    Toys are thrown until n experiments have been returned or maxseconds have passed, whichever is first.
+    At least one of them must be given. Batches still being thrown when the time runs out are discarded.
+    With nprocesses=1 the batches are thrown in this process and a batch that has started is finished.
+    Batch i is thrown from child stream i of seed (see simplot.mc.streams), so for a given seed the batches do not 
+    depend on the number of processes. Each batch is thrown from a copy of toymc, which is left unchanged.
+    If ordered is False the batches are yielded as soon as they are ready. If name is given the progress is printed.
+    """
+    if n is None and maxseconds is None:
+        raise ValueError("generate_parallel requires a number of events or a time limit.")
+    end = None
+    if maxseconds is not None:
+        end = time.time() + maxseconds
+    tasks = _paralleltasks(n, batchsize)
+    pool = None
+    key = next(_PARALLEL_KEYS)
+    _PARALLEL_TASKS[key] = (toymc, asstream(seed), poisson)
+    nprocesses = numprocesses(nprocesses)
+    try:
+        if nprocesses <= 1:
+            batches = _localbatches(key, tasks, end)
+        else:
+            pool = multiprocessing.Pool(nprocesses)
+            batches = _poolbatches(pool, key, tasks, ordered, 2 * nprocesses, end)
+        for batch in _parallelprogress(name, n, batchsize, maxseconds, batches):
+            if end is not None and time.time() >= end:
+                break
+            yield batch
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        del _PARALLEL_TASKS[key]
+        _WORKER_TOYMCS.pop(key, None)
+    return
+
+def _paralleltasks(n, batchsize):
+    if n is None:
+        return ((index, batchsize) for index in itertools.count())
+    return ((index, min(batchsize, n - start)) for index, start in enumerate(xrange(0, n, batchsize)))
+
+def _throwbatch(key, index, size):
+    toymc, stream, poisson = _PARALLEL_TASKS[key]
+    if key not in _WORKER_TOYMCS:
+        _WORKER_TOYMCS[key] = toymc.clone() if isinstance(toymc, ToyMC) else toymc()
+    worker = _WORKER_TOYMCS[key]
+    worker.seed(stream.child(index))
+    return worker.generate_batch(size, poisson=poisson)
+
+def _poolthrow(task):
+    #exceptions are returned with their traceback from the worker
+    key, index, size = task
+    try:
+        return index, _throwbatch(key, index, size), None
+    except Exception:
+        return index, None, traceback.format_exc()
+
+def _localbatches(key, tasks, end):
+    for index, size in tasks:
+        if end is not None and time.time() >= end:
+            return
+        yield _throwbatch(key, index, size)
+    return
+
+def _poolbatches(pool, key, tasks, ordered, window, end):
+    #at most window batches are thrown ahead of the next one to be returned,
+    #so an unlimited number of tasks can be thrown against a time limit
+    #a task lost with its worker never finishes, so the workers are checked while waiting
+    workers = list(pool._pool)
+    tasks = iter(tasks)
+    pending = {}
+    finished = {}
+    nextindex = 0
+    submitted = 0
+    exhausted = False
+    while True:
+        while not exhausted and submitted - nextindex < window:
+            task = next(tasks, None)
+            if task is None:
+                exhausted = True
+            else:
+                pending[task[0]] = pool.apply_async(_poolthrow, ((key,) + task,))
+                submitted += 1
+        if nextindex == submitted:
+            return
+        ready = [index for index, result in pending.iteritems() if result.ready()]
+        if not ready:
+            if end is not None and time.time() >= end:
+                #out of time
+                return
+            if any(w.exitcode is not None for w in workers):
+                raise RuntimeError("generate_parallel worker died", [w.exitcode for w in workers])
+            timeout = _POLL_SECONDS
+            if end is not None:
+                timeout = min(timeout, max(end - time.time(), 0.0))
+            pending[min(pending)].wait(timeout)
+            continue
+        for index in sorted(ready):
+            #raises if the result could not be returned from the worker
+            index, batch, error = pending.pop(index).get()
+            if error is not None:
+                raise RuntimeError("generate_parallel worker failed", error)
+            if ordered:
+                finished[index] = batch
+                while nextindex in finished:
+                    nextindex += 1
+                    yield finished.pop(nextindex - 1)
+            else:
+                nextindex += 1
+                yield batch
+    return
+
+def _parallelprogress(name, n, batchsize, maxseconds, batches):
+    if name is None:
+        return batches
+    if n is None:
+        fmt = "%Y-%m-%d %H:%M:%S"
+        start = time.time()
+        print name + " start =", datetime.datetime.fromtimestamp(start).strftime(fmt), " expected end =", datetime.datetime.fromtimestamp(start + maxseconds).strftime(fmt)
+        return batches
+    return printprogress(name, len(xrange(0, n, batchsize)), batches, update=True)
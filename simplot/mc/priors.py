@@ -1,6 +1,7 @@
 import math
 
 from simplot.mc.generators import GaussianGenerator, MultiVariateGaussianGenerator, UniformGenerator, GeneratorList
+from simplot.mc.streams import derive_streams
 from simplot.mc.likelihood import GaussianLikelihood, MultiVariateGaussianLikelihood, CombinedLikelihood, ConstantLikelihood
 from simplot.pdg import PdgNeutrinoOscillationParameters
 from simplot.binnedmodel.sample import OscParMode
@@ -43,8 +44,6 @@ class OscillationParametersPrior(CombinedPrior):
         super(OscillationParametersPrior, self).__init__(priors)
         
     def _buildpriors(self, values, usereactorconstraint, seed=None, oscparmode=OscParMode.SINSQTHETA):
-        if seed is not None:
-            seed = seed + 230932904 # offset seed, incase user is giving sequential seeds to various generators.
         priors = []
         if oscparmode == OscParMode.SINSQTHETA:
             parnames = type(values).ALL_PARS_SINSQ
@@ -52,9 +51,11 @@ class OscillationParametersPrior(CombinedPrior):
             parnames = type(values).ALL_PARS_SINSQ2
         else:
             parnames = type(values).ALL_PARS
-        for p in parnames:
-            if seed is not None:
-                seed += 1
+        #each parameter gets an independent child stream of seed
+        seeds = [None] * len(parnames)
+        if seed is not None:
+            seeds = derive_streams(seed, len(parnames))
+        for p, seed in zip(parnames, seeds):
             val = values.value(p)
             err = values.error(p)
             if p == type(values).DELTACP:
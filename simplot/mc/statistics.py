@@ -1,6 +1,5 @@
 # cython: profile=True
 
-import itertools
 import collections
 from operator import attrgetter
 
@@ -8,19 +7,58 @@ import numpy as np
 import ROOT
 
 from simplot.progress import printprogress
+from simplot.mc.montecarlo import generate_batches, generate_events, DEFAULT_BATCH_SIZE
+from simplot.mc.generators import MultiVariateGaussianGenerator
+from simplot.mc.likelihood import MultiVariateGaussianLikelihood
 
 ###############################################################################
 
-def calculate_statistics_from_toymc(toymc, statistics, npe, transform=None, name=None):
+def calculate_statistics_from_toymc(toymc, statistics, npe, transform=None, name=None, poisson=False):
+    """Fills the statistics with npe toys thrown in batches (see ToyMC.generate_batch).
+    If transform is None the statistics are filled with the rate vectors, a batch at a time for statistics with add_batch.
+    Otherwise they are filled with transform(ToyMCExperiment).
+    """
+    if not hasattr(toymc, "generate_batch"):
+        if transform is None:
+            transform = attrgetter("vec")
+        return calculate_statistics(toymc, statistics, npe, transform=transform, name=name)
+    statistics = _aslist(statistics)
     if transform is None:
-        transform = attrgetter("vec")
-    return calculate_statistics(toymc, statistics, npe, transform=transform, name=name)
+        batches = generate_batches(toymc, npe, poisson=poisson)
+        if name is not None:
+            batches = printprogress(name, len(xrange(0, npe, DEFAULT_BATCH_SIZE)), batches, update=True)
+        for batch in batches:
+            add_batch(statistics, batch.vec)
+    else:
+        events = generate_events(toymc, npe, poisson=poisson)
+        if name is not None:
+            events = printprogress(name, npe, events, update=True)
+        for exp in events:
+            exp = transform(exp)
+            for s in statistics:
+                s.add(exp)
+    return statistics
 
-def calculate_statistics(generator, statistics, npe, transform=None, name=None):
+def add_batch(statistics, vecs):
+    """Adds each row of vecs to each statistic, in one call for statistics that implement add_batch."""
+    for s in _aslist(statistics):
+        addbatch = getattr(s, "add_batch", None)
+        if addbatch is not None:
+            addbatch(vecs)
+        else:
+            for v in vecs:
+                s.add(v)
+    return statistics
+
+def _aslist(statistics):
     try:
         iter(statistics)
     except TypeError:
         statistics = [statistics]
+    return statistics
+
+def calculate_statistics(generator, statistics, npe, transform=None, name=None):
+    statistics = _aslist(statistics)
     iterable = xrange(npe)
     if name is not None:
         iterable = printprogress(name, npe, iterable, update=True)
@@ -49,6 +87,51 @@ def safedivide(lhs, rhs):
     r[r==0] = 1.0
     return l / r
 
+def fractional_covariance(cov, mu):
+    """Returns cov[i,j] / (mu[i] mu[j]), with 0.0 where the product of the means is zero."""
+    return safedivide(cov, np.outer(mu, mu))
+
+def correlation_matrix(cov):
+    """Returns cov[i,j] / sqrt(cov[i,i] cov[j,j]), with 0.0 where either variance is zero."""
+    variance = np.diag(cov)
+    return safedivide(cov, np.sqrt(np.outer(variance, variance)))
+
+def covariance_error(cov, count):
+    """Returns the statistical error on each element of a covariance matrix estimated from count toys.
+    The diagonal error is sqrt(2) cov[i,i] / sqrt(count) and the off-diagonal error is
+    sqrt((1 + |corr[i,j]|) cov[i,i] cov[j,j] / count).
+    """
+    cov = np.asarray(cov)
+    variance = np.diag(cov)
+    product = np.outer(variance, variance)
+    corr = safedivide(cov, np.sqrt(product))
+    result = np.sqrt((1.0 + np.abs(corr)) * np.divide(product, count))
+    diagonal = np.arange(len(variance))
+    result[diagonal, diagonal] = np.multiply(np.sqrt(2), np.divide(variance, np.sqrt(count)))
+    return result
+
+###############################################################################
+
+def _combine(obj, count, mean, m2, outer):
+    """Adds a partial result (count, mean, sum of squared deviations m2) to obj (Chan et al. pairwise update)."""
+    if count == 0:
+        return
+    if obj._count == 0:
+        obj._count = count
+        obj._mu = np.array(mean, dtype=float)
+        obj._m2 = np.array(m2, dtype=float)
+        return
+    total = obj._count + count
+    delta = mean - obj._mu
+    obj._m2 += m2
+    obj._m2 += outer(delta, delta) * (obj._count * (count / float(total)))
+    obj._mu += delta * (count / float(total))
+    obj._count = total
+    return
+
+def _elementwise(a, b):
+    return a * b
+
 ###############################################################################
 
 class Mean(object):
@@ -57,6 +140,13 @@ class Mean(object):
     
     def add(self, vec):
         self._rms.add(vec) 
+
+    def add_batch(self, vecs):
+        self._rms.add_batch(vecs)
+
+    def merge(self, other):
+        self._rms.merge(other._rms)
+        return self
     
     def eval(self):
         return self._rms._mean()
@@ -68,32 +158,47 @@ class Mean(object):
 ###############################################################################
 
 class StandardDeviation(object):
+    """Accumulates the mean and the sum of squared deviations from the mean of each element (Welford's algorithm),
+    avoiding the cancellation in E[x^2] - E[x]^2. Partial results are combined exactly with merge.
+    """
     def __init__(self, ndbinning=None, projection=None):
         self._ndbinning = ndbinning
         self._projection = projection
-        self._sumw = None
-        self._sumw2 = None
+        self._mu = None
+        self._m2 = None
         self._count = 0
     
     def add(self, vec):
+        vec = np.array(vec, dtype=float)
+        if self._count == 0:
+            _combine(self, 1, vec, np.zeros_like(vec), _elementwise)
+            return
         self._count += 1
-        try:
-            self._sumw += vec
-            self._sumw2 += np.power(vec, 2)
-        except TypeError:
-            self._sumw = np.copy(vec)
-            self._sumw2 = np.power(vec, 2)
+        delta = vec - self._mu
+        self._mu += delta / self._count
+        self._m2 += delta * delta * ((self._count - 1.0) / self._count)
+        return
+
+    def add_batch(self, vecs):
+        """Adds each row of the [n, nbins] array vecs."""
+        vecs = np.asarray(vecs, dtype=float)
+        if len(vecs) == 0:
+            return
+        mean = np.mean(vecs, axis=0)
+        deviations = vecs - mean
+        _combine(self, len(vecs), mean, np.einsum("ij,ij->j", deviations, deviations), _elementwise)
         return
+
+    def merge(self, other):
+        """Adds the result accumulated by other (for example in another process) to this object."""
+        _combine(self, other._count, other._mu, other._m2, _elementwise)
+        return self
     
     def _mean(self):
-        return np.divide(self._sumw, float(self._count))
+        return np.copy(self._mu)
         
     def eval(self):
-        mean = self._mean()
-        mean2 = np.power(mean, 2)
-        avgsum2 = self._sumw2 / float(self._count)
-        rms = np.sqrt(np.abs(avgsum2 - mean2))
-        return rms
+        return np.sqrt(self._m2 / float(self._count))
 
     def err(self):
         rms = self.eval()
@@ -102,67 +207,193 @@ class StandardDeviation(object):
 ###############################################################################
 
 class Covariance(object):
+    """Accumulates the mean and the matrix of summed products of deviations from the mean (Welford's algorithm).
+    Batches are added with one matrix product and partial results are combined exactly with merge.
+    """
     def __init__(self, fractional=False):
-        self._sumw = None
-        self._sumw2 = None
+        self._mu = None
+        self._m2 = None
         self._count = 0
         self._fractional = fractional
     
     def add(self, vec):
-        vec = np.array(vec, copy=False) # convert to vec
+        vec = np.array(vec, dtype=float)
+        if self._count == 0:
+            _combine(self, 1, vec, np.zeros((len(vec), len(vec))), np.outer)
+            return
         self._count += 1
-        try:
-            self._sumw += vec
-            self._sumw2 += self._product(vec, vec)
-        except TypeError:
-            self._sumw = np.copy(vec)
-            self._sumw2 = self._product(vec, vec)
+        delta = vec - self._mu
+        self._mu += delta / self._count
+        self._m2 += np.outer(delta, delta * ((self._count - 1.0) / self._count))
         return
-    
-    def _product(self, a, b):
-        #return np.array([bi * a for bi in b])
-        ax = a.reshape((a.shape[0], 1))
-        bx = b.reshape((b.shape[0], 1))
-        return np.dot(ax, bx.T)
+
+    def add_batch(self, vecs):
+        """Adds each row of the [n, nbins] array vecs."""
+        vecs = np.asarray(vecs, dtype=float)
+        if len(vecs) == 0:
+            return
+        mean = np.mean(vecs, axis=0)
+        deviations = vecs - mean
+        _combine(self, len(vecs), mean, np.dot(deviations.T, deviations), np.outer)
+        return
+
+    def merge(self, other):
+        """Adds the result accumulated by other (for example in another process) to this object."""
+        _combine(self, other._count, other._mu, other._m2, np.outer)
+        return self
     
     def _mean(self):
-        return np.divide(self._sumw, float(self._count))
+        return np.copy(self._mu)
         
     def eval(self):
-        mean = self._mean()
-        mean2 = self._product(mean, mean)
-        avgsum2 = self._sumw2 / float(self._count)
-        rms = avgsum2 - mean2
+        rms = self._m2 / float(self._count)
         if self._fractional:
-            #rms /= mean2
-            rms = safedivide(rms, mean2)
+            rms = fractional_covariance(rms, self._mu)
         return rms
 
     def err(self):
-        cov = self.eval()
-        result = np.copy(cov)
-        for ii, jj in itertools.product(xrange(cov.shape[0]), xrange(cov.shape[1])):
-            result[ii,jj] = self._calcerr(cov, ii, jj, self._count)
-        return result
-
-    def _calcerr(self, cov, ii, jj, N):
-        if ii == jj:
-            return np.multiply(np.sqrt(2), np.divide(cov[ii][jj], np.sqrt(N)))
+        return covariance_error(self.eval(), self._count)
+
+    def correlation(self):
+        return correlation_matrix(self._m2)
+
+###############################################################################
+
+class LowRankCovariance(object):
+    """Accumulates the leading rank principal components of the covariance and its exact diagonal
+    in O(nbins * rank) memory, for covariance matrices too large to store.
+
+    The matrix of summed products of deviations is kept as a sketch B of rank + oversample rows with B^T B ~ M2.
+    Each toy (or batch, or merged partial result) adds rows to B, which is compressed with a truncated SVD
+    whenever rank + oversample rows are waiting. The covariance is approximated by W W^T + diag(residual),
+    where the residual restores the exact variance of each bin.
+    """
+    def __init__(self, rank, oversample=10, fractional=False):
+        self._rank = rank
+        self._size = rank + oversample
+        self._fractional = fractional
+        self._mu = None
+        self._m2 = None
+        self._count = 0
+        self._sketch = None
+        self._pending = []
+        self._npending = 0
+
+    def add(self, vec):
+        vec = np.array(vec, dtype=float)
+        if self._count == 0:
+            self._addpartial(1, vec, np.zeros_like(vec), None)
+            return
+        self._count += 1
+        delta = vec - self._mu
+        self._mu += delta / self._count
+        row = delta * np.sqrt((self._count - 1.0) / self._count)
+        self._m2 += row * row
+        self._append(row[np.newaxis, :])
+        return
+
+    def add_batch(self, vecs):
+        """Adds each row of the [n, nbins] array vecs."""
+        vecs = np.asarray(vecs, dtype=float)
+        if len(vecs) == 0:
+            return
+        mean = np.mean(vecs, axis=0)
+        deviations = vecs - mean
+        self._addpartial(len(vecs), mean, np.einsum("ij,ij->j", deviations, deviations), [deviations])
+        return
+
+    def merge(self, other):
+        """Adds the result accumulated by other (for example in another process) to this object."""
+        rows = list(other._pending)
+        if other._sketch is not None:
+            rows.append(other._sketch)
+        self._addpartial(other._count, other._mu, other._m2, rows)
+        return self
+
+    def _addpartial(self, count, mean, m2, rows):
+        if count == 0:
+            return
+        if self._count == 0:
+            self._sketch = np.zeros((0, len(mean)))
         else:
-            #no correlations
-            #return np.divide(np.sqrt(cov[ii][ii]*cov[jj][jj]), np.sqrt(N))
-            #with correlations
-            uncorrterm = np.divide(np.array(cov[ii][ii]*cov[jj][jj]), N)
-            corr = cov[ii][jj]
-            denominator = np.sqrt(cov[ii][ii]*cov[jj][jj])
-            if denominator != 0.0:
-                corr /= denominator
-            else:
-                #at least one of the variances is zero, set correlation to 0.0
-                corr = 0.0 
-            errsq = (1.0 + abs(corr)) * uncorrterm
-            ret = np.sqrt(errsq)
-            return ret
+            #the shift between the two means adds one rank-one term to M2
+            correction = (mean - self._mu) * np.sqrt(self._count * (count / float(self._count + count)))
+            rows = (rows or []) + [correction[np.newaxis, :]]
+        _combine(self, count, mean, m2, _elementwise)
+        for r in (rows or []):
+            self._append(r)
+        return
+
+    def _append(self, rows):
+        self._pending.append(rows)
+        self._npending += len(rows)
+        if self._npending >= self._size:
+            self._compress()
+        return
+
+    def _compress(self):
+        if self._npending == 0:
+            return
+        pending = np.vstack(self._pending)
+        self._pending = []
+        self._npending = 0
+        #fold in at most self._size rows at a time so each SVD costs O(nbins * size^2)
+        for start in xrange(0, len(pending), self._size):
+            stacked = np.vstack([self._sketch, pending[start:start + self._size]])
+            _, s, vt = np.linalg.svd(stacked, full_matrices=False)
+            self._sketch = s[:self._size, np.newaxis] * vt[:self._size]
+        return
+
+    def _mean(self):
+        return np.copy(self._mu)
+
+    def components(self):
+        """Returns (eigenvalues, [nbins, rank] eigenvectors) of the leading principal components of the (absolute) covariance."""
+        self._compress()
+        _, s, vt = np.linalg.svd(self._sketch, full_matrices=False)
+        return np.power(s[:self._rank], 2) / float(self._count), vt[:self._rank].T
+
+    def factors(self):
+        """Returns (W, residual), the [nbins, rank] factor and [nbins] diagonal with covariance ~ W W^T + diag(residual)."""
+        eigenvalues, vectors = self.components()
+        factor = vectors * np.sqrt(eigenvalues)
+        residual = self._m2 / float(self._count) - np.sum(np.power(factor, 2), axis=1)
+        residual = np.maximum(residual, 0.0)
+        if self._fractional:
+            scale = safedivide(np.ones_like(self._mu), self._mu)
+            factor = factor * scale[:, np.newaxis]
+            residual = residual * np.power(scale, 2)
+        return factor, residual
+
+    def matvec(self, x):
+        """Returns the product of the covariance with x (a [nbins] vector or [nbins, m] matrix) without building the matrix."""
+        factor, residual = self.factors()
+        x = np.asarray(x, dtype=float)
+        return np.dot(factor, np.dot(factor.T, x)) + (residual * x.T).T
+
+    def eval(self):
+        """Returns the dense [nbins, nbins] approximation of the covariance."""
+        factor, residual = self.factors()
+        return np.dot(factor, factor.T) + np.diag(residual)
+
+    def _centre(self, mu):
+        if mu is not None:
+            return mu
+        if self._fractional:
+            return np.ones_like(self._mu)
+        return self._mean()
+
+    def generator(self, parameter_names, mu=None, seed=None):
+        """Returns a MultiVariateGaussianGenerator throwing from the factored covariance.
+        By default it is centred on the mean or, for a fractional covariance, on ones.
+        """
+        factor, residual = self.factors()
+        return MultiVariateGaussianGenerator.fromfactors(parameter_names, self._centre(mu), factor, residual, seed=seed)
+
+    def likelihood(self, parameter_names, mu=None):
+        """Returns a MultiVariateGaussianLikelihood with the factored covariance (the residual must be positive in every bin)."""
+        factor, residual = self.factors()
+        return MultiVariateGaussianLikelihood.fromfactors(parameter_names, self._centre(mu), factor, residual)
 
 ###############################################################################
 
@@ -216,3 +447,277 @@ class RootHistogram(object):
     def eval(self):
         return self._hist.values()
 
+
+###############################################################################
+
+def _interpolate_rows(q, count, positions, values):
+    """Returns the value at cumulative count q * count of each row, [nrows] for scalar q or [len(q), nrows]."""
+    targets = np.asarray(q, dtype=float) * count
+    result = np.array([np.interp(targets, x, y) for x, y in zip(positions, values)])
+    return result.T
+
+class _QuantileEstimator(object):
+    def quantile(self, q):
+        raise NotImplementedError("Sub-class must override this method.")
+
+    def interval(self, cl=0.6827):
+        """Returns the (lower, upper) edges of the central interval containing a fraction cl of the toys in each element."""
+        return self.quantile(0.5 * (1.0 - cl)), self.quantile(0.5 * (1.0 + cl))
+
+###############################################################################
+
+class QuantileDigest(_QuantileEstimator):
+    """Estimates quantiles of each element without storing the toys (a merging t-digest, vectorised over elements).
+
+    Adjacent points are merged into a centroid only while the centroid spans at most one unit of the scale function
+    k(q) = delta / (2 pi) asin(2q - 1), and the smallest and largest points are always kept as single-point centroids.
+    Each element is summarised by about delta / 2 weighted centroids, small in the tails and large near the median,
+    so memory is O(nelements * delta) and the relative accuracy is best for extreme quantiles.
+    Toys are buffered and folded into the centroids buffersize at a time. Digests are combined with merge.
+    """
+    def __init__(self, probabilities=(0.1587, 0.5, 0.8413), delta=200, buffersize=1000):
+        self._probabilities = probabilities
+        self._delta = float(delta)
+        self._buffersize = buffersize
+        self._means = None
+        self._weights = None
+        self._min = None
+        self._max = None
+        self._buffer = []
+        self._nbuffered = 0
+        self._count = 0
+
+    def add(self, vec):
+        self.add_batch(np.asarray(vec, dtype=float)[np.newaxis, :])
+        return
+
+    def add_batch(self, vecs):
+        """Adds each row of the [n, nelements] array vecs."""
+        vecs = np.asarray(vecs, dtype=float)
+        if len(vecs) == 0:
+            return
+        self._updaterange(np.min(vecs, axis=0), np.max(vecs, axis=0))
+        self._buffer.append(vecs)
+        self._nbuffered += len(vecs)
+        self._count += len(vecs)
+        if self._nbuffered >= self._buffersize:
+            self._flush()
+        return
+
+    def merge(self, other):
+        """Adds the toys summarised by other (for example in another process) to this object."""
+        if other._count == 0:
+            return self
+        means, weights = self._pending()
+        othermeans, otherweights = other._pending()
+        if means is not None:
+            othermeans = np.hstack([means, othermeans])
+            otherweights = np.hstack([weights, otherweights])
+        self._compress(othermeans, otherweights)
+        self._updaterange(other._min, other._max)
+        self._buffer = []
+        self._nbuffered = 0
+        self._count += other._count
+        return self
+
+    def _updaterange(self, low, high):
+        if self._min is None:
+            self._min = np.array(low, dtype=float)
+            self._max = np.array(high, dtype=float)
+        else:
+            np.minimum(self._min, low, self._min)
+            np.maximum(self._max, high, self._max)
+        return
+
+    def _pending(self):
+        #the centroids and the buffered toys (each a centroid of weight one) as [nelements, m] arrays
+        means = [] if self._means is None else [self._means]
+        weights = [] if self._weights is None else [self._weights]
+        if self._nbuffered > 0:
+            buffered = np.vstack(self._buffer).T
+            means.append(buffered)
+            weights.append(np.ones_like(buffered))
+        if len(means) == 0:
+            return None, None
+        return np.hstack(means), np.hstack(weights)
+
+    def _flush(self):
+        if self._nbuffered > 0:
+            self._compress(*self._pending())
+            self._buffer = []
+            self._nbuffered = 0
+        return
+
+    def _scale(self, q):
+        return self._delta / (2.0 * np.pi) * np.arcsin(np.clip(2.0 * q - 1.0, -1.0, 1.0))
+
+    def _compress(self, means, weights):
+        nelements, npoints = means.shape
+        rows = np.arange(nelements)
+        #sort each element, with empty (zero weight) centroids last
+        order = np.argsort(np.where(weights > 0.0, means, np.inf), axis=1, kind="mergesort")
+        means = means[rows[:, np.newaxis], order]
+        weights = weights[rows[:, np.newaxis], order]
+        total = np.sum(weights, axis=1)
+        last = np.sum(weights > 0.0, axis=1) - 1
+        outweights = np.zeros((nelements, npoints))
+        outsums = np.zeros((nelements, npoints))
+        #the centroid being built in each element, and the cumulative weight to its left
+        current = np.zeros(nelements, dtype=int)
+        weight = np.zeros(nelements)
+        wsum = np.zeros(nelements)
+        left = np.zeros(nelements)
+        kleft = self._scale(left)
+        for jj in xrange(npoints):
+            w = weights[:, jj]
+            x = np.where(w > 0.0, means[:, jj], 0.0)
+            #merge while the centroid spans at most one unit of k, never into the first or last point
+            join = (self._scale((left + weight + w) / total) - kleft <= 1.0) & (left > 0.0) & (jj < last)
+            join |= (weight == 0.0) | (w == 0.0)
+            start = ~join
+            if np.any(start):
+                outweights[rows[start], current[start]] = weight[start]
+                outsums[rows[start], current[start]] = wsum[start]
+                current[start] += 1
+                left[start] += weight[start]
+                kleft[start] = self._scale(left[start] / total[start])
+                weight[start] = 0.0
+                wsum[start] = 0.0
+            weight += w
+            wsum += w * x
+        outweights[rows, current] = weight
+        outsums[rows, current] = wsum
+        ncentroids = np.max(current) + 1
+        self._weights = outweights[:, :ncentroids]
+        self._means = safedivide(outsums[:, :ncentroids], self._weights)
+        return
+
+    def quantile(self, q):
+        """Returns the q quantile of each element, [nelements] for scalar q or [len(q), nelements]."""
+        self._flush()
+        positions = []
+        values = []
+        for means, weights, low, high in zip(self._means, self._weights, self._min, self._max):
+            nonzero = weights > 0.0
+            means = means[nonzero]
+            weights = weights[nonzero]
+            #each centroid sits at the cumulative weight of its centre
+            positions.append(np.concatenate([[0.0], np.cumsum(weights) - 0.5 * weights, [self._count]]))
+            values.append(np.concatenate([[low], means, [high]]))
+        return _interpolate_rows(q, self._count, positions, values)
+
+    def eval(self):
+        return self.quantile(self._probabilities)
+
+###############################################################################
+
+class Histogram(_QuantileEstimator):
+    """Histograms each element of the toys into one [nelements, nbins] numpy array, filled a batch at a time.
+
+    range is (xmin, xmax), or a list with one (xmin, xmax) per element. If range is None the range of each element
+    is set from the first buffersize toys. Histograms with the same binning are combined with merge, so give the range
+    explicitly for parallel runs.
+    """
+    def __init__(self, nbins=100, range=None, buffersize=1000):
+        self._nbins = nbins
+        self._range = range
+        self._buffersize = buffersize
+        self._low = None
+        self._width = None
+        #counts includes the underflow (first) and overflow (last) bins
+        self._counts = None
+        self._buffer = []
+        self._nbuffered = 0
+        self._count = 0
+
+    def add(self, vec):
+        self.add_batch(np.asarray(vec, dtype=float)[np.newaxis, :])
+        return
+
+    def add_batch(self, vecs):
+        """Adds each row of the [n, nelements] array vecs."""
+        vecs = np.asarray(vecs, dtype=float)
+        if len(vecs) == 0:
+            return
+        self._count += len(vecs)
+        if self._counts is not None:
+            self._fill(vecs)
+            return
+        self._buffer.append(vecs)
+        self._nbuffered += len(vecs)
+        if self._range is not None or self._nbuffered >= self._buffersize:
+            self._flush()
+        return
+
+    def merge(self, other):
+        """Adds the histograms filled by other (for example in another process) to this object."""
+        if other._counts is None:
+            for vecs in other._buffer:
+                self.add_batch(vecs)
+            return self
+        if self._counts is None:
+            self._setbinning(other._low, other._low + other._width * self._nbins)
+            self._fillbuffer()
+        elif not (np.array_equal(self._low, other._low) and np.array_equal(self._width, other._width)):
+            raise ValueError("Histogram.merge requires histograms with the same binning")
+        self._counts += other._counts
+        self._count += other._count
+        return self
+
+    def _flush(self):
+        if self._counts is None and self._nbuffered > 0:
+            buffered = np.vstack(self._buffer)
+            if self._range is None:
+                low = np.min(buffered, axis=0)
+                high = np.max(buffered, axis=0)
+                pad = 0.05 * (high - low)
+                #constant elements get a unit range
+                pad[pad == 0.0] = 0.5
+                self._setbinning(low - pad, high + pad)
+            else:
+                limits = np.asarray(self._range, dtype=float) * np.ones((buffered.shape[1], 2))
+                self._setbinning(limits[:, 0], limits[:, 1])
+        self._fillbuffer()
+        return
+
+    def _setbinning(self, low, high):
+        self._low = np.array(low, dtype=float)
+        self._width = (np.asarray(high, dtype=float) - self._low) / self._nbins
+        self._counts = np.zeros((len(self._low), self._nbins + 2))
+        return
+
+    def _fillbuffer(self):
+        for vecs in self._buffer:
+            self._fill(vecs)
+        self._buffer = []
+        self._nbuffered = 0
+        return
+
+    def _fill(self, vecs):
+        nelements, ncolumns = self._counts.shape
+        index = np.clip(np.floor((vecs - self._low) / self._width), -1, self._nbins).astype(int) + 1
+        index += np.arange(nelements) * ncolumns
+        self._counts += np.bincount(index.ravel(), minlength=self._counts.size).reshape(self._counts.shape)
+        return
+
+    def edges(self):
+        """Returns the [nelements, nbins + 1] bin edges."""
+        self._flush()
+        return self._low[:, np.newaxis] + self._width[:, np.newaxis] * np.arange(self._nbins + 1)
+
+    def outofrange(self):
+        """Returns the (underflow, overflow) counts of each element."""
+        self._flush()
+        return np.copy(self._counts[:, 0]), np.copy(self._counts[:, -1])
+
+    def quantile(self, q):
+        """Returns the q quantile of each element interpolated within the bins, [nelements] for scalar q or [len(q), nelements]."""
+        self._flush()
+        #cumulative count at each bin edge, starting from the underflow
+        cumulative = np.cumsum(self._counts[:, :-1], axis=1)
+        return _interpolate_rows(q, self._count, cumulative, self.edges())
+
+    def eval(self):
+        """Returns the [nelements, nbins] counts."""
+        self._flush()
+        return np.copy(self._counts[:, 1:-1])
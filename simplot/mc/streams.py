@@ -0,0 +1,79 @@
+"""Reproducible, independent random number streams for generators, samplers and worker processes.
+
+A RandomStream is identified by a root seed and a key, a tuple of integers giving its position in a tree of streams.
+The Mersenne Twister state of a stream is initialised from a SHA-256 hash of (seed, key).
+Child streams are spawned by extending the key, so they do not depend on how many numbers were drawn from the parent,
+and streams with different keys are statistically independent (the same scheme as numpy's SeedSequence).
+
+Anything in simplot that takes a seed accepts None, an integer, a RandomStream or a numpy RandomState.
+"""
+
+import hashlib
+import os
+import struct
+
+import numpy as np
+
+###############################################################################
+
+class RandomStream(object):
+    def __init__(self, seed=None, key=()):
+        """If seed is None a root seed is drawn from the operating system entropy pool."""
+        if seed is None:
+            seed = struct.unpack("<Q", os.urandom(8))[0]
+        self.seed = int(seed)
+        self.key = tuple(int(k) for k in key)
+        self._numspawned = 0
+
+    def child(self, index):
+        """Returns the child stream with this index. The same index always gives the same stream."""
+        return RandomStream(self.seed, self.key + (index,))
+
+    def spawn(self, n):
+        """Returns n new child streams, different from all children spawned before from this stream."""
+        result = [self.child(self._numspawned + ii) for ii in xrange(n)]
+        self._numspawned += n
+        return result
+
+    def randomstate(self):
+        """Returns a new numpy RandomState at the start of this stream."""
+        return np.random.RandomState(self._entropy())
+
+    def _entropy(self):
+        digest = hashlib.sha256(repr((self.seed, self.key))).digest()
+        return np.frombuffer(digest, dtype="<u4").astype(np.uint32)
+
+    def __eq__(self, other):
+        return isinstance(other, RandomStream) and self.seed == other.seed and self.key == other.key
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.seed, self.key))
+
+    def __repr__(self):
+        return "RandomStream(%s, key=%s)" % (self.seed, self.key)
+
+###############################################################################
+
+def asstream(seed):
+    """Returns seed if it is a RandomStream, otherwise the root stream with that (integer or None) seed."""
+    if isinstance(seed, RandomStream):
+        return seed
+    return RandomStream(seed)
+
+def randomstate(seed=None):
+    """Returns a numpy RandomState for seed, which is None, an integer, a RandomStream or a RandomState (returned as is)."""
+    if isinstance(seed, np.random.RandomState):
+        return seed
+    if isinstance(seed, RandomStream):
+        return seed.randomstate()
+    return np.random.RandomState(seed=seed)
+
+def derive_streams(seed, n):
+    """Returns n independent child streams of seed (None, an integer or a RandomStream).
+    The result only depends on seed, so calling this again with the same seed gives the same streams.
+    """
+    stream = asstream(seed)
+    return [stream.child(ii) for ii in xrange(n)]
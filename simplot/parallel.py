@@ -0,0 +1,59 @@
+"""Utilities to evaluate a function over a pool of local worker processes.
+
+The worker processes are forked from the calling process. The function and its
+inputs are inherited by the workers rather than pickled, so they may be closures
+or hold objects (such as ROOT objects) that cannot be pickled.
+Only the return values are pickled and sent back to the calling process.
+"""
+
+import multiprocessing
+
+from simplot.progress import printprogress
+
+###############################################################################
+
+_TASK = None
+
+def _runtask(index):
+    func, items = _TASK
+    return func(items[index])
+
+###############################################################################
+
+def numprocesses(nprocesses=None):
+    """Returns the number of worker processes to use. If nprocesses is None all cores on this machine are used."""
+    if nprocesses is None:
+        nprocesses = multiprocessing.cpu_count()
+    if nprocesses <= 0:
+        raise ValueError("number of processes must be greater than 0. ({0} given)".format(nprocesses))
+    return nprocesses
+
+def parallel_map(func, items, nprocesses=None, name=None):
+    """Returns [func(x) for x in items] evaluated in nprocesses worker processes.
+
+    The results are returned in the same order as the input items.
+    If only one process is required the function is evaluated in this process.
+    If name is given the progress is printed with simplot.progress.printprogress.
+    """
+    global _TASK
+    items = list(items)
+    nprocesses = min(numprocesses(nprocesses), len(items))
+    if nprocesses <= 1:
+        return [func(x) for x in _progress(name, len(items), items)]
+    _TASK = (func, items)
+    pool = multiprocessing.Pool(nprocesses)
+    try:
+        result = list(_progress(name, len(items), pool.imap(_runtask, xrange(len(items)), chunksize=1)))
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        _TASK = None
+    return result
+
+def _progress(name, num_entries, iterable):
+    if name is not None:
+        iterable = printprogress(name, num_entries, iterable, update=True)
+    return iterable
@@ -560,6 +560,60 @@ class ProcessTreeSubset(ProcessTree):
 
 ###############################################################################
 
+class TreeChunkReader(object):
+    def __init__(self, infilelist, treename, branches, chunksize=100000, n_max=None, dtype=numpy.float64):
+        '''Iterates over the input trees in blocks of at most chunksize entries.
+        Each block is a dict mapping branch name to a numpy array, only the requested (scalar) branches are read.
+        Memory use is set by the chunk size rather than the number of entries in the input files.
+        If root_numpy is available it is used to read the blocks, otherwise entries are read one at a time into
+        preallocated arrays.
+        '''
+        self.filelist = _expand_file_patterns(infilelist)
+        self._treename = treename
+        self._branches = list(branches)
+        if chunksize <= 0:
+            raise ValueError("TreeChunkReader chunksize must be greater than 0.", chunksize)
+        self._chunksize = chunksize
+        self._n_max = n_max
+        self._dtype = dtype
+
+    def __iter__(self):
+        chain = ROOT.TChain(self._treename)
+        for fname in self.filelist:
+            chain.Add(fname)
+        nentries = chain.GetEntries()
+        if self._n_max is not None:
+            nentries = min(nentries, self._n_max)
+        try:
+            import root_numpy
+        except ImportError:
+            root_numpy = None
+        if root_numpy is None:
+            chain.SetBranchStatus("*", 0)
+            for name in self._branches:
+                chain.SetBranchStatus(name, 1)
+        starts = xrange(0, nentries, self._chunksize)
+        starts = progress.printprogress("TreeChunkReader "+self._treename, len(starts), starts, update=True)
+        for start in starts:
+            stop = min(start + self._chunksize, nentries)
+            if root_numpy is not None:
+                arr = root_numpy.tree2array(chain, branches=self._branches, start=start, stop=stop)
+                yield dict((name, numpy.asarray(arr[name], dtype=self._dtype)) for name in self._branches)
+            else:
+                yield self._readchunk(chain, start, stop)
+        return
+
+    def _readchunk(self, chain, start, stop):
+        chunk = [numpy.empty(stop - start, dtype=self._dtype) for name in self._branches]
+        getters = [operator.attrgetter(name) for name in self._branches]
+        for i, entry in enumerate(xrange(start, stop)):
+            chain.GetEntry(entry)
+            for column, getter in itertools.izip(chunk, getters):
+                column[i] = getter(chain)
+        return dict(itertools.izip(self._branches, chunk))
+
+###############################################################################
+
 class BranchFiller(object):
     def __init__(self, name, function, start_value=0.0, ignore_errors=False, type_=None):
         '''BranchFiller handles setting branch values on each event and is designed to be provided to a TreeFillerAlgorithm.
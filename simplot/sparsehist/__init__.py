@@ -1,4 +1,5 @@
 
 from .sparsehist import SparseHistogram
 from .sparsehist import SparseArray
+from .sparsehist import DenseArray, choose_storage, DENSE_OCCUPANCY_THRESHOLD
 
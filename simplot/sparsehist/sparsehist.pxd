@@ -28,6 +28,8 @@ cdef class SparseArray:
 #    pass
 
 cdef int array_bisect_right(vector[double]& arr, double x);
+cdef uint64_t broadcast_key(vector[uint64_t]& shape, vector[uint64_t]& dimscale, uint64_t key) nogil;
+cdef double find_value(SparseArrayContainer& data, uint64_t key) nogil;
 cdef SparseArray sparse_array_interpolation(double f, SparseArray y0, SparseArray y1);
 
 #cdef extern from "<algorithm>" namespace "std" nogil:
@@ -89,6 +89,9 @@ cdef class SparseArray:
     def occupancy(self):
         return float(self.actual_size())/float(self.max_size())
 
+    def todense(self, dtype=numpy.float64):
+        return DenseArray.fromsparse(self, dtype=dtype)
+
     cdef double get(self, vector[uint64_t]& index):
         cdef uint64_t key = self.key(index)
         cdef SparseArrayIterator it = self._data.find(key)
@@ -158,6 +161,10 @@ cdef class SparseArray:
         cdef vector[uint64_t] index
         cdef vector[uint64_t] newindex = newshape
         cdef uint64_t nkeep = keep.size()
+        if range_ is None:
+            with nogil:
+                _project(self, result, keep)
+            return result
         while it != end:
             key = dereference(it).first
             value = dereference(it).second
@@ -169,10 +176,17 @@ cdef class SparseArray:
             preincrement(it)
         return result
 
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
     def flatten(self):
         result = numpy.zeros(self.max_size())
-        for k, v in self._data:
-            result[k] = v
+        cdef double[:] out = result
+        cdef SparseArrayIterator it = self._data.begin()
+        cdef SparseArrayIterator end = self._data.end()
+        with nogil:
+            while it != end:
+                out[dereference(it).first] = dereference(it).second
+                preincrement(it)
         return result
 
     def _within_range(self, vector[uint64_t] index, dict range_):
@@ -194,6 +208,8 @@ cdef class SparseArray:
     @cython.profile(PROFILE_FLAG)
     def __mul__(lhs, rhs):
         # implement result = lhs * rhs
+        if isinstance(lhs, DenseArray) or isinstance(rhs, DenseArray):
+            return _mixed_multiply(lhs, rhs)
         if isinstance(lhs, float):
             lhs = _makescalar(lhs, rhs.shape())
         #convert to SparseArray
@@ -206,29 +222,39 @@ cdef class SparseArray:
             return _multiply_array_with_copy(lhs, rhs)
 
     @cython.profile(PROFILE_FLAG)
-    def __add__(SparseArray lhs, SparseArray rhs):
+    def __add__(lhs, rhs):
+        if isinstance(lhs, DenseArray) or isinstance(rhs, DenseArray):
+            return _mixed_add(lhs, rhs, 1.0)
         if not lhs.shape() == rhs.shape():
             raise Exception("cannot __add__, incompatible shape.")
         return _add_array_with_copy(lhs, rhs)
 
     @cython.profile(PROFILE_FLAG)
-    def __sub__(SparseArray lhs, SparseArray rhs):
+    def __sub__(lhs, rhs):
+        if isinstance(lhs, DenseArray) or isinstance(rhs, DenseArray):
+            return _mixed_add(lhs, rhs, -1.0)
         if not lhs.shape() == rhs.shape():
             raise Exception("cannot __add__, incompatible shape.")
         return _subtract_array_with_copy(lhs, rhs)
 
     @cython.profile(PROFILE_FLAG)
-    def __imul__(SparseArray self, SparseArray rhs):
+    def __imul__(SparseArray self, rhs):
         # implement: lhs *= rhs
-        cdef int mode = rhs._check_shape(self) # intentionally the opposite order to __mul__
+        if isinstance(rhs, DenseArray):
+            return _multiply_dense_inplace(self, rhs)
+        cdef SparseArray r = rhs
+        cdef int mode = r._check_shape(self) # intentionally the opposite order to __mul__
         if mode == SHAPE_IS_IDENTICAL:
-            return _multiply_identical_shape_array_inplace(self, rhs)
+            return _multiply_identical_shape_array_inplace(self, r)
         else:
-            return _multiply_array_inplace(self, rhs)
+            return _multiply_array_inplace(self, r)
 
     @cython.profile(PROFILE_FLAG)
-    def __div__(SparseArray self, SparseArray rhs):
+    def __div__(lhs, rhs):
         # implement result = lhs / rhs
+        if isinstance(lhs, DenseArray) or isinstance(rhs, DenseArray):
+            return _mixed_divide(lhs, rhs)
+        cdef SparseArray self = lhs
         self._check_shape(rhs)
         return self._divide_array_with_copy(rhs)
 
@@ -260,10 +286,37 @@ cdef class SparseArray:
         return self
 
     def __reduce__(self):
-        dictit = iter(self)
-        constructor = SparseArray
-        args = (list(self._shape),)
-        return (constructor, args, None, None, dictit)
+        keys, values = self.toarrays()
+        constructor = _unpickle_sparsearray
+        args = (list(self._shape), keys, values)
+        return (constructor, args, None, None, None)
+
+    def toarrays(self, sort=False):
+        '''Returns the (keys, values) of the filled elements as numpy arrays.'''
+        cdef numpy.ndarray[uint64_t, ndim=1] keys = numpy.zeros(self._data.size(), dtype=numpy.uint64)
+        cdef numpy.ndarray[double, ndim=1] values = numpy.zeros(self._data.size(), dtype=float)
+        cdef SparseArrayIterator it = self._data.begin()
+        cdef SparseArrayIterator end = self._data.end()
+        cdef Py_ssize_t ii = 0
+        while it != end:
+            keys[ii] = dereference(it).first
+            values[ii] = dereference(it).second
+            ii += 1
+            preincrement(it)
+        if sort:
+            order = numpy.argsort(keys, kind="mergesort")
+            keys = keys[order]
+            values = values[order]
+        return keys, values
+
+    def __iadd__(SparseArray self, SparseArray rhs):
+        # implement: lhs += rhs
+        if not self.shape() == rhs.shape():
+            raise Exception("cannot __iadd__, incompatible shape.")
+        # each key is added once, so the order of the keys does not change the result
+        keys, values = rhs.toarrays()
+        _add_keys(self, keys, values)
+        return self
 
     def clone(self):
         ret = SparseArray(self._shape)
@@ -278,19 +331,49 @@ cdef class SparseArray:
             preincrement(it)
         return ret
 
+def _unpickle_sparsearray(shape, keys, values):
+    arr = SparseArray(shape)
+    _add_keys(arr, keys, values)
+    return arr
+
+def _multiply_dense_inplace(SparseArray lhs, rhs):
+    # lhs *= rhs for a DenseArray rhs, only the filled elements of lhs are updated
+    if not _compatible_shape(rhs.shape(), lhs.shape()):
+        raise Exception("Arrays have incompatible shape")
+    keys, values = lhs.toarrays()
+    values *= rhs._values[_broadcast_keys(keys, lhs.shape(), rhs._dimscale).astype(numpy.int64)]
+    _set_keys(lhs, keys, values)
+    return lhs
+
+@cython.boundscheck(False)
+cdef void _set_keys(SparseArray arr, numpy.ndarray[uint64_t, ndim=1] keys, numpy.ndarray[double, ndim=1] values):
+    cdef Py_ssize_t ii
+    with nogil:
+        for ii in xrange(keys.shape[0]):
+            arr._data[keys[ii]] = values[ii]
+    return
+
+@cython.boundscheck(False)
+cdef void _add_keys(SparseArray arr, numpy.ndarray[uint64_t, ndim=1] keys, numpy.ndarray[double, ndim=1] values):
+    cdef Py_ssize_t ii
+    cdef uint64_t key
+    with nogil:
+        for ii in xrange(keys.shape[0]):
+            key = keys[ii]
+            arr._data[key] += values[ii]
+    return
+
 @cython.profile(PROFILE_FLAG)
 cdef SparseArray _multiply_array_with_copy(SparseArray lhs, SparseArray rhs):
         cdef SparseArray result = SparseArray(rhs.shape())
         cdef SparseArrayIterator it = rhs._data.begin()
         cdef SparseArrayIterator end = rhs._data.end()
-        cdef double x = 0.0
-        cdef vector[uint64_t] index
-        while it != end:
-            key = dereference(it).first
-            index = rhs.decodekey(key)
-            x = lhs.get(index) * dereference(it).second
-            result.set(index, x)
-            preincrement(it)
+        cdef uint64_t key
+        with nogil:
+            while it != end:
+                key = dereference(it).first
+                result._data[key] = find_value(lhs._data, broadcast_key(rhs._shape, lhs._dimscale, key)) * dereference(it).second
+                preincrement(it)
         return result
 
 @cython.profile(PROFILE_FLAG)
@@ -298,41 +381,37 @@ cdef SparseArray _multiply_identical_shape_array_with_copy(SparseArray lhs, Spar
         cdef SparseArray result = SparseArray(rhs.shape())
         cdef SparseArrayIterator it = rhs._data.begin()
         cdef SparseArrayIterator end = rhs._data.end()
-        cdef double x = 0.0
-        cdef vector[uint64_t] index
-        while it != end:
-            key = dereference(it).first
-            x = lhs._data[key] * dereference(it).second
-            result._data[key] = x
-            preincrement(it)
+        cdef uint64_t key
+        with nogil:
+            while it != end:
+                key = dereference(it).first
+                result._data[key] = find_value(lhs._data, key) * dereference(it).second
+                preincrement(it)
         return result
 
 @cython.profile(PROFILE_FLAG)
 cdef SparseArray _multiply_array_inplace(SparseArray lhs, SparseArray rhs):
         cdef SparseArrayIterator it = lhs._data.begin()
         cdef SparseArrayIterator end = lhs._data.end()
-        cdef uint64_t key;
-        cdef double x = 0.0
-        cdef vector[uint64_t] index
-        while it != end:
-            key = dereference(it).first
-            index = rhs.decodekey(key)
-            x = rhs.get(index) * dereference(it).second
-            lhs.set(index, x)
-            preincrement(it)
+        cdef uint64_t key
+        with nogil:
+            while it != end:
+                #dereference(it) is copied by Cython, write through the map
+                key = dereference(it).first
+                lhs._data[key] = dereference(it).second * find_value(rhs._data, broadcast_key(lhs._shape, rhs._dimscale, key))
+                preincrement(it)
         return lhs
 
 @cython.profile(PROFILE_FLAG)
 cdef SparseArray _multiply_identical_shape_array_inplace(SparseArray lhs, SparseArray rhs):
         cdef SparseArrayIterator it = lhs._data.begin()
         cdef SparseArrayIterator end = lhs._data.end()
-        cdef uint64_t key;
-        cdef double x = 0.0
-        while it != end:
-            key = dereference(it).first
-            x = rhs._data[key] * dereference(it).second
-            lhs._data[key] = x
-            preincrement(it)
+        cdef uint64_t key
+        with nogil:
+            while it != end:
+                key = dereference(it).first
+                lhs._data[key] = dereference(it).second * find_value(rhs._data, key)
+                preincrement(it)
         return lhs
 
 @cython.profile(PROFILE_FLAG)
@@ -385,6 +464,248 @@ def _makescalar(val, shape):
 
 ###############################################################################
 
+DENSE_OCCUPANCY_THRESHOLD = 0.3
+
+def choose_storage(arr, threshold=DENSE_OCCUPANCY_THRESHOLD, dtype=numpy.float64):
+    '''Returns arr as a DenseArray with values of dtype if at least threshold of its bins are filled, otherwise arr unchanged.
+    threshold=None always keeps the sparse storage, which is always float64.'''
+    if threshold is None:
+        return arr
+    if isinstance(arr, DenseArray):
+        return arr if arr.dtype == dtype else arr.astype(dtype)
+    if arr.max_size() > 0 and arr.occupancy() >= threshold:
+        return arr.todense(dtype=dtype)
+    return arr
+
+class DenseArray(object):
+    '''numpy backed array with the same interface as SparseArray for highly occupied arrays.
+    The values are stored in key order (the first dimension varies fastest) and dimensions with
+    size 0 are broadcast, as in SparseArray.
+    The values are stored with dtype (for example numpy.float32 to halve the memory). Arithmetic with
+    other arrays and projections are calculated in float64 and return float64 arrays.'''
+    def __init__(self, shape, values=None, dtype=numpy.float64):
+        self._shape = [int(s) for s in shape]
+        self._dimscale = _dimscale(self._shape)
+        size = self.max_size()
+        if values is None:
+            values = numpy.zeros(size, dtype=dtype)
+        values = numpy.ascontiguousarray(values, dtype=dtype)
+        if values.shape != (size,):
+            raise ValueError("DenseArray given values with the wrong size", values.shape, size)
+        self._values = values
+
+    @classmethod
+    def fromsparse(cls, arr, dtype=numpy.float64):
+        result = cls(arr.shape(), dtype=dtype)
+        keys, values = arr.toarrays()
+        result._values[keys.astype(numpy.int64)] = values
+        return result
+
+    def tosparse(self):
+        keys, values = self.toarrays()
+        return _unpickle_sparsearray(self._shape, keys, values)
+
+    def todense(self, dtype=None):
+        if dtype is None or dtype == self.dtype:
+            return self
+        return self.astype(dtype)
+
+    def astype(self, dtype):
+        '''Returns a copy with values of dtype.'''
+        return DenseArray(self._shape, numpy.array(self._values, dtype=dtype), dtype=dtype)
+
+    @property
+    def dtype(self):
+        return self._values.dtype
+
+    def view(self):
+        '''Returns the values as an ndarray with one axis per dimension (size 1 for broadcast dimensions).'''
+        return self._values.reshape([s if s > 0 else 1 for s in self._shape], order="F")
+
+    def sum(self):
+        return float(numpy.sum(self._values, dtype=numpy.float64))
+
+    def shape(self):
+        return list(self._shape)
+
+    def max_size(self):
+        size = 1
+        for s in self._shape:
+            if s > 0:
+                size *= s
+        return size
+
+    def actual_size(self):
+        return int(numpy.count_nonzero(self._values))
+
+    def occupancy(self):
+        return float(self.actual_size())/float(self.max_size())
+
+    def __str__(self):
+        return r"DenseArray(%.2e%%, %.2e/%.2e)" % (100.*self.occupancy(), self.actual_size(), self.max_size())
+
+    def __len__(self):
+        return self.actual_size()
+
+    def __iter__(self):
+        keys, values = self.toarrays()
+        for key, value in zip(keys, values):
+            yield self._decodekey(key), value
+
+    def _key(self, index):
+        key = 0
+        for i, (b, s) in enumerate(zip(index, self._shape)):
+            if s > 0:
+                if not 0 <= b < s:
+                    raise IndexError("%.0fth index out of bounds" % i, self._shape, index,)
+                key += b * self._dimscale[i]
+        return key
+
+    def _decodekey(self, key):
+        index = []
+        for s in self._shape:
+            if s > 0:
+                index.append(int(key % s))
+                key //= s
+            else:
+                index.append(0)
+        return index
+
+    def __setitem__(self, index, value):
+        self._values[self._key(index)] = value
+
+    def __getitem__(self, index):
+        return self._values[self._key(index)]
+
+    def project(self, keep, range_=None):
+        keep = list(keep)
+        view = self.view()
+        if range_:
+            view = view[tuple(slice(*range_[d]) if d in range_ else slice(None) for d in xrange(len(self._shape)))]
+        summed = numpy.sum(view, axis=tuple(d for d in xrange(len(self._shape)) if d not in keep), dtype=numpy.float64)
+        kept = sorted(set(keep))
+        summed = numpy.transpose(summed, [kept.index(k) for k in keep])
+        return DenseArray([self._shape[k] for k in keep], summed.ravel(order="F"))
+
+    def flatten(self):
+        return numpy.array(self._values, dtype=numpy.float64)
+
+    def toarrays(self, sort=False):
+        '''Returns the (keys, values) of the non-zero elements as numpy arrays (always sorted by key), the values in float64.'''
+        keys = numpy.flatnonzero(self._values)
+        return keys.astype(numpy.uint64), numpy.asarray(self._values[keys], dtype=numpy.float64)
+
+    def clone(self):
+        return DenseArray(self._shape, numpy.copy(self._values), dtype=self.dtype)
+
+    def _check_shape(self, rhs):
+        '''Raises an exception unless self can be broadcast to the shape of rhs.'''
+        if not _compatible_shape(self._shape, rhs.shape()):
+            raise Exception("Arrays have incompatible shape")
+        return
+
+    def __mul__(self, rhs):
+        return _mixed_multiply(self, rhs)
+
+    def __rmul__(self, lhs):
+        return _mixed_multiply(lhs, self)
+
+    def __imul__(self, rhs):
+        # implement: lhs *= rhs, rhs may have broadcast dimensions
+        if not _compatible_shape(rhs.shape(), self._shape):
+            raise Exception("Arrays have incompatible shape")
+        view = self.view()
+        numpy.multiply(view, _asdense(rhs).view(), out=view)
+        return self
+
+    def __add__(self, rhs):
+        return _mixed_add(self, rhs, 1.0)
+
+    def __radd__(self, lhs):
+        return _mixed_add(lhs, self, 1.0)
+
+    def __sub__(self, rhs):
+        return _mixed_add(self, rhs, -1.0)
+
+    def __rsub__(self, lhs):
+        return _mixed_add(lhs, self, -1.0)
+
+    def __iadd__(self, rhs):
+        if not self.shape() == rhs.shape():
+            raise Exception("cannot __iadd__, incompatible shape.")
+        self._values += _asdense(rhs)._values
+        return self
+
+    def __div__(self, rhs):
+        return _mixed_divide(self, rhs)
+
+    def __rdiv__(self, lhs):
+        return _mixed_divide(lhs, self)
+
+    __truediv__ = __div__
+    __rtruediv__ = __rdiv__
+
+def _dimscale(shape):
+    result = []
+    cumprod = 1
+    for s in shape:
+        if s > 0:
+            result.append(cumprod)
+            cumprod *= s
+        else:
+            result.append(0)
+    return result
+
+def _asdense(arr):
+    if isinstance(arr, DenseArray):
+        return arr
+    return DenseArray.fromsparse(arr)
+
+def _broadcast_keys(keys, shape, dimscale):
+    '''Vectorised broadcast_key.'''
+    keys = numpy.array(keys, dtype=numpy.uint64)
+    result = numpy.zeros(len(keys), dtype=numpy.uint64)
+    for s, d in zip(shape, dimscale):
+        if s > 0:
+            b = keys % numpy.uint64(s)
+            keys //= numpy.uint64(s)
+            result += b * numpy.uint64(d)
+    return result
+
+def _mixed_multiply(lhs, rhs):
+    # implement result = lhs * rhs where lhs may have broadcast dimensions.
+    # The result has the storage of rhs: a sparse rhs keeps its filled keys.
+    if isinstance(lhs, float):
+        lhs = _makescalar(lhs, rhs.shape())
+    if not _compatible_shape(lhs.shape(), rhs.shape()):
+        raise Exception("Arrays have incompatible shape")
+    if isinstance(rhs, DenseArray):
+        result = DenseArray(rhs.shape())
+        numpy.multiply(_asdense(lhs).view(), rhs.view(), out=result.view(), dtype=numpy.float64)
+        return result
+    keys, values = rhs.toarrays()
+    l = _asdense(lhs)
+    values *= l._values[_broadcast_keys(keys, rhs.shape(), l._dimscale).astype(numpy.int64)]
+    return _unpickle_sparsearray(rhs.shape(), keys, values)
+
+def _mixed_add(lhs, rhs, sign):
+    if not lhs.shape() == rhs.shape():
+        raise Exception("cannot __add__, incompatible shape.")
+    result = DenseArray(rhs.shape(), _asdense(lhs)._values)
+    result._values += sign * numpy.asarray(_asdense(rhs)._values, dtype=numpy.float64)
+    return result
+
+def _mixed_divide(lhs, rhs):
+    # implement result = lhs / rhs, division by zero gives 0
+    if not _compatible_shape(lhs.shape(), rhs.shape()):
+        raise Exception("Arrays have incompatible shape")
+    result = DenseArray(rhs.shape())
+    r = rhs.view() if isinstance(rhs, DenseArray) else _asdense(rhs).view()
+    numpy.divide(_asdense(lhs).view(), r, out=result.view(), where=(r != 0.0), dtype=numpy.float64)
+    return result
+
+###############################################################################
+
 #cdef class Ones(SparseArray):
 #
 #    #cdef vector[uint64_t] _shape
@@ -409,8 +730,12 @@ cdef class SparseHistogram:
     cdef vector[vector[double]] _binning
     cdef double _overflow
     cdef _label
+    cdef _densethreshold
+    cdef _dense
 
-    def __init__(self, binning, label=None):
+    def __init__(self, binning, label=None, densethreshold=None):
+        '''If densethreshold is given, array() returns a DenseArray copy of the contents once at least
+        that fraction of the bins is filled. The histogram is always filled with sparse storage.'''
         #convert input label into HistogramNDLabel object
         if label is None:
             label = HistogramNDLabel(binning)
@@ -424,12 +749,18 @@ cdef class SparseHistogram:
         self._binning = binning
         self._overflow = 0.0
         self._label = label
+        self._densethreshold = densethreshold
+        self._dense = None
 
     def binning(self):
         return self._binning
 
     def array(self):
-        return self._arr
+        if self._densethreshold is None:
+            return self._arr
+        if self._dense is None:
+            self._dense = choose_storage(self._arr, self._densethreshold)
+        return self._dense
 
     def __str__(self):
         return "\n".join([r"SparseHistogram(%.2e%%, %.2e/%.2e)" % (100.*self.occupancy(), self.actual_size(), self.max_size()), 
@@ -455,8 +786,44 @@ cdef class SparseHistogram:
             self._overflow += weight
         else:
             self._arr.add(index, weight)
+            self._dense = None
         return
 
+    def find_keys(self, coords):
+        '''Returns the array keys of the bins containing each row of coords (an [N, ndim] array).
+        Values outside of the binning are assigned to the first/last bin, as in fill.'''
+        coords = numpy.asarray(coords, dtype=float)
+        if coords.ndim != 2 or coords.shape[1] != self._binning.size():
+            raise ValueError("SparseHistogram.find_keys expected coordinates with shape [N, %s]" % self._binning.size(), coords.shape)
+        keys = numpy.zeros(coords.shape[0], dtype=numpy.uint64)
+        cdef uint64_t dim
+        for dim in xrange(self._binning.size()):
+            edges = numpy.array(self._binning[dim], dtype=float)
+            index = numpy.searchsorted(edges, coords[:, dim], side="right") - 1
+            numpy.clip(index, 0, self._arr._shape[dim] - 1, out=index)
+            keys += index.astype(numpy.uint64) * numpy.uint64(self._arr._dimscale[dim])
+        return keys
+
+    def fill_keys(self, numpy.ndarray[uint64_t, ndim=1] keys, numpy.ndarray[double, ndim=1] weights):
+        '''Adds weights[i] to the bin with array key keys[i] (see find_keys).'''
+        if keys.shape[0] != weights.shape[0]:
+            raise ValueError("SparseHistogram.fill_keys given keys and weights of different length", keys.shape[0], weights.shape[0])
+        _add_keys(self._arr, keys, weights)
+        self._dense = None
+        return
+
+    def merge(self, SparseHistogram other):
+        '''Adds the contents of other (a histogram with identical binning) to this histogram.'''
+        if not self._binning == other._binning:
+            raise ValueError("cannot merge SparseHistogram with different binning.")
+        self._arr += other._arr
+        self._overflow += other._overflow
+        self._dense = None
+        return self
+
+    def __iadd__(self, SparseHistogram other):
+        return self.merge(other)
+
     def eval(self, coord):
         index = self._findindex(coord)
         return self._arr.get(index)
@@ -494,7 +861,7 @@ cdef class SparseHistogram:
     def project_nd(self, list axes, dict range_=None):
         if range_:
             range_ = self._convert_floatrange_to_binrange(range_)
-        result = SparseHistogram([self._binning[k] for k in axes])
+        result = SparseHistogram([self._binning[k] for k in axes], densethreshold=self._densethreshold)
         result._arr = self._arr.project(axes, range_=range_)
         return result
 
@@ -542,7 +909,7 @@ cdef class SparseHistogram:
 
     def __reduce__(self):
         constructor = _unpickle_sparsehistogram
-        args = (self._binning, self._arr, self._overflow)
+        args = (self._binning, self._arr, self._overflow, self._densethreshold)
         return (constructor, args, None, None, None)
 
     def scale(self, float scale):
@@ -556,21 +923,68 @@ cdef class SparseHistogram:
             result._data[key] = dereference(it).second * scale
             preincrement(it)
         self._arr = result
+        self._dense = None
         return
 
     def clone(self):
-        ret = SparseHistogram(self._binning, label=self._label)
+        ret = SparseHistogram(self._binning, label=self._label, densethreshold=self._densethreshold)
         ret._overflow = self._overflow
         ret._arr = self._arr.clone()
         return ret
 
-def _unpickle_sparsehistogram(binning, arr, overflow):
-    hist = SparseHistogram(binning)
+def _unpickle_sparsehistogram(binning, arr, overflow, densethreshold=None):
+    hist = SparseHistogram(binning, densethreshold=densethreshold)
     hist._arr = arr
     hist._overflow = overflow
     return hist
 
 
+@cython.cdivision(True)
+cdef uint64_t broadcast_key(vector[uint64_t]& shape, vector[uint64_t]& dimscale, uint64_t key) nogil:
+    '''Converts a key of an array with the given shape into the key of an array with the 
+    same number of dimensions and the given dimscale (that may have broadcast dimensions).'''
+    cdef uint64_t result = 0
+    cdef uint64_t b, s
+    cdef size_t i
+    for i in xrange(shape.size()):
+        s = shape[i]
+        if s > 0:
+            b = key % s
+            key = key / s
+            result += b * dimscale[i]
+    return result
+
+cdef double find_value(SparseArrayContainer& data, uint64_t key) nogil:
+    '''Returns the value stored at key or 0 if it is not filled (without inserting it).'''
+    cdef SparseArrayIterator it = data.find(key)
+    if it == data.end():
+        return 0.0
+    return dereference(it).second
+
+@cython.cdivision(True)
+cdef void _project(SparseArray arr, SparseArray result, vector[uint64_t]& keep) nogil:
+    cdef SparseArrayIterator it = arr._data.begin()
+    cdef SparseArrayIterator end = arr._data.end()
+    cdef vector[uint64_t] index = vector[uint64_t](arr._shape.size())
+    cdef uint64_t key, newkey, b, s
+    cdef size_t i
+    while it != end:
+        key = dereference(it).first
+        for i in xrange(arr._shape.size()):
+            s = arr._shape[i]
+            if s > 0:
+                b = key % s
+                key = key / s
+            else:
+                b = 0
+            index[i] = b
+        newkey = 0
+        for i in xrange(keep.size()):
+            newkey += index[keep[i]] * result._dimscale[i]
+        result._data[newkey] += dereference(it).second
+        preincrement(it)
+    return
+
 cdef int array_bisect_right(vector[double]& arr, double x):
     cdef int lo = 0
     cdef int hi = arr.size()
@@ -591,15 +1005,15 @@ cdef SparseArray sparse_array_interpolation(double f, SparseArray y0, SparseArra
     cdef SparseArrayIterator it = y1._data.begin()
     cdef SparseArrayIterator end = y1._data.end()
     cdef double v1, v0, v
-    cdef vector[uint64_t] index
     cdef uint64_t key
-    while it != end:
-        key = dereference(it).first
-        v1 = dereference(it).second
-        v0 = y0._data[key]
-        v = f*v1 + (1.0-f)*v0
-        result._data[key] = v
-        preincrement(it)
+    with nogil:
+        while it != end:
+            key = dereference(it).first
+            v1 = dereference(it).second
+            v0 = find_value(y0._data, key)
+            v = f*v1 + (1.0-f)*v0
+            result._data[key] = v
+            preincrement(it)
     return result
 
 cdef vector_content_identical(vector[uint64_t]& lhs, vector[uint64_t]& rhs):
@@ -48,10 +48,23 @@ def speedtest_list(npe=_NPE, npars=_NPARS):
     return
 
 
+def speedtest_batch(npe=_NPE, npars=_NPARS, batchsize=10**4):
+    names = [str(x) for x in range(npars)]
+    mu = range(npars)
+    sigma = range(npars)
+    gaus = GaussianGenerator(["gaus"+n for n in names], mu, sigma)
+    cov = np.diag(sigma)
+    multigaus = MultiVariateGaussianGenerator(["multi" + n for n in names], mu, cov)
+    gen = GeneratorList(gaus, multigaus)
+    for _ in xrange(npe // batchsize):
+       gen.generate(batchsize)
+    return
+
 _GENERATOR_CHOICES = { "gaus" : speedtest_gaus,
                        "multigaus" : speedtest_multigaus,
                        "const" : speedtest_const,
                        "list" : speedtest_list,
+                       "batch" : speedtest_batch,
 }
 
 def parsecml():
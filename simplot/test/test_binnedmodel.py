@@ -1,9 +1,13 @@
 
 import itertools
 import math
+import os
+import shutil
+import tempfile
 import random
 import string
 import unittest
+import cPickle as pickle
 
 import numpy as np
 
@@ -12,8 +16,19 @@ from simplot.mc.statistics import Mean, StandardDeviation, calculate_statistics_
 from simplot.mc.likelihood import EventRateLikelihood, SumLikelihood
 from simplot.mc.generators import GaussianGenerator, GeneratorList
 from simplot.mc.priors import GaussianPrior, CombinedPrior, OscillationParametersPrior
-from simplot.binnedmodel.sample import Sample, BinnedSample, BinnedSampleWithOscillation, CombinedBinnedSample
+from simplot.binnedmodel.model import BinnedModel
+from simplot.binnedmodel.sample import Sample, BinnedSample, BinnedSampleWithOscillation, CombinedBinnedSample, PartitionedData, ChunkedData
+from simplot.sparsehist import SparseHistogram, SparseArray, DenseArray
 from simplot.binnedmodel.systematics import Systematics, SplineSystematics, FluxSystematics, FluxAndSplineSystematics
+from simplot.pdg import PdgNeutrinoOscillationParameters
+
+################################################################################
+
+def _probabilitycalc():
+    #only the oscillation tests need ROOT and Prob3++
+    import simplot.rootprob3pp.lib
+    import ROOT
+    return ROOT.crootprob3pp.Probability()
 
 ################################################################################
 
@@ -251,6 +266,409 @@ class TestOscillationCalculation(unittest.TestCase):
 
 ################################################################################
 
+class TestColumnarData(unittest.TestCase):
+
+    def _events(self, N, withosc):
+        random = np.random.RandomState(1227)
+        coord = np.column_stack([random.uniform(-1.0, 6.0, size=N), random.uniform(0.0, 4.0, size=N), random.uniform(0.0, 5.0, size=N)])
+        selweight = random.uniform(size=N)
+        selweight[random.uniform(size=N) < 0.2] = 0.0
+        noselweight = random.uniform(1.0, 2.0, size=N)
+        systweight = random.normal(1.0, 0.1, size=(N, 2, 3))
+        if withosc:
+            events = [(c, s, n, w) for c, s, n, w in zip(coord, selweight, noselweight, systweight)]
+            columns = {"coord" : {"trueenu" : coord[:, 0], "nupdg" : coord[:, 1], "recoenu" : coord[:, 2]}, 
+                       "selweight" : selweight, 
+                       "noselweight" : noselweight, 
+                       "systweight" : systweight,
+            }
+        else:
+            events = [(c, s, w) for c, s, w in zip(coord, selweight, systweight)]
+            columns = {"coord" : coord, "selweight" : selweight, "systweight" : [systweight[:, 0, :], systweight[:, 1, :]]}
+        return events, columns
+
+    def _binning(self):
+        return [("trueenu", np.linspace(0.0, 5.0, num=10.0)), ("nupdg", np.arange(0.0, 5.0)), ("recoenu", np.linspace(0.0, 5.0, num=10.0))]
+
+    def _systematics(self):
+        return SplineSystematics([("x", [-5.0, 0.0, 5.0]), ("y", [-5.0, 0.0, 5.0])])
+
+    def _assert_hist_equal(self, h1, h2):
+        self.assertEquals(h1.actual_size(), h2.actual_size())
+        self.assertTrue(np.array_equal(h1.array().flatten(), h2.array().flatten()))
+
+    def test_columnar_binned_sample(self):
+        events, columns = self._events(10**4, withosc=False)
+        s1 = BinnedSample("s1", self._binning(), ["recoenu"], events, systematics=self._systematics())
+        s2 = BinnedSample("s2", self._binning(), ["recoenu"], columns, systematics=self._systematics())
+        self._assert_hist_equal(s1.N_sel, s2.N_sel)
+        #bin contents are identical but the projection may sum bins in a different order
+        for pars in itertools.product([-3.0, 0.0, 2.0], repeat=2):
+            self.assertTrue(np.allclose(s1(pars), s2(pars), rtol=1e-12, atol=0.0))
+        return
+
+    def test_columnar_binned_sample_with_oscillation(self):
+        events, columns = self._events(10**4, withosc=True)
+        probabilitycalc = _probabilitycalc()
+        s1 = BinnedSampleWithOscillation("s1", self._binning(), ["recoenu"], events, "trueenu", "nupdg", 295.0, systematics=self._systematics(), probabilitycalc=probabilitycalc)
+        s2 = BinnedSampleWithOscillation("s2", self._binning(), ["recoenu"], columns, "trueenu", "nupdg", 295.0, systematics=self._systematics(), probabilitycalc=probabilitycalc)
+        self._assert_hist_equal(s1.N_sel, s2.N_sel)
+        self._assert_hist_equal(s1.N_nosel, s2.N_nosel)
+        #bin contents are identical but the projection may sum bins in a different order
+        pars = np.array(list(PdgNeutrinoOscillationParameters().value(p) for p in PdgNeutrinoOscillationParameters.ALL_PARS_SINSQ) + [1.0, -1.0])
+        self.assertTrue(np.allclose(s1(pars), s2(pars), rtol=1e-12, atol=0.0))
+        return
+
+    def test_response_matrix_model(self):
+        _, columns = self._events(10**4, withosc=True)
+        probabilitycalc = _probabilitycalc()
+        s1 = BinnedSampleWithOscillation("s1", self._binning(), ["recoenu"], columns, "trueenu", "nupdg", 295.0, probabilitycalc=probabilitycalc)
+        pars = np.array(list(PdgNeutrinoOscillationParameters().value(p) for p in PdgNeutrinoOscillationParameters.ALL_PARS_SINSQ))
+        expected = s1(pars)
+        s2 = BinnedSampleWithOscillation("s2", self._binning(), ["recoenu"], columns, "trueenu", "nupdg", 295.0, probabilitycalc=probabilitycalc, responsematrix=True)
+        self.assertTrue(np.allclose(s2(pars), expected, rtol=1e-12, atol=0.0))
+        #spline systematics are refused before the data are read
+        with self.assertRaises(ValueError):
+            BinnedSampleWithOscillation("s3", self._binning(), ["recoenu"], _NoData(), "trueenu", "nupdg", 295.0, systematics=self._systematics(), probabilitycalc=probabilitycalc, responsematrix=True)
+        #flux systematics, with a beam mode axis
+        binning = self._binning() + [("beammode", np.arange(0.0, 3.0))]
+        columns["coord"]["beammode"] = np.arange(len(columns["selweight"])) % 2
+        enubinning = binning[0][1]
+        flux_error_binning = [((beamname, flavname), beambin, flavbin, list(enubinning[[0, 4, 9]])) for beambin, beamname in enumerate(["RHC", "FHC"]) for flavbin, flavname in enumerate(["numu", "nue", "numubar", "nuebar"])]
+        fluxparametermap = FluxSystematics.make_flux_parameter_map(enubinning, flux_error_binning)
+        samples = [BinnedSampleWithOscillation(name, binning, ["recoenu"], columns, "trueenu", "nupdg", 295.0, beammodeaxis="beammode", systematics=FluxSystematics(0, 1, 3, fluxparametermap), probabilitycalc=probabilitycalc, responsematrix=responsematrix) for name, responsematrix in [("s4", False), ("s5", True)]]
+        fluxpars = np.linspace(0.8, 1.2, num=len(fluxparametermap))
+        pars = np.concatenate([pars, fluxpars])
+        s4, s5 = samples
+        self.assertTrue(np.allclose(s5(pars), s4(pars), rtol=1e-12, atol=0.0))
+        vec, jac = s5.eval_and_jacobian(pars)
+        self.assertTrue(np.allclose(vec, s4(pars), rtol=1e-12, atol=0.0))
+        self.assertTrue(np.allclose(jac[:, 6:], s4.jacobian(pars)[:, 6:], rtol=1e-12, atol=1e-12 * np.max(vec)))
+        self._assert_jacobian(s5, pars, xrange(6, len(pars)))
+        self._assert_jacobian(s5, pars, xrange(6), rtol=1e-3)
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, "model.bin")
+            s5._model.save(path)
+            loaded = type(s5._model).load(path, probabilitycalc=probabilitycalc)
+            self.assertTrue(np.array_equal(loaded(pars), s5._model(pars)))
+        finally:
+            shutil.rmtree(tmpdir)
+        return
+
+    def test_dense_storage(self):
+        _, columns = self._events(10**4, withosc=False)
+        s1 = BinnedSample("s1", self._binning(), ["recoenu"], columns, systematics=self._systematics(), densethreshold=None)
+        s2 = BinnedSample("s2", self._binning(), ["recoenu"], columns, systematics=self._systematics(), densethreshold=0.0)
+        for pars in itertools.product([-3.0, 0.0, 2.0], repeat=2):
+            self.assertTrue(np.allclose(s1(pars), s2(pars), rtol=1e-12, atol=0.0))
+        self.assertTrue(np.allclose(s1.jacobian([1.5, -0.5]), s2.jacobian([1.5, -0.5]), rtol=1e-12, atol=0.0))
+        _, columns = self._events(10**4, withosc=True)
+        probabilitycalc = _probabilitycalc()
+        s1 = BinnedSampleWithOscillation("s1", self._binning(), ["recoenu"], columns, "trueenu", "nupdg", 295.0, systematics=self._systematics(), probabilitycalc=probabilitycalc, densethreshold=None)
+        s2 = BinnedSampleWithOscillation("s2", self._binning(), ["recoenu"], columns, "trueenu", "nupdg", 295.0, systematics=self._systematics(), probabilitycalc=probabilitycalc, densethreshold=0.0)
+        pars = np.array(list(PdgNeutrinoOscillationParameters().value(p) for p in PdgNeutrinoOscillationParameters.ALL_PARS_SINSQ) + [1.0, -1.0])
+        self.assertTrue(np.allclose(s1(pars), s2(pars), rtol=1e-12, atol=0.0))
+        return
+
+    def test_single_precision_storage(self):
+        _, columns = self._events(10**4, withosc=False)
+        s1 = BinnedSample("s1", self._binning(), ["recoenu"], columns, systematics=self._systematics(), densethreshold=0.0)
+        s2 = BinnedSample("s2", self._binning(), ["recoenu"], columns, systematics=SplineSystematics([("x", [-5.0, 0.0, 5.0]), ("y", [-5.0, 0.0, 5.0])], dtype=np.float32), densethreshold=0.0, dtype=np.float32)
+        for pars in itertools.product([-3.0, 0.0, 2.0], repeat=2):
+            self.assertEquals(s2(pars).dtype, np.float64)
+            self.assertTrue(np.allclose(s1(pars), s2(pars), rtol=1e-5, atol=0.0))
+        self.assertTrue(np.allclose(s1.jacobian([1.5, -0.5]), s2.jacobian([1.5, -0.5]), rtol=1e-5, atol=1e-5))
+        _, columns = self._events(10**4, withosc=True)
+        probabilitycalc = _probabilitycalc()
+        s1 = BinnedSampleWithOscillation("s1", self._binning(), ["recoenu"], columns, "trueenu", "nupdg", 295.0, systematics=self._systematics(), probabilitycalc=probabilitycalc, densethreshold=0.0)
+        s2 = BinnedSampleWithOscillation("s2", self._binning(), ["recoenu"], columns, "trueenu", "nupdg", 295.0, systematics=self._systematics(), probabilitycalc=probabilitycalc, densethreshold=0.0, dtype=np.float32)
+        pars = np.array(list(PdgNeutrinoOscillationParameters().value(p) for p in PdgNeutrinoOscillationParameters.ALL_PARS_SINSQ) + [1.0, -1.0])
+        self.assertTrue(np.allclose(s1(pars), s2(pars), rtol=1e-5, atol=0.0))
+        #stored in single precision, summed in double precision
+        dense = SparseHistogram([edges for _, edges in self._binning()], densethreshold=0.0).array().astype(np.float32)
+        dense[[0, 0, 0]] = 0.1
+        self.assertEquals(dense.dtype, np.float32)
+        self.assertEquals(dense.clone().dtype, np.float32)
+        self.assertEquals(dense.flatten().dtype, np.float64)
+        self.assertEquals(dense.sum(), float(np.float32(0.1)))
+        return
+
+    def test_mixed_dense_sparse_arithmetic(self):
+        events, _ = self._events(10**3, withosc=False)
+        hist = SparseHistogram([edges for _, edges in self._binning()])
+        for coord, weight, _ in events:
+            hist.fill(coord, weight)
+        sparse = hist.array()
+        dense = sparse.todense()
+        weights = SparseArray([0, 4, 0])
+        for ii in xrange(4):
+            weights[[0, ii, 0]] = 1.0 + ii
+        self.assertTrue(np.array_equal((weights * sparse).flatten(), (weights * dense).flatten()))
+        self.assertTrue(np.array_equal((weights.todense() * sparse).flatten(), (weights * sparse).flatten()))
+        #in place, with broadcast and identical shapes
+        inplace = dense.tosparse()
+        inplace *= weights
+        self.assertTrue(np.array_equal(inplace.flatten(), (weights * sparse).flatten()))
+        inplace = dense.tosparse()
+        inplace *= sparse
+        self.assertTrue(np.array_equal(inplace.flatten(), (sparse * sparse).flatten()))
+        self.assertTrue(np.allclose((sparse + dense).flatten(), 2.0 * sparse.flatten(), rtol=1e-12, atol=0.0))
+        self.assertTrue(np.allclose(sparse.project([2, 0]).flatten(), dense.project([2, 0]).flatten(), rtol=1e-12, atol=0.0))
+        self.assertTrue(np.allclose(sparse.project([1], range_={0:(2, 5)}).flatten(), dense.project([1], range_={0:(2, 5)}).flatten(), rtol=1e-12, atol=0.0))
+        self.assertEquals(dense.tosparse().flatten().tolist(), sparse.flatten().tolist())
+        self.assertIsInstance(SparseHistogram([edges for _, edges in self._binning()], densethreshold=0.0).array(), DenseArray)
+        return
+
+    def _assert_jacobian(self, sample, pars, parindices, rtol=1e-6):
+        vec, jac = sample.eval_and_jacobian(pars)
+        self.assertTrue(np.allclose(vec, sample(pars), rtol=1e-12, atol=0.0))
+        for ipar in parindices:
+            h = 1e-6 * max(abs(pars[ipar]), 1.0)
+            up = np.copy(pars)
+            up[ipar] += h
+            down = np.copy(pars)
+            down[ipar] -= h
+            #copied, a combined sample reuses its result array
+            numerical = (np.copy(sample(up)) - sample(down)) / (2.0 * h)
+            self.assertTrue(np.allclose(jac[:, ipar], numerical, rtol=rtol, atol=rtol * np.max(np.abs(vec))))
+        return
+
+    def test_jacobian(self):
+        _, columns = self._events(10**4, withosc=False)
+        s1 = BinnedSample("s1", self._binning(), ["recoenu"], columns, systematics=self._systematics())
+        s2 = BinnedSample("s2", self._binning(), ["trueenu"], columns, systematics=self._systematics())
+        for pars in [np.array([-3.0, 2.0]), np.array([1.5, -0.5]), np.array([6.0, 0.5])]:
+            self._assert_jacobian(s1, pars, xrange(2))
+        combined = CombinedBinnedSample([s1, s2], nthreads=1)
+        pars = np.array([1.5, -0.5])
+        self._assert_jacobian(combined, pars, xrange(2))
+        vec, jac = combined.eval_and_jacobian(pars)
+        self.assertTrue(np.array_equal(jac[:len(s1(pars))], s1.jacobian(pars)))
+        return
+
+    def test_jacobian_without_weight_derivatives(self):
+        _, columns = self._events(10**4, withosc=False)
+        sample = BinnedSample("s1", self._binning(), ["recoenu"], columns, systematics=self._systematics())
+        systematics = self._systematics()
+        hist, systhist = sample._loaddata(columns, systematics)
+        weights = dict(zip(["det_weights", "xsec_weights", "flux_weights"], systematics(sample.parameter_names, systhist, hist)))
+        class NoDerivatives(object):
+            def __init__(self, weights):
+                self._weights = weights
+            def __call__(self, pars):
+                return self._weights(pars)
+        obs = [sample.axisnames.index("recoenu")]
+        analytic = BinnedModel(sample.parameter_names, hist, obs, **weights)
+        numerical = BinnedModel(sample.parameter_names, hist, obs, **dict((k, None if w is None else NoDerivatives(w)) for k, w in weights.iteritems()))
+        for pars in [np.array([-3.0, 2.0]), np.array([1.5, -0.5])]:
+            vec, jac = analytic.observable_and_jacobian(pars)
+            numvec, numjac = numerical.observable_and_jacobian(pars)
+            self.assertTrue(np.array_equal(vec, numvec))
+            self.assertTrue(np.allclose(numjac, jac, rtol=1e-6, atol=1e-6 * np.max(np.abs(vec))))
+        return
+
+    def test_jacobian_with_oscillation(self):
+        _, columns = self._events(10**4, withosc=True)
+        probabilitycalc = _probabilitycalc()
+        sample = BinnedSampleWithOscillation("s1", self._binning(), ["recoenu"], columns, "trueenu", "nupdg", 295.0, systematics=self._systematics(), probabilitycalc=probabilitycalc)
+        pars = np.array(list(PdgNeutrinoOscillationParameters().value(p) for p in PdgNeutrinoOscillationParameters.ALL_PARS_SINSQ) + [1.0, -1.0])
+        #the oscillation parameters are differentiated numerically so only agree approximately
+        self._assert_jacobian(sample, pars, xrange(6, 8))
+        self._assert_jacobian(sample, pars, xrange(6), rtol=1e-3)
+        return
+
+    def test_partitioned_data(self):
+        events, columns = self._events(10**4, withosc=False)
+        partitions = [dict(coord=columns["coord"][ii::4], selweight=columns["selweight"][ii::4], systweight=[w[ii::4] for w in columns["systweight"]]) for ii in xrange(3)]
+        partitions.append(events[3::4])
+        samples = [BinnedSample("s1", self._binning(), ["recoenu"], PartitionedData(partitions, nprocesses=n), systematics=self._systematics()) for n in [1, 3]]
+        s1, s2 = samples
+        self._assert_hist_equal(s1.N_sel, s2.N_sel)
+        for pars in itertools.product([-3.0, 0.0, 2.0], repeat=2):
+            self.assertTrue(np.array_equal(s1(pars), s2(pars)))
+        #the partitions are summed separately so they agree with a single fill up to rounding
+        serial = BinnedSample("s3", self._binning(), ["recoenu"], columns, systematics=self._systematics())
+        self.assertEquals(s1.N_sel.actual_size(), serial.N_sel.actual_size())
+        self.assertTrue(np.allclose(s1.N_sel.array().flatten(), serial.N_sel.array().flatten(), rtol=1e-12, atol=0.0))
+        for pars in itertools.product([-3.0, 0.0, 2.0], repeat=2):
+            self.assertTrue(np.allclose(s1(pars), serial(pars), rtol=1e-12, atol=0.0))
+        return
+
+    def test_chunked_data(self):
+        _, columns = self._events(10**4, withosc=False)
+        branches = dict(x=columns["coord"][:, 0], y=columns["coord"][:, 1], z=columns["coord"][:, 2], w=columns["selweight"], s0=columns["systweight"][0], s1=columns["systweight"][1])
+        chunks = [dict((k, v[start:start + 999]) for k, v in branches.iteritems()) for start in xrange(0, 10**4, 999)]
+        def tocolumns(chunk):
+            return {"coord" : {"trueenu" : chunk["x"], "nupdg" : chunk["y"], "recoenu" : chunk["z"]}, "selweight" : chunk["w"], "systweight" : [chunk["s0"], chunk["s1"]]}
+        s1 = BinnedSample("s1", self._binning(), ["recoenu"], columns, systematics=self._systematics())
+        s2 = BinnedSample("s2", self._binning(), ["recoenu"], ChunkedData(iter(chunks), columns=tocolumns), systematics=self._systematics())
+        #the chunks are summed separately so the bin contents agree up to rounding
+        self.assertEquals(s1.N_sel.actual_size(), s2.N_sel.actual_size())
+        self.assertTrue(np.allclose(s1.N_sel.array().flatten(), s2.N_sel.array().flatten(), rtol=1e-12, atol=0.0))
+        for pars in itertools.product([-3.0, 0.0, 2.0], repeat=2):
+            self.assertTrue(np.allclose(s1(pars), s2(pars), rtol=1e-12, atol=0.0))
+        return
+
+    def test_combined_sample_threads(self):
+        _, columns = self._events(10**4, withosc=False)
+        samples = [BinnedSample("s%s" % ii, self._binning(), [obs], columns, systematics=self._systematics()) for ii, obs in enumerate(["recoenu", "trueenu", "nupdg"])]
+        sequential = CombinedBinnedSample(samples, nthreads=1)
+        threaded = CombinedBinnedSample(samples, nthreads=3)
+        for pars in itertools.product([-3.0, 0.0, 2.0], repeat=2):
+            pars = np.array(pars)
+            expected = np.concatenate([s(pars) for s in samples])
+            self.assertTrue(np.array_equal(sequential(pars), expected))
+            self.assertTrue(np.array_equal(threaded(pars), expected))
+        #integer parameters must not truncate the rates
+        self.assertTrue(np.array_equal(np.copy(threaded(np.array([1, -1]))), threaded(np.array([1.0, -1.0]))))
+        #the samples write into one result array, or into out
+        self.assertTrue(sequential(pars) is sequential(pars))
+        out = np.zeros(len(expected))
+        self.assertTrue(threaded(pars, out=out) is out)
+        self.assertTrue(np.array_equal(out, expected))
+        threaded.close()
+        #a shared probability calculator is not thread safe
+        shared = [Sample(["a"]), Sample(["b"])]
+        for s in shared:
+            s._probabilitycalc = object()
+        CombinedBinnedSample(shared, nthreads=2)
+        shared[1]._probabilitycalc = shared[0]._probabilitycalc
+        with self.assertRaises(ValueError):
+            CombinedBinnedSample(shared, nthreads=2)
+        CombinedBinnedSample(shared)
+        return
+
+    def test_pickle_and_merge_histograms(self):
+        _, columns = self._events(10**3, withosc=False)
+        hist = SparseHistogram([edges for _, edges in self._binning()])
+        hist.fill_keys(hist.find_keys(columns["coord"]), columns["selweight"])
+        copy = pickle.loads(pickle.dumps(hist, protocol=pickle.HIGHEST_PROTOCOL))
+        self._assert_hist_equal(hist, copy)
+        copy += hist
+        self.assertTrue(np.array_equal(copy.array().flatten(), 2.0 * hist.array().flatten()))
+        return
+
+    def test_save_and_load(self):
+        _, columns = self._events(10**4, withosc=True)
+        probabilitycalc = _probabilitycalc()
+        s1 = BinnedSample("s1", self._binning(), ["recoenu"], columns, systematics=self._systematics())
+        s2 = BinnedSampleWithOscillation("s2", self._binning(), ["recoenu"], columns, "trueenu", "nupdg", 295.0, systematics=self._systematics(), probabilitycalc=probabilitycalc)
+        s3 = BinnedSampleWithOscillation("s3", self._binning(), ["recoenu"], columns, "trueenu", "nupdg", 295.0, probabilitycalc=probabilitycalc, responsematrix=True)
+        combined = CombinedBinnedSample([s2, s3], nthreads=1)
+        oscpars = list(PdgNeutrinoOscillationParameters().value(p) for p in PdgNeutrinoOscillationParameters.ALL_PARS_SINSQ)
+        tmpdir = tempfile.mkdtemp()
+        try:
+            for sample, pars in [(s1, np.array([1.5, -0.5])), (s2, np.array(oscpars + [1.5, -0.5])), (combined, np.array(oscpars + [1.5, -0.5]))]:
+                path = os.path.join(tmpdir, "model.bin")
+                sample.save(path)
+                for mmap in [False, True]:
+                    loaded = type(sample).load(path, mmap=mmap)
+                    self.assertEquals(loaded.parameter_names, sample.parameter_names)
+                    self.assertTrue(np.array_equal(loaded(pars), sample(pars)))
+                    self.assertTrue(np.array_equal(loaded(pars), sample(pars)))
+            with self.assertRaises(TypeError):
+                BinnedSampleWithOscillation.load(os.path.join(tmpdir, "model.bin"))
+        finally:
+            shutil.rmtree(tmpdir)
+        return
+
+################################################################################
+
+class _NoData(object):
+    #raises if the data are read, so the histograms must come from the cache
+    def __iter__(self):
+        raise AssertionError("data read when the cache should have been used")
+
+class _FileChunks(list):
+    #blocks of columns read from the files in filelist
+    def __init__(self, chunks, filelist):
+        super(_FileChunks, self).__init__(chunks)
+        self.filelist = filelist
+
+_INFILE = object()
+
+class TestCacheKey(unittest.TestCase):
+
+    def setUp(self):
+        self._tmpdir = tempfile.mkdtemp()
+        self._cachedir = os.path.join(self._tmpdir, "cache")
+        self._infile = os.path.join(self._tmpdir, "input.npy")
+
+    def tearDown(self):
+        shutil.rmtree(self._tmpdir)
+
+    def _columns(self, scale):
+        random = np.random.RandomState(1229)
+        coord = random.uniform(0.0, 5.0, size=(1000, 2))
+        return {"coord" : coord, "selweight" : scale * np.ones(len(coord)), "systweight" : random.normal(1.0, 0.1, size=(1000, 1, 3))}
+
+    def _sample(self, data, edges, knots=(-1.0, 0.0, 1.0), cache_digest=False, cache_files=_INFILE):
+        binning = [("x", edges), ("y", np.linspace(0.0, 5.0, num=6))]
+        systematics = SplineSystematics([("s", list(knots))])
+        if cache_files is _INFILE:
+            cache_files = [self._infile]
+        return BinnedSample("s", binning, ["x"], data, cache_name="testcachekey", systematics=systematics, cache_dir=self._cachedir, cache_files=cache_files, cache_digest=cache_digest)
+
+    def _write(self, scale, mtime):
+        np.save(self._infile, self._columns(scale)["selweight"])
+        os.utime(self._infile, (mtime, mtime))
+
+    def test_cache_hit(self):
+        self._write(1.0, 1000.0)
+        edges = np.linspace(0.0, 5.0, num=6)
+        s1 = self._sample(self._columns(1.0), edges)
+        s2 = self._sample(ChunkedData(_NoData()), edges)
+        self.assertTrue(np.array_equal(s1.N_sel.array().flatten(), s2.N_sel.array().flatten()))
+        return
+
+    def test_cache_invalidated(self):
+        self._write(1.0, 1000.0)
+        edges = np.linspace(0.0, 5.0, num=6)
+        s1 = self._sample(self._columns(1.0), edges)
+        #different binning
+        s2 = self._sample(self._columns(1.0), np.linspace(0.0, 5.0, num=11))
+        self.assertEquals(s2.N_sel.array().shape(), [10, 5])
+        #different knots, the selected histogram only changes if the data are read again
+        s3 = self._sample(self._columns(2.0), edges, knots=(-2.0, 0.0, 2.0))
+        self.assertTrue(np.array_equal(2.0 * s1.N_sel.array().flatten(), s3.N_sel.array().flatten()))
+        #modified input file
+        self._write(2.0, 2000.0)
+        s4 = self._sample(self._columns(2.0), edges)
+        self.assertTrue(np.array_equal(2.0 * s1.N_sel.array().flatten(), s4.N_sel.array().flatten()))
+        return
+
+    def test_cache_data_filelist(self):
+        #without cache_files the key uses the files of the data
+        self._write(1.0, 1000.0)
+        edges = np.linspace(0.0, 5.0, num=6)
+        def data(scale):
+            chunks = _FileChunks([self._columns(scale)], [self._infile])
+            return PartitionedData([ChunkedData(chunks), self._columns(0.0)])
+        self.assertEquals(data(1.0).filelist, [self._infile])
+        s1 = self._sample(data(1.0), edges, cache_files=None)
+        nodata = _NoData()
+        nodata.filelist = [self._infile]
+        s2 = self._sample(ChunkedData(nodata), edges, cache_files=None)
+        self.assertTrue(np.array_equal(s1.N_sel.array().flatten(), s2.N_sel.array().flatten()))
+        self.assertRaises(AssertionError, self._sample, ChunkedData(_NoData()), edges, cache_files=None)
+        self._write(2.0, 2000.0)
+        s3 = self._sample(data(2.0), edges, cache_files=None)
+        self.assertTrue(np.array_equal(2.0 * s1.N_sel.array().flatten(), s3.N_sel.array().flatten()))
+        return
+
+    def test_cache_digest(self):
+        self._write(1.0, 1000.0)
+        edges = np.linspace(0.0, 5.0, num=6)
+        s1 = self._sample(self._columns(1.0), edges, cache_digest=True)
+        #same size and modification time, only the content digest detects the change
+        self._write(2.0, 1000.0)
+        s2 = self._sample(self._columns(2.0), edges, cache_digest=True)
+        self.assertTrue(np.array_equal(2.0 * s1.N_sel.array().flatten(), s2.N_sel.array().flatten()))
+        return
+
+################################################################################
+
 def main():
     #TestModel("test_model_building_withosc").run()
     return unittest.main()
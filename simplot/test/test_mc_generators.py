@@ -4,7 +4,8 @@ import unittest
 
 import numpy as np
 
-from simplot.mc.generators import UniformGenerator, GaussianGenerator, MultiVariateGaussianGenerator, ConstantGenerator, GeneratorList, Generator
+from simplot.mc.generators import UniformGenerator, GaussianGenerator, MultiVariateGaussianGenerator, ConstantGenerator, GeneratorList, GeneratorSubset, Generator
+from simplot.mc.streams import RandomStream, derive_streams
 
 class TestGenerators(unittest.TestCase):
 
@@ -164,6 +165,86 @@ class TestGenerators(unittest.TestCase):
         self._checkcovariance(data, gen=gen)
         return
 
+    def test_multivargaus_lowrank(self):
+        #rank 3 covariance matrix, the Cholesky decomposition fails
+        random = np.random.RandomState(19023)
+        modes = random.normal(size=(len(self.mu), 3))
+        cov = np.dot(modes, modes.T)
+        gen = MultiVariateGaussianGenerator(self.names, self.mu, cov, seed=19024)
+        data = gen.generate(10**4)
+        self._checkmean(data, sigma=np.sqrt(np.diag(cov)), gen=gen)
+        self._checkcovariance(data, cov=cov, gen=gen)
+        #the smallest modes are dropped
+        truncated = MultiVariateGaussianGenerator(self.names, self.mu, cov, seed=19024, variancefraction=1.0 - 1e-9)
+        self.assertEquals(truncated.nmodes, 3)
+        data = truncated.generate(10**4)
+        self._checkcovariance(data, cov=cov, gen=truncated)
+        half = MultiVariateGaussianGenerator(self.names, self.mu, cov, variancefraction=0.5)
+        self.assertLessEqual(half.nmodes, 2)
+        self.assertEquals(half().shape, (len(self.mu),))
+        with self.assertRaises(ValueError):
+            MultiVariateGaussianGenerator(self.names, self.mu, cov, variancefraction=0.0)
+        return
+
+    def test_generatorsubset_marginal(self):
+        gaus = GaussianGenerator(["gaus"+n for n in self.names], self.mu, self.sigma, seed=19025)
+        multi = MultiVariateGaussianGenerator(["multi"+n for n in self.names], self.mu, self.cov, seed=19026)
+        parent = GeneratorList(gaus, multi)
+        parent.setfixed({"gaus"+self.names[2] : 7.0})
+        names = ["multi"+self.names[5], "gaus"+self.names[2], "multi"+self.names[3], "gaus"+self.names[1]]
+        subset = GeneratorSubset(names, parent)
+        #only the kept parameters are thrown
+        self.assertEquals(subset._marginal.parameter_names, ["gaus"+self.names[1], "gaus"+self.names[2], "multi"+self.names[3], "multi"+self.names[5]])
+        data = subset.generate(10**4)
+        mu = np.array([self.mu[5], 7.0, self.mu[3], self.mu[1]])
+        sigma = np.array([self.sigma[5], 0.0, self.sigma[3], self.sigma[1]])
+        cov = np.diag(sigma**2)
+        cov[0, 2] = cov[2, 0] = self.cov[5, 3]
+        self._checkmean(data, mu=mu, sigma=sigma)
+        self._checkcovariance(data, cov=cov)
+        #the subset has its own stream, even when seeded like the parent
+        parent.seed(19028)
+        subset.seed(19028)
+        throws = parent.generate(100)[:, [parent.parameter_names.index(n) for n in names]]
+        self.assertFalse(np.any(subset.generate(100)[:, [0, 2, 3]] == throws[:, [0, 2, 3]]))
+        #parameters fixed in the parent after the subset was built are fixed in the subset
+        parent.setfixed({"gaus"+self.names[1] : -3.0})
+        data = subset.generate(10)
+        self.assertTrue(np.all(data[:, 3] == -3.0))
+        self.assertTrue(np.all(data[:, 1] != 7.0))
+        parent.setfixed(None)
+        self.assertTrue(np.all(subset.generate(10)[:, 3] != -3.0))
+        #generators without a marginal distribution throw the full vector
+        class NoMarginal(Generator):
+            def _generate(self):
+                return np.arange(len(self.parameter_names), dtype=float)
+        subset = GeneratorSubset(["c", "a"], NoMarginal(["a", "b", "c"], [0.0, 1.0, 2.0]))
+        self.assertIsNone(subset._marginal)
+        self.assertTrue(np.array_equal(subset(), [2.0, 0.0]))
+        return
+
+    def test_random_streams(self):
+        root = RandomStream(19027)
+        #streams are identified by their seed and key
+        self.assertEquals(root.child(3), RandomStream(19027, key=(3,)))
+        self.assertTrue(np.array_equal(root.child(3).randomstate().normal(size=10), RandomStream(19027, (3,)).randomstate().normal(size=10)))
+        self.assertEquals(derive_streams(root, 4), derive_streams(19027, 4))
+        spawned = root.spawn(2) + root.spawn(2)
+        self.assertEquals(len(set(spawned)), 4)
+        draws = [s.randomstate().normal(size=1000) for s in spawned + [root, root.child(0).child(0)]]
+        for x, y in itertools.combinations(draws, 2):
+            self.assertFalse(np.array_equal(x, y))
+            self.assertLess(abs(np.corrcoef(x, y)[0, 1]), 0.15)
+        #generators accept streams and reseeding a list with the same stream repeats the throws
+        gen = GeneratorList(GaussianGenerator(["a", "b"], [0.0, 0.0], [1.0, 1.0], seed=root.child(0)), UniformGenerator(["c"], [0.5], [(0.0, 1.0)], seed=root.child(1)))
+        gen.seed(root)
+        first = gen.generate(10)
+        gen.seed(root)
+        self.assertTrue(np.array_equal(gen.generate(10), first))
+        gen.seed(root.child(5))
+        self.assertFalse(np.array_equal(gen.generate(10), first))
+        return
+
     def test_generatorlist(self):
         #make a generator list from every kind of generator we have
         mu = self.mu
@@ -191,6 +272,26 @@ class TestGenerators(unittest.TestCase):
         self._checkcovariance(data, gen=gen, cov=excov)
         return
 
+    def test_generate_batch(self):
+        def build(seed):
+            gaus = GaussianGenerator(["gaus"+n for n in self.names], self.mu, self.sigma, seed=seed)
+            multi = MultiVariateGaussianGenerator(["multi"+n for n in self.names], self.mu, self.cov, seed=seed + 1)
+            const = ConstantGenerator(["const"+n for n in self.names], self.mu)
+            uniform = UniformGenerator(["uniform"+n for n in self.names], self.mu, zip(self.mu - 1.0, self.mu + 1.0), seed=seed + 2)
+            gen = GeneratorList(gaus, multi, const, uniform)
+            gen.setfixed({"gaus"+self.names[1] : 7.0, "uniform"+self.names[2] : -7.0})
+            subset = GeneratorSubset(["multi"+self.names[3], "gaus"+self.names[1], "gaus"+self.names[2]], gen, seed=seed + 3)
+            return [gaus, multi, const, uniform, gen, subset]
+        npe = 100
+        for single, batch in zip(build(19022), build(19022)):
+            expected = np.array([single() for _ in xrange(npe)])
+            data = batch.generate(npe)
+            self.assertEquals(data.shape, (npe, len(batch.parameter_names)))
+            self.assertTrue(np.allclose(data, expected, rtol=1e-12, atol=1e-12))
+            #the streams continue from the same point
+            self.assertTrue(np.allclose(batch.generate(1)[0], single(), rtol=1e-12, atol=1e-12))
+        return
+
     def _checkmean(self, data, mu=None, sigma=None, precision=None, gen=None):
         if mu is None:
             mu = self.mu
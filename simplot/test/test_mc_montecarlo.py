@@ -1,13 +1,15 @@
 
 import itertools
 import math
+import os
+import time
 import unittest
 
 import numpy as np
 
 from simplot.mc.generators import GaussianGenerator
 #from simplot.mc.Likelihood import Minus2LnLikelihood, GaussianLikelihood
-from simplot.mc.montecarlo import ToyMC, MonteCarloException, MonteCarloParameterMismatch
+from simplot.mc.montecarlo import ToyMC, MonteCarloException, MonteCarloParameterMismatch, generate_events, generate_parallel
 from simplot.mc.statistics import calculate_statistics_from_toymc, Mean, StandardDeviation, FractionalStandardDeviation, Covariance
 
 class TestMonteCarlo(unittest.TestCase):
@@ -76,6 +78,99 @@ class TestMonteCarlo(unittest.TestCase):
 #                self.assertAlmostEquals(v1, v2, delta=delta)
 #        return
 
+    def test_generate_batch(self):
+        toymc = ToyMC(self.model, GaussianGenerator(self.model.parameter_names, self.mu, self.sigma, seed=12913))
+        expected = [toymc() for _ in xrange(100)]
+        toymc.generator.seed(12913)
+        batch = toymc.generate_batch(100)
+        self.assertEquals(batch.pars.shape, (100, 2))
+        self.assertEquals(batch.vec.shape, (100, 2))
+        for exp, bexp in itertools.izip_longest(expected, batch):
+            self.assertTrue(np.array_equal(exp.pars, bexp.pars))
+            self.assertTrue(np.array_equal(exp.vec, bexp.vec))
+        #generate_events throws in batches but returns independent experiments
+        toymc.generator.seed(12913)
+        events = list(generate_events(toymc, 100))
+        for exp, event in itertools.izip_longest(expected, events):
+            self.assertTrue(np.array_equal(exp.pars, event.pars))
+            self.assertTrue(event.pars.base is None and event.vec.base is None)
+        #Poisson fluctuations of a constant rate
+        toymc = ToyMC(self.model, GaussianGenerator(self.model.parameter_names, [5.0, 50.0], [0.0, 0.0]), seed=12914)
+        vec = toymc.generate_batch(10**4, poisson=True).vec
+        self.assertTrue(np.array_equal(vec, np.round(vec)))
+        mean = Mean()
+        mean.add_batch(vec)
+        for v, er, ex in zip(mean.eval(), mean.err(), [5.0, 50.0]):
+            self.assertAlmostEquals(v, ex, delta=3.0*er)
+        return
+
+    def test_generate_parallel(self):
+        toymc = ToyMC(self.model, self.gen)
+        results = []
+        for nprocesses in [1, 3]:
+            batches = list(generate_parallel(toymc, n=2500, nprocesses=nprocesses, seed=12915, batchsize=1000))
+            self.assertEquals([len(b) for b in batches], [1000, 1000, 500])
+            results.append(np.concatenate([b.pars for b in batches]))
+        self.assertTrue(np.array_equal(results[0], results[1]))
+        #the caller's toymc is not reseeded
+        caller = ToyMC(self.model, GaussianGenerator(self.model.parameter_names, self.mu, self.sigma, seed=12916))
+        expected = ToyMC(self.model, GaussianGenerator(self.model.parameter_names, self.mu, self.sigma, seed=12916))
+        list(generate_parallel(caller, n=100, nprocesses=1, seed=12915))
+        self.assertTrue(np.array_equal(caller.generate_batch(10).pars, expected.generate_batch(10).pars))
+        #two generators consumed at the same time
+        for nprocesses in [1, 2]:
+            first = generate_parallel(toymc, n=2500, nprocesses=nprocesses, seed=12915, batchsize=1000)
+            second = generate_parallel(toymc, n=2500, nprocesses=nprocesses, seed=12917, batchsize=1000)
+            interleaved = zip(*itertools.izip(first, second))
+            self.assertTrue(np.array_equal(np.concatenate([b.pars for b in interleaved[0]]), results[0]))
+            self.assertFalse(np.array_equal(np.concatenate([b.pars for b in interleaved[1]]), results[0]))
+        #the toymc can also be built in each worker
+        def factory():
+            return ToyMC(self.model, GaussianGenerator(self.model.parameter_names, self.mu, self.sigma))
+        unordered = np.concatenate([b.pars for b in generate_parallel(factory, n=2500, nprocesses=3, ordered=False, seed=12915, batchsize=1000)])
+        self.assertTrue(np.array_equal(np.sort(unordered, axis=0), np.sort(results[0], axis=0)))
+        #time limit without a number of events
+        for nprocesses in [1, 2]:
+            count = 0
+            start = time.time()
+            for batch in generate_parallel(toymc, maxseconds=0.5, nprocesses=nprocesses, batchsize=10):
+                count += len(batch)
+            self.assertGreater(count, 0)
+            self.assertLess(time.time() - start, 5.0)
+        #the time limit is checked while waiting for a slow batch
+        def slowfactory():
+            def slowmodel(pars):
+                time.sleep(10.0)
+                return np.copy(pars)
+            slowmodel.parameter_names = self.model.parameter_names
+            return ToyMC(slowmodel, GaussianGenerator(self.model.parameter_names, self.mu, self.sigma))
+        start = time.time()
+        self.assertEquals(list(generate_parallel(slowfactory, n=10, maxseconds=0.5, nprocesses=2)), [])
+        self.assertLess(time.time() - start, 5.0)
+        with self.assertRaises(ValueError):
+            list(generate_parallel(toymc))
+        return
+
+    def test_generate_parallel_lost_task(self):
+        #a worker that dies or a batch that cannot be returned raises rather than waiting forever
+        def dyingfactory():
+            def dyingmodel(pars):
+                os._exit(1)
+            dyingmodel.parameter_names = self.model.parameter_names
+            return ToyMC(dyingmodel, GaussianGenerator(self.model.parameter_names, self.mu, self.sigma))
+        def unpicklablefactory():
+            class UnpicklableModel(object):
+                parameter_names = self.model.parameter_names
+                def eval_batch(self, pars):
+                    return np.array([[lambda: None] * len(self.parameter_names)] * len(pars), dtype=object)
+            return ToyMC(UnpicklableModel(), GaussianGenerator(self.model.parameter_names, self.mu, self.sigma))
+        for factory in [dyingfactory, unpicklablefactory]:
+            start = time.time()
+            with self.assertRaises(Exception):
+                list(generate_parallel(factory, n=100, nprocesses=2, batchsize=10))
+            self.assertLess(time.time() - start, 5.0)
+        return
+
     def test_toymcexperiment_clone(self):
         toymc = ToyMC(self.model, self.gen)
         exp1 = toymc()
@@ -49,6 +49,131 @@ class TestStatistics(unittest.TestCase):
                 self.assertAlmostEquals(x[ii,jj], exp[ii,jj], delta=5.0*err[ii,jj])
         return
 
+    def test_merge(self):
+        gen = GaussianGenerator(["a", "b", "c"], [1.0, 2.0, 3.0], [1.0, 1.0, 1.0], seed=1291)
+        toys = [gen() for _ in xrange(100)]
+        for cls in [Mean, StandardDeviation, lambda: Covariance(fractional=True)]:
+            total = cls()
+            partials = [cls() for _ in xrange(3)]
+            for ii, x in enumerate(toys):
+                total.add(x)
+                partials[ii % 3].add(x)
+            merged = cls()
+            for p in partials:
+                merged.merge(p)
+            self.assertTrue(np.allclose(merged.eval(), total.eval(), rtol=1e-12, atol=1e-12))
+        return
+
+    def test_stable_accumulators(self):
+        #a large offset cancels catastrophically in E[x^2] - E[x]^2
+        random = np.random.RandomState(1292)
+        toys = 1.0e9 + random.normal(size=(1000, 3)) * np.array([1.0, 2.0, 3.0])
+        expectedcov = np.cov(toys - 1.0e9, rowvar=0, bias=1)
+        #the raw sums lose every significant figure of the variance
+        naive = np.dot(toys.T, toys) / len(toys) - np.outer(np.mean(toys, axis=0), np.mean(toys, axis=0))
+        self.assertFalse(np.allclose(naive, expectedcov, rtol=0.0, atol=0.1 * np.max(np.diag(expectedcov))))
+        for cls, expected in [(StandardDeviation, np.sqrt(np.diag(expectedcov))), (Covariance, expectedcov)]:
+            single = cls()
+            for x in toys:
+                single.add(x)
+            batched = cls()
+            batched.add_batch(toys[:300])
+            batched.add_batch(toys[300:])
+            merged = cls()
+            for part in [toys[:10], toys[10:700], toys[700:]]:
+                partial = cls()
+                partial.add_batch(part)
+                merged.merge(partial)
+            for s in [single, batched, merged]:
+                #off-diagonal terms are close to zero, so compare on the scale of the variances
+                self.assertTrue(np.allclose(s.eval(), expected, rtol=0.0, atol=1e-6 * np.max(np.diag(expectedcov))))
+            self.assertEquals(merged._count, len(toys))
+        return
+
+    def test_covariance_error(self):
+        cov = np.array([[4.0, 1.0, 0.0], [1.0, 9.0, -2.0], [0.0, -2.0, 0.0]])
+        N = 100
+        expected = np.zeros_like(cov)
+        for ii, jj in itertools.product(xrange(3), repeat=2):
+            if ii == jj:
+                expected[ii, jj] = np.sqrt(2) * (cov[ii, jj] / np.sqrt(N))
+            else:
+                denominator = np.sqrt(cov[ii, ii] * cov[jj, jj])
+                corr = cov[ii, jj] / denominator if denominator != 0.0 else 0.0
+                expected[ii, jj] = np.sqrt((1.0 + abs(corr)) * (cov[ii, ii] * cov[jj, jj] / N))
+        self.assertTrue(np.array_equal(covariance_error(cov, N), expected))
+        expectedcorr = np.array([[1.0, 1.0 / 6.0, 0.0], [1.0 / 6.0, 1.0, 0.0], [0.0, 0.0, 0.0]])
+        self.assertTrue(np.allclose(correlation_matrix(cov), expectedcorr))
+        mu = np.array([2.0, 3.0, 0.0])
+        self.assertTrue(np.allclose(fractional_covariance(cov, mu), [[1.0, 1.0 / 6.0, 0.0], [1.0 / 6.0, 1.0, 0.0], [0.0, 0.0, 0.0]]))
+        return
+
+    def test_lowrankcovariance(self):
+        #two correlated modes plus independent noise in each bin
+        random = np.random.RandomState(1293)
+        nbins = 50
+        modes = random.normal(size=(nbins, 2)) * np.array([5.0, 2.0])
+        noise = 0.5 * np.ones(nbins)
+        toys = 10.0 + np.dot(random.normal(size=(2000, 2)), modes.T) + random.normal(size=(2000, nbins)) * noise
+        dense = Covariance()
+        dense.add_batch(toys)
+        lowrank = LowRankCovariance(2, oversample=4)
+        for x in toys[:100]:
+            lowrank.add(x)
+        lowrank.add_batch(toys[100:1500])
+        partial = LowRankCovariance(2, oversample=4)
+        partial.add_batch(toys[1500:])
+        lowrank.merge(partial)
+        self.assertEquals(lowrank._count, len(toys))
+        self.assertTrue(len(lowrank._sketch) <= 6)
+        expected = dense.eval()
+        factor, residual = lowrank.factors()
+        self.assertEquals(factor.shape, (nbins, 2))
+        #exact diagonal
+        self.assertTrue(np.allclose(np.diag(lowrank.eval()), np.diag(expected), rtol=1e-8))
+        x = random.normal(size=nbins)
+        self.assertTrue(np.allclose(lowrank.matvec(x), np.dot(expected, x), rtol=0.05, atol=0.05 * np.linalg.norm(np.dot(expected, x))))
+        #exports
+        names = ["bin%s" % ii for ii in xrange(nbins)]
+        gen = lowrank.generator(names, seed=1294)
+        self.assertTrue(np.allclose(np.cov(gen.generate(5000), rowvar=0), lowrank.eval(), atol=0.1 * np.max(np.abs(expected))))
+        lhd = lowrank.likelihood(names)
+        mu = lowrank._mean()
+        exact = -0.5 * np.dot(x, np.linalg.solve(lowrank.eval(), x))
+        self.assertAlmostEquals(lhd(mu + x), exact, delta=1e-6 * abs(exact))
+        return
+
+    def test_quantiles(self):
+        names = ["a", "b", "c"]
+        gen = GaussianGenerator(names, [0.0, 10.0, -5.0], [1.0, 2.0, 0.5], seed=1295)
+        toys = gen.generate(20000)
+        probabilities = [0.01, 0.1587, 0.5, 0.8413, 0.99]
+        expected = np.array([np.percentile(toys, 100.0 * p, axis=0) for p in probabilities])
+        sigma = np.array([1.0, 2.0, 0.5])
+        single = [QuantileDigest(probabilities), Histogram(nbins=400)]
+        calculate_statistics(iter(toys).next, single, 5000)
+        add_batch(single, toys[5000:])
+        merged = [QuantileDigest(probabilities), Histogram(nbins=400, range=[(-6.0, 6.0), (-2.0, 22.0), (-8.0, -2.0)])]
+        for part in [toys[:7000], toys[7000:]]:
+            partials = [QuantileDigest(probabilities), Histogram(nbins=400, range=[(-6.0, 6.0), (-2.0, 22.0), (-8.0, -2.0)])]
+            add_batch(partials, part)
+            for m, p in zip(merged, partials):
+                m.merge(p)
+        for s in single + merged:
+            self.assertEquals(s._count, len(toys))
+            result = s.quantile(probabilities)
+            self.assertEquals(result.shape, (len(probabilities), len(names)))
+            self.assertTrue(np.all(np.abs(result - expected) < 0.03 * sigma))
+            lower, upper = s.interval(0.6827)
+            self.assertTrue(np.allclose(upper - lower, 2.0 * sigma, rtol=0.05))
+        self.assertTrue(np.allclose(single[0].eval(), expected, atol=0.02 * np.max(sigma)))
+        #about delta / 2 centroids, with single points at the extremes
+        self.assertTrue(single[0]._means.shape[1] <= 200)
+        self.assertTrue(np.all(single[0]._weights[:, 0] == 1.0))
+        self.assertEquals(np.sum(merged[1].eval()) + sum(np.sum(x) for x in merged[1].outofrange()), len(names) * len(toys))
+        self.assertRaises(ValueError, merged[1].merge, single[1])
+        return
+
     def test_roothistogram(self):
         names = ["a", "b"]
         expectedmu = np.array([2.0, 4.0])
@@ -1,9 +1,14 @@
 
+import copy
 import itertools
 import math
+import os
 import random
+import shutil
 import string
+import tempfile
 import unittest
+from collections import OrderedDict
 
 import numpy as np
 
@@ -17,7 +22,7 @@ from simplot.mc.priors import GaussianPrior, CombinedPrior, OscillationParameter
 from simplot.binnedmodel.sample import Sample, BinnedSample, BinnedSampleWithOscillation, CombinedBinnedSample, OscParMode
 from simplot.binnedmodel.systematics import Systematics, SplineSystematics, FluxSystematics, FluxAndSplineSystematics
 
-from simplot.binnedmodel.simplemodel import SimpleMcBuilder, SimpleMcWithOscillationBuilder
+from simplot.binnedmodel.simplemodel import SimpleMcBuilder, SimpleMcWithOscillationBuilder, SimpleModel, CovarianceMethod, compare_precision
 
 import simplot.rootprob3pp.lib
 import ROOT
@@ -29,12 +34,12 @@ def _smear(x, state=np.random, resolution=0.1):
 
 class TestSimpleFit(unittest.TestCase):
 
-    def _buildtestmc(self, cachestr=None):
+    def _buildtestmc(self, cachestr=None, **kwargs):
         systematics = [("x", [-5.0, 0.0, 5.0]),
                        ("y", [-5.0, 0.0, 5.0]),
                        ("z", [-10.0, -5.0, 0.0, 5.0, 10.0]),
         ]
-        systematics = SplineSystematics(systematics)
+        systematics = SplineSystematics(systematics, dtype=kwargs.get("dtype", np.float64))
         random = np.random.RandomState(seed=1223)
         def gen(N):
             for _ in xrange(N):
@@ -42,7 +47,7 @@ class TestSimpleFit(unittest.TestCase):
                 yield coord, 1.0, [(_smear(-4.0, random), _smear(1.0, random), _smear(5.0, random)), (_smear(-4.0, random), _smear(1.0, random), _smear(5.0, random)), (_smear(-9.0, random), _smear(-4.0, random), _smear(1.0, random), _smear(5.0, random), _smear(10.0, random))]
         binning = [("a", np.arange(0.0, 5.0)), ("b", np.arange(0.0, 5.0))]
         observables = ["a"]
-        model = BinnedSample("simplemodel", binning, observables, gen(10**4), systematics=systematics, cache_name=cachestr)
+        model = BinnedSample("simplemodel", binning, observables, gen(10**4), systematics=systematics, cache_name=cachestr, **kwargs)
         generator = GaussianGenerator(["x", "y", "z"], [1.0, 2.0, 3.0], [1.0, 2.0, 3.0], seed=1224)
         toymc = ToyMC(model, generator)
         return toymc
@@ -54,6 +59,152 @@ class TestSimpleFit(unittest.TestCase):
         toymc2()
         return
 
+    def test_reproducible_build(self):
+        throws = []
+        for seed in [1230, 1230, 1231, None, None]:
+            toymc, cov = SimpleMcBuilder().build(None, self._buildtestmc(), keep={"x":[-5.0, 0.0, 5.0]}, npe=10, seed=seed)
+            throws.append(toymc.generator.generate(5))
+        self.assertTrue(np.array_equal(throws[0], throws[1]))
+        self.assertFalse(np.array_equal(throws[0], throws[2]))
+        #without a seed the built generator follows the seeded input generator
+        self.assertTrue(np.array_equal(throws[3], throws[4]))
+        return
+
+    def test_parallel_splines(self):
+        toymc = self._buildtestmc()
+        keep = {"z":[-10.0, -5.0, 0.0, 1.0, 5.0, 10.0]}
+        builder = SimpleMcBuilder()
+        builder.build(None, toymc, keep=keep, npe=10)
+        s1 = builder._generate_splines(toymc, toymc.asimov().vec, keep=keep, spline_points=keep)
+        builder.nprocesses = 3
+        s2 = builder._generate_splines(toymc, toymc.asimov().vec, keep=keep, spline_points=keep)
+        pars = np.array([7.5])
+        self.assertTrue(np.array_equal(s1["z"](pars), s2["z"](pars)))
+        return
+
+    def test_parallel_covariance(self):
+        toymc = self._buildtestmc()
+        results = []
+        for nprocesses in [1, 3]:
+            builder = SimpleMcBuilder()
+            builder.build(None, toymc, npe=10, nprocesses=nprocesses, seed=1225)
+            expected = copy.deepcopy(toymc.generator).generate(5)
+            results.append(builder._generate_covariance(toymc, None, npe=2500))
+            #the toymc passed in is not reseeded
+            self.assertTrue(np.array_equal(toymc.generator.generate(5), expected))
+        (cov1, mean1), (cov2, mean2) = results
+        self.assertTrue(np.array_equal(cov1, cov2))
+        self.assertTrue(np.array_equal(mean1, mean2))
+        return
+
+    def test_stacked_splines(self):
+        toymc = self._buildtestmc()
+        keep = OrderedDict([("x", [-2.0, 0.0, 2.0]), ("z", [-10.0, -5.0, 0.0, 1.0, 5.0, 10.0])])
+        builder = SimpleMcBuilder()
+        builder.build(None, toymc, keep=keep, npe=10)
+        nominal = toymc.asimov().vec
+        splines = builder._generate_splines(toymc, nominal, keep=keep, spline_points=keep)
+        model = SimpleModel(nominal, splines)
+        random = np.random.RandomState(1226)
+        out = np.zeros(len(nominal))
+        for _ in xrange(100):
+            pars = np.concatenate([random.uniform(-12.0, 12.0, size=2), random.uniform(0.5, 1.5, size=len(nominal))])
+            expected = np.ones(len(nominal))
+            for wc in splines.itervalues():
+                expected *= wc(pars)
+            expected = expected * pars[2:] * nominal
+            self.assertTrue(np.allclose(model(pars), expected, rtol=1e-12, atol=0.0))
+            self.assertIs(model(pars, out=out), out)
+            self.assertTrue(np.allclose(out, expected, rtol=1e-12, atol=0.0))
+        return
+
+    def test_eval_batch(self):
+        toymc = self._buildtestmc()
+        keep = OrderedDict([("x", [-2.0, 0.0, 2.0]), ("z", [-10.0, -5.0, 0.0, 1.0, 5.0, 10.0])])
+        builder = SimpleMcBuilder()
+        builder.build(None, toymc, keep=keep, npe=10)
+        nominal = toymc.asimov().vec
+        model = SimpleModel(nominal, builder._generate_splines(toymc, nominal, keep=keep, spline_points=keep))
+        random = np.random.RandomState(1230)
+        pars = np.column_stack([random.uniform(-12.0, 12.0, size=(50, 2)), random.uniform(0.5, 1.5, size=(50, len(nominal)))])
+        self.assertTrue(np.array_equal(model.eval_batch(pars), np.array([model(p) for p in pars])))
+        return
+
+    def test_jacobian(self):
+        toymc = self._buildtestmc()
+        keep = OrderedDict([("x", [-2.0, 0.0, 2.0]), ("z", [-10.0, -5.0, 0.0, 1.0, 5.0, 10.0])])
+        builder = SimpleMcBuilder()
+        builder.build(None, toymc, keep=keep, npe=10)
+        nominal = toymc.asimov().vec
+        model = SimpleModel(nominal, builder._generate_splines(toymc, nominal, keep=keep, spline_points=keep))
+        pars = np.concatenate([[0.7, -3.2], np.linspace(0.5, 1.5, num=len(nominal))])
+        vec, jac = model.eval_and_jacobian(pars)
+        self.assertTrue(np.allclose(vec, model(pars), rtol=1e-12, atol=0.0))
+        h = 1e-6
+        for ipar in xrange(len(pars)):
+            up = np.copy(pars)
+            up[ipar] += h
+            down = np.copy(pars)
+            down[ipar] -= h
+            numerical = (model(up) - model(down)) / (2.0 * h)
+            self.assertTrue(np.allclose(jac[:, ipar], numerical, rtol=1e-6, atol=1e-6))
+        return
+
+    def test_single_precision(self):
+        toymc = self._buildtestmc()
+        keep = OrderedDict([("x", [-2.0, 0.0, 2.0]), ("z", [-10.0, -5.0, 0.0, 1.0, 5.0, 10.0])])
+        builder = SimpleMcBuilder()
+        builder.build(None, toymc, keep=keep, npe=10)
+        nominal = toymc.asimov().vec
+        splines = builder._generate_splines(toymc, nominal, keep=keep, spline_points=keep)
+        m64 = SimpleModel(nominal, splines)
+        m32 = SimpleModel(nominal, splines, dtype=np.float32)
+        random = np.random.RandomState(1229)
+        parameters = [np.concatenate([random.uniform(-12.0, 12.0, size=2), random.uniform(0.5, 1.5, size=len(nominal))]) for _ in xrange(20)]
+        self.assertEquals(m32(parameters[0]).dtype, np.float64)
+        maxobs, maxlhd = compare_precision(m64, m32, parameters)
+        self.assertLess(maxobs, 1e-6)
+        #the likelihood is only compared where all rates are positive, far outside the knots the rates
+        #are negative and the likelihood (~1e14) differs by its own float64 rounding.
+        #A relative change of ~1e-7 in the rates moves a log-likelihood of ~1e5 by ~1e-3.
+        parameters = [np.concatenate([random.uniform(-1.0, 1.0, size=2), random.uniform(0.5, 1.5, size=len(nominal))]) for _ in xrange(20)]
+        self.assertTrue(all(np.all(m64(p) > 0.0) for p in parameters))
+        maxobs, maxlhd = compare_precision(m64, m32, parameters)
+        self.assertLess(maxlhd, 1e-2)
+        #the binned model is compared on its observable rate vector
+        b64 = self._buildtestmc().ratevector._model
+        b32 = self._buildtestmc(dtype=np.float32, densethreshold=0.0).ratevector._model
+        parameters = [random.uniform(-4.0, 4.0, size=3) for _ in xrange(20)]
+        maxobs, maxlhd = compare_precision(b64, b32, parameters)
+        self.assertGreater(maxobs, 0.0)
+        self.assertLess(maxobs, 1e-5)
+        self.assertLess(maxlhd, 1e-2)
+        return
+
+    def test_linear_covariance(self):
+        class LinearModel(object):
+            parameter_names = ["x", "y", "z"]
+            def __call__(self, pars):
+                return np.dot([[1.0, 0.5, 0.0], [0.0, 2.0, 1.0], [3.0, 0.0, 0.5]], pars) + 10.0
+        toymc = ToyMC(LinearModel(), GaussianGenerator(["x", "y", "z"], [1.0, 2.0, 3.0], [1.0, 2.0, 3.0], seed=1228))
+        A = np.array([[1.0, 0.5, 0.0], [0.0, 2.0, 1.0], [3.0, 0.0, 0.5]])
+        mean = np.dot(A, [1.0, 2.0, 3.0]) + 10.0
+        expected = np.dot(A, np.dot(np.diag([1.0, 4.0, 9.0]), A.T)) / np.outer(mean, mean)
+        builder = SimpleMcBuilder()
+        for method in [CovarianceMethod.LINEAR, CovarianceMethod.QUADRATIC]:
+            builder.method = method
+            cov, m = builder._generate_covariance_with_cache(toymc, None)
+            self.assertTrue(np.allclose(cov, expected, rtol=1e-6, atol=0.0))
+            #the quadratic correction is a finite difference Hessian, zero up to rounding
+            self.assertTrue(np.allclose(m, mean, rtol=1e-9, atol=0.0))
+        comparison = builder.compare_covariance(toymc, npe=2000)
+        self.assertTrue(comparison.agrees(threshold=5.0))
+        #the spline model has an analytic Jacobian
+        toymc2, cov = SimpleMcBuilder().build(None, self._buildtestmc(), keep={"z":[-10.0, -5.0, 0.0, 1.0, 5.0, 10.0]}, method=CovarianceMethod.LINEAR)
+        self.assertEquals(cov.shape, (len(toymc2.asimov().vec),) * 2)
+        toymc2()
+        return
+
     def test_eval_model(self):
         npe = 10**4
         toymc1 = self._buildtestmc()
@@ -102,6 +253,44 @@ class TestSimpleFitWithOscillation(unittest.TestCase):
         toymc2()
         return
 
+    def test_oscillation_cache_and_out(self):
+        toymc1 = self._buildtestmc()
+        toymc2, cov = SimpleMcWithOscillationBuilder().build(None, toymc1, toymc1.ratevector, npe=10)
+        model = toymc2.ratevector
+        pars = np.copy(toymc2.asimov().pars)
+        nominal = np.copy(model(pars))
+        #only the bin weights change, the cached oscillated prediction is reused
+        pars[6:] = 2.0
+        out = np.zeros(len(nominal))
+        self.assertIs(model(pars, out=out), out)
+        self.assertTrue(np.allclose(out, 2.0 * nominal, rtol=1e-12, atol=0.0))
+        #the oscillation parameters change, the prediction must be recalculated
+        pars[6:] = 1.0
+        pars[1] *= 0.5
+        oscillated = np.copy(model(pars))
+        self.assertFalse(np.allclose(oscillated, nominal))
+        fresh = SimpleMcWithOscillationBuilder().build(None, toymc1, toymc1.ratevector, npe=10)[0].ratevector
+        self.assertTrue(np.allclose(oscillated, fresh(pars), rtol=1e-12, atol=0.0))
+        return
+
+    def test_save_and_load(self):
+        toymc1 = self._buildtestmc()
+        toymc2, cov = SimpleMcWithOscillationBuilder().build(None, toymc1, toymc1.ratevector, npe=10)
+        model = toymc2.ratevector
+        pars = np.copy(toymc2.asimov().pars)
+        pars[6:] = 1.5
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, "model.bin")
+            model.save(path)
+            for mmap in [False, True]:
+                loaded = type(model).load(path, mmap=mmap)
+                self.assertEquals(loaded.parameter_names, model.parameter_names)
+                self.assertTrue(np.array_equal(loaded(pars), model(pars)))
+        finally:
+            shutil.rmtree(tmpdir)
+        return
+
     def test_eval_model(self):
         npe = 10**3
         toymc1 = self._buildtestmc()